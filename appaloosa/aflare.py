@@ -7,6 +7,7 @@ Algorithm originally from here: https://github.com/jradavenport/FBEYE
 '''
 
 import numpy as np
+from runlength import Ranges
 
 def aflare(t, p):
     """
@@ -96,4 +97,174 @@ def aflare1(t, tpeak, fwhm, ampl):
                                         _fd[2]*np.exp( ((x-tpeak)/fwhm)*_fd[3] ))]
                             ) * np.abs(ampl) # amplitude
 
-    return flare
\ No newline at end of file
+    return flare
+
+
+def _aflare1_shape(x, deriv=False):
+    '''
+    The aflare1 model w/ unit amplitude, as a function of x = (t-tpeak)/fwhm.
+    Same pieces as aflare1: polynomial rise, double exponential decay.
+    If deriv=True, also return the derivative with respect to x.
+    '''
+    _fr = [1.00000, 1.94053, -0.175084, -2.24588, -1.12498]
+    _fd = [0.689008, -1.60053, 0.302963, -0.278318]
+
+    rise = (x <= 0) & (x > -1.)
+    decay = (x > 0)
+
+    shape = np.zeros_like(x)
+    xr = x[rise]
+    shape[rise] = _fr[0] + xr*(_fr[1] + xr*(_fr[2] + xr*(_fr[3] + xr*_fr[4])))
+
+    xd = x[decay]
+    e1 = _fd[0] * np.exp(xd * _fd[1])
+    e2 = _fd[2] * np.exp(xd * _fd[3])
+    shape[decay] = e1 + e2
+
+    if deriv is False:
+        return shape
+
+    dshape = np.zeros_like(x)
+    dshape[rise] = _fr[1] + xr*(2.*_fr[2] + xr*(3.*_fr[3] + xr*4.*_fr[4]))
+    dshape[decay] = e1 * _fd[1] + e2 * _fd[3]
+
+    return shape, dshape
+
+
+def aflare1_jac(t, tpeak, fwhm, ampl):
+    '''
+    The analytic Jacobian of aflare1, i.e. the partial derivatives of the
+    model with respect to (tpeak, fwhm, ampl) at each time. For use with
+    gradient based fitting (e.g. flarefit.FitFlare), instead of finite
+    differences.
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array to evaluate the derivatives over
+    tpeak : float
+        The time of the flare peak
+    fwhm : float
+        The "Full Width at Half Maximum", timescale of the flare
+    ampl : float
+        The amplitude of the flare
+
+    Returns
+    -------
+    jac : 2-d array, shape (len(t), 3)
+        columns are d(flare)/d(tpeak), d(flare)/d(fwhm), d(flare)/d(ampl)
+    '''
+    x = (np.asarray(t, dtype='float') - tpeak) / fwhm
+    shape, dshape = _aflare1_shape(x, deriv=True)
+
+    jac = np.empty((len(x), 3), dtype='float')
+    jac[:,0] = -np.abs(ampl) * dshape / fwhm
+    jac[:,1] = -np.abs(ampl) * dshape * x / fwhm
+    jac[:,2] = (-1. if ampl < 0 else 1.) * shape
+
+    return jac
+
+
+def aflare1_support(tol=1e-4):
+    '''
+    How far after the peak (in units of fwhm) the aflare1 decay must be
+    followed before it drops below a fraction "tol" of the amplitude.
+    The rise always starts at 1 fwhm before the peak.
+
+    Uses the bound fd0*exp(fd1*x) + fd2*exp(fd3*x) <= (fd0+fd2)*exp(fd3*x),
+    since the 2nd exponential is the slower one.
+    '''
+    _fd = [0.689008, -1.60053, 0.302963, -0.278318]
+    return max(np.log(tol / (_fd[0] + _fd[2])) / _fd[3], 0.)
+
+
+def aflare1_ed(fwhm, ampl):
+    '''
+    The integral of the aflare1 model over time, i.e. the equivalent
+    duration if ampl is in relative flux units. Has the units of fwhm.
+
+    The polynomial rise integrates to 0.3078 fwhm, and the double
+    exponential decay to 1.5190 fwhm, so ED ~ 1.827 * fwhm * ampl
+    '''
+    _fr = [1.00000, 1.94053, -0.175084, -2.24588, -1.12498]
+    _fd = [0.689008, -1.60053, 0.302963, -0.278318]
+
+    rise = sum([_fr[k] * (-1.)**k / (k + 1.) for k in range(len(_fr))])
+    decay = -_fd[0] / _fd[1] - _fd[2] / _fd[3]
+
+    return (rise + decay) * fwhm * np.abs(ampl)
+
+
+def aflare_sparse(t, tpeak, fwhm, ampl, tol=1e-4):
+    '''
+    Evaluate many single-peak flares (the aflare1 model) at once, only
+    within each flare's support: from 1 fwhm before the peak, until the
+    decay falls below tol*ampl. Costs ~ the number of points inside the
+    flares, rather than len(t) per flare.
+
+    One extra point is kept on either side of each flare's support, so
+    trapezoid integrals (e.g. the equivalent duration) over each flare's
+    points match those over the full time array.
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array, must be sorted
+    tpeak : 1-d array
+        The peak time of each flare
+    fwhm : 1-d array
+        The "Full Width at Half Maximum" of each flare
+    ampl : 1-d array
+        The amplitude of each flare (sign is ignored, as in aflare1)
+    tol : float, optional
+        Fraction of the amplitude the decay is followed down to.
+        (Default is 1e-4)
+
+    Returns
+    -------
+    indx, flare, flux : 1-d arrays
+        For every point evaluated: the index in to t, which flare it
+        belongs to, and that flare's flux there
+    '''
+    t = np.asarray(t, dtype='float')
+    tpeak = np.atleast_1d(np.asarray(tpeak, dtype='float'))
+    fwhm = np.atleast_1d(np.asarray(fwhm, dtype='float'))
+    ampl = np.atleast_1d(np.asarray(ampl, dtype='float'))
+
+    xmax = aflare1_support(tol)
+    i0 = np.searchsorted(t, tpeak - fwhm, side='right') - 1
+    i1 = np.searchsorted(t, tpeak + xmax * fwhm, side='right') + 1
+
+    indx, flare = Ranges(np.clip(i0, 0, len(t)), np.clip(i1, 0, len(t)))
+
+    x = (t[indx] - tpeak[flare]) / fwhm[flare]
+    flux = _aflare1_shape(x) * np.abs(ampl[flare])
+
+    return indx, flare, flux
+
+
+def aflare_many(t, tpeak, fwhm, ampl, tol=1e-4):
+    '''
+    The summed light curve of many single-peak flares (the aflare1 model),
+    each only evaluated within its support. See aflare_sparse.
+
+    Matches aflare(t, p) with p = [tpeak, fwhm, ampl] x N (for positive
+    amplitudes) to within tol*ampl, but needs the time array to be sorted.
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array, must be sorted
+    tpeak : 1-d array
+    fwhm : 1-d array
+    ampl : 1-d array
+    tol : float, optional
+        (Default is 1e-4)
+
+    Returns
+    -------
+    flare : 1-d array
+        The flux of all the flares evaluated at each time
+    '''
+    indx, _, flux = aflare_sparse(t, tpeak, fwhm, ampl, tol=tol)
+    return np.bincount(indx, weights=flux, minlength=len(t))
@@ -9,28 +9,41 @@ from os.path import expanduser
 import time
 import datetime
 from version import __version__
-from aflare import aflare1
+from aflare import aflare1, aflare_sparse, aflare1_support, aflare1_ed
+from flarefit import FitFlare
+from rolling import RollingStd
 import detrend
-from gatspy.periodic import LombScargleFast
+import runlength
+import intervals
+import emulator
+import lcstore
+import tarlc
+import fitsread
+import textread
+from periodogram import LSGrid, LSPower
 import warnings
-import matplotlib.pyplot as plt
-from pandas import rolling_std
-from scipy import stats
-from scipy.optimize import curve_fit
-from scipy.signal import wiener
-from scipy import signal
-from astropy.io import fits
-import matplotlib
-matplotlib.rcParams.update({'font.size':18})
-matplotlib.rcParams.update({'font.family':'serif'})
+import zlib
+import multiprocessing
+# from rayleigh import RayleighPowerSpectrum
 
+# matplotlib, astropy, pandas, scipy.stats/signal and MySQLdb are slow to
+# import (or not installed everywhere), so they are imported inside the
+# functions that use them, and headless runs never load the plotting.
+_plt = None
 
-# from rayleigh import RayleighPowerSpectrum
-try:
-    import MySQLdb
-    haz_mysql = True
-except ImportError:
-    haz_mysql = False
+
+def _Pyplot():
+    '''
+    matplotlib.pyplot, imported (and the plot style set) on first use
+    '''
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.rcParams.update({'font.size':18})
+        matplotlib.rcParams.update({'font.family':'serif'})
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
 
 
 def chisq(data, error, model):
@@ -79,6 +92,8 @@ def GetLCdb(objectid, type='', readfile=False,
             data = np.loadtxt(str(objectid) + exten)
             isok = 101
 
+    if isok < 1:
+        import MySQLdb
 
     while isok<1:
         # this holds the keys to the db... don't put on github!
@@ -133,45 +148,87 @@ def GetLCdb(objectid, type='', readfile=False,
     return data
 
 
-def GetLCfits(file):
+def _GetLCbintable(file, fluxcol, errcol):
     '''
+    Read a Kepler or K2 light curve FITS table, with the flux from the
+    columns fluxcol & errcol. Only the columns used are decoded, and only
+    the rows with finite flux are kept.
 
     Parameters
     ----------
-    file : str
+    file : str or file object
+        the FITS file, or a member of a tarball as "archive.tgz::member"
+        (see tarlc.py)
+    fluxcol, errcol : str
+        the flux and flux error column names
 
     Returns
     -------
     qtr, time, sap_quality, exptime, flux_raw, error
     '''
+    if isinstance(file, str) and (file.find('::') > -1):
+        file = tarlc.OpenMember(file)
 
-    hdu = fits.open(file)
-    data_rec = hdu[1].data
-
-    time = data_rec['TIME']
-    flux_raw = data_rec['SAP_FLUX']
-    error = data_rec['SAP_FLUX_ERR']
-    sap_quality = data_rec['SAP_QUALITY']
-
-    isrl = np.isfinite(flux_raw)
+    # only the rows with finite flux
+    time, flux_raw, error, sap_quality = fitsread.ReadBintable(file,
+                                             ['TIME', fluxcol, errcol, 'SAP_QUALITY'],
+                                             finite=[fluxcol])
 
-    qtr = np.zeros_like(time[isrl])
+    qtr = np.zeros_like(time)
 
     dt = np.nanmedian(time[1:] - time[0:-1])
     if (dt < 0.01):
         dtime = 54.2 / 60. / 60. / 24.
     else:
         dtime = 30 * 54.2 / 60. / 60. / 24.
-    exptime = np.ones_like(time[isrl]) * dtime
+    exptime = np.ones_like(time) * dtime
 
-    return qtr, time[isrl], sap_quality[isrl], exptime, flux_raw[isrl], error[isrl]
+    return qtr, time, sap_quality, exptime, flux_raw, error
+
+
+def GetLCfits(file):
+    '''
+    Read a Kepler light curve FITS file (SAP flux), see _GetLCbintable
+
+    Parameters
+    ----------
+    file : str or file object
+        the FITS file, or a member of a tarball as "archive.tgz::member"
+        (see tarlc.py)
+
+    Returns
+    -------
+    qtr, time, sap_quality, exptime, flux_raw, error
+    '''
+    return _GetLCbintable(file, 'SAP_FLUX', 'SAP_FLUX_ERR')
+
+
+def GetLCk2fits(file):
+    '''
+    Read a K2 light curve straight from the MAST ktwo*_llc.fits or
+    ktwo*_slc.fits file, see _GetLCbintable.
+
+    Uses the PDCSAP flux, as GetLCk2 does with the ascii-dumps (columns
+    7,8): for K2 the SAP flux is dominated by the roll systematics.
+
+    Parameters
+    ----------
+    file : str or file object
+        the FITS file, or a member of a tarball as "archive.tgz::member"
+
+    Returns
+    -------
+    qtr, time, sap_quality, exptime, flux_raw, error
+    '''
+    return _GetLCbintable(file, 'PDCSAP_FLUX', 'PDCSAP_FLUX_ERR')
 
 
 def GetLCk2(file):
     '''
     Read K2 data in.
 
-    Currently supporting the ascii-dumps of MAST .fits files
+    Currently supporting the ascii-dumps of MAST .fits files. To read the
+    .fits files themselves use GetLCk2fits (dbmode='k2fits')
 
     Parameters
     ----------
@@ -182,7 +239,7 @@ def GetLCk2(file):
     qtr, time, sap_quality, exptime, flux_raw, error
     '''
 
-    time, flux_raw, error, sap_quality = np.loadtxt(file, unpack=True, usecols=(0,7,8,9), skiprows=1)
+    time, flux_raw, error, sap_quality = textread.ReadText(file, usecols=(0,7,8,9), skiprows=1)
 
     isrl = np.isfinite(flux_raw)
 
@@ -204,7 +261,7 @@ def GetLCvdb(file, win_size=3):
 
     also generates errors via median short term scatter
     '''
-    time, flux_raw = np.loadtxt(file, unpack=True, usecols=(0,1), skiprows=1, delimiter=',', comments=('#','*'))
+    time, flux_raw = textread.ReadText(file, usecols=(0,1), skiprows=1, delimiter=',', comments=('#','*'))
     isrl = np.isfinite(flux_raw)
     qtr = np.zeros_like(time[isrl])
     qual = np.zeros_like(time[isrl])
@@ -216,7 +273,7 @@ def GetLCvdb(file, win_size=3):
         dtime = 30 * 54.2 / 60. / 60. / 24.
     exptime = np.ones_like(time[isrl]) * dtime
 
-    error = np.ones_like(time[isrl]) * np.nanmedian(rolling_std(flux_raw[isrl], win_size, center=True))
+    error = np.ones_like(time[isrl]) * np.nanmedian(RollingStd(flux_raw[isrl], win_size, center=True))
 
     return qtr, time[isrl], qual, exptime, flux_raw[isrl], error
 
@@ -227,29 +284,24 @@ def GetLCeverest(file, win_size=3):
 
     also generates errors via median short term scatter
     '''
+    # only the rows with finite flux
+    time, flux_raw = fitsread.ReadBintable(file, ['TIME', 'FLUX'], finite=['FLUX'])
 
-    hdu = fits.open(file)
-    data_rec = hdu[1].data
-
-    time = np.array(data_rec['TIME'])
-    flux_raw = np.array(data_rec['FLUX'])
-    isrl = np.isfinite(flux_raw)
-
-    qtr = np.zeros_like(time[isrl])
+    qtr = np.zeros_like(time)
 
     dt = np.nanmedian(time[1:] - time[0:-1])
     if (dt < 0.01):
         dtime = 54.2 / 60. / 60. / 24.
     else:
         dtime = 30 * 54.2 / 60. / 60. / 24.
-    exptime = np.ones_like(time[isrl]) * dtime
+    exptime = np.ones_like(time) * dtime
 
     # qual = data_rec['OUTLIER']
     qual = np.zeros_like(flux_raw) # keep the outliers... for now
 
-    error = np.ones_like(time[isrl]) * np.nanmedian(rolling_std(flux_raw[isrl], win_size, center=True))
+    error = np.ones_like(time) * np.nanmedian(RollingStd(flux_raw, win_size, center=True))
 
-    return qtr, time[isrl], qual[isrl], exptime, flux_raw[isrl], error
+    return qtr, time, qual, exptime, flux_raw, error
 
 
 def GetLCtxt(file, skiprows=1):
@@ -269,7 +321,7 @@ def GetLCtxt(file, skiprows=1):
 
     '''
 
-    time, flux_raw, error = np.loadtxt(file, unpack=True, usecols=(0,1,2), skiprows=skiprows)
+    time, flux_raw, error = textread.ReadText(file, usecols=(0,1,2), skiprows=skiprows)
 
     isrl = np.isfinite(flux_raw)
 
@@ -371,8 +423,7 @@ def DetectCandidate(time, flux, error, flags, model,
         cand1 = np.delete(cand1, x2)
 
     # find start and stop index, combine neighboring candidates in to same events
-    cstart = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
-    cstop = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
+    cstart, cstop = runlength.GroupIndex(cand1, minsep=minsep)
 
     # for now just return index of candidates
     if returnall is True:
@@ -436,7 +487,7 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
     else:
         # take the average of the rolling stddev in the window.
         # better for windows w/ significant starspots being removed
-        sig_i = np.nanmedian(rolling_std(flux, std_window, center=True))
+        sig_i = np.nanmedian(RollingStd(flux, std_window, center=True))
 
     if debug is True:
         print("DEBUG: sig_i = " + str(sig_i))
@@ -457,31 +508,22 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
     cindx = np.zeros_like(flux)
     cindx[ctmp] = 1
 
-    # Need to find cumulative number of points that pass "ctmp"
-    # Count in reverse!
-    ConM = np.zeros_like(flux)
-    # this requires a full pass thru the data -> bottleneck
-    for k in range(2, len(flux)):
-        ConM[-k] = cindx[-k] * (ConM[-(k-1)] + cindx[-k])
+    # Need to find runs of consecutive points that pass "ctmp".
+    # This used to be a reverse cumulative count (ConM) that never reached
+    # the first or last point, so keep those two edges out of the runs
+    cindx[0] = 0
+    cindx[-1] = 0
+    istart_i, istop_i, nrun = runlength.RunLength(cindx)
 
-    # these only defined between dl[i] and dr[i]
-    # find flare start where values in ConM switch from 0 to >=N3
-    istart_i = np.where((ConM[1:] >= N3) &
-                        (ConM[0:-1] - ConM[1:] < 0))[0] + 1
-
-    # use the value of ConM to determine how many points away stop is
-    istop_i = istart_i + (ConM[istart_i] - 1)
-
-    istart_i = np.array(istart_i, dtype='int')
-    istop_i = np.array(istop_i, dtype='int')
+    # find flare start where runs are at least N3 points long
+    keep = np.where((nrun >= N3))
+    istart_i = np.array(istart_i[keep], dtype='int')
+    istop_i = np.array(istop_i[keep], dtype='int')
 
     if returnbinary is False:
         return istart_i, istop_i
     else:
-        bin_out = np.zeros_like(flux, dtype='int')
-        for k in range(len(istart_i)):
-            bin_out[istart_i[k]:istop_i[k]+1] = 1
-        return bin_out
+        return runlength.RunMask(istart_i, istop_i, len(flux))
 
 
 def FlagCuts(flags, bad_flags = (16, 128, 2048), returngood=True):
@@ -529,8 +571,15 @@ def EquivDur(time, flux):
     return p
 
 
+# the parameter names for later reference
+_FlareStatsHeader = 't_start, t_stop, t_peak, amplitude, FWHM, duration, '+\
+                    't_peak_aflare1, t_FWHM_aflare1, amplitude_aflare1, '+\
+                    'flare_chisq, KS_d_model, KS_p_model, KS_d_cont, KS_p_cont, Equiv_Dur'
+
+
 def FlareStats(time, flux, error, model, istart=-1, istop=-1,
-               c1=(-1,-1), c2=(-1,-1), cpoly=2, ReturnHeader=False):
+               c1=(-1,-1), c2=(-1,-1), cpoly=2, ReturnHeader=False,
+               maxfev=200, maxtime=None):
     '''
     Compute properties of a flare event. Assumes flux is in relative flux units,
     i.e. rel_flux = (flux - median) / median
@@ -548,9 +597,18 @@ def FlareStats(time, flux, error, model, istart=-1, istop=-1,
     istop : int, optional
         The index in the input arrays (time,flux,error,model) that the
         flare ends at. If not used, defaults to the last data point.
+    maxfev : int, optional
+        Max number of model evaluations for the aflare1 fit, see
+        flarefit.FitFlare (Default is 200)
+    maxtime : float, optional
+        Max wall time in seconds for the aflare1 fit. Makes the results
+        depend on the machine's load (Default is None, no limit)
 
     '''
 
+    if ReturnHeader is True:
+        return _FlareStatsHeader
+
     # if FLARE indicies are not stated by user, use start/stop of data
     if (istart < 0):
         istart = 0
@@ -616,21 +674,15 @@ def FlareStats(time, flux, error, model, istart=-1, istop=-1,
     # print(pguess) # % ;
     # print(len(flaretime)) # % ;
 
-    try:
-        popt1, pcov = curve_fit(aflare1, flaretime, (flareflux-contline) / medflux, p0=pguess)
-    except ValueError:
-        # tried to fit bad data, so just fill in with NaN's
-        # shouldn't happen often
-        popt1 = np.array([np.nan, np.nan, np.nan])
-    except RuntimeError:
-        # could not converge on a fit with aflare
-        # fill with bad flag values
-        popt1 = np.array([-99., -99., -99.])
+    # NaN's if it tried to fit bad data, -99's if could not converge
+    popt1 = FitFlare(flaretime, (flareflux-contline) / medflux, pguess,
+                     maxfev=maxfev, maxtime=maxtime)
 
     # flare_chisq = total( flareflux - modelflux)**2.  / total(error)**2
     flare_chisq = chisq(flareflux, flareerror, modelflux)
 
     # measure KS stats of flare versus model
+    from scipy import stats
     ks_d, ks_p = stats.ks_2samp(flareflux, modelflux)
 
     # measure KS stats of flare versus continuum regions
@@ -647,15 +699,230 @@ def FlareStats(time, flux, error, model, istart=-1, istop=-1,
     params = np.array((tstart, tstop, tpeak, ampl, fwhm, dur0,
                        popt1[0], popt1[1], popt1[2],
                        flare_chisq, ks_d, ks_p, ks_dc, ks_pc, ed), dtype='float')
-    # the parameter names for later reference
-    header = 't_start, t_stop, t_peak, amplitude, FWHM, duration, '+\
-             't_peak_aflare1, t_FWHM_aflare1, amplitude_aflare1, '+\
-             'flare_chisq, KS_d_model, KS_p_model, KS_d_cont, KS_p_cont, Equiv_Dur'
 
-    if ReturnHeader is True:
-        return header
-    else:
-        return params
+    return params
+
+
+def FlareStatsBatch(time, flux, error, model, istart, istop,
+                    cpoly=2, ed68=None, ed90=None, maxfev=200, maxtime=None):
+    '''
+    Compute properties of ALL flare events in a light curve at once.
+    Same measurements as FlareStats, but the continuum windows are found
+    with searchsorted, and the continuum fits, amplitudes, FWHM, chisq and
+    equivalent durations are done for every flare together in array form.
+    Only the aflare1 model fit (FitFlare) and KS tests are still done
+    flare-by-flare.
+
+    Assumes time is sorted, and flux is in relative flux units.
+
+    Parameters
+    ----------
+    time : 1d numpy array
+    flux : 1d numpy array
+    error : 1d numpy array
+    model : 1d numpy array
+        These 4 arrays must have the same number of elements
+    istart : int array
+        The index that each flare starts at
+    istop : int array
+        The index that each flare ends at
+    cpoly : int, optional
+        The order of polynomial fit to the continuum (Default is 2)
+    ed68 : array, optional
+        The ED68i value to report for each flare (Default is NaN)
+    ed90 : array, optional
+        The ED90i value to report for each flare (Default is NaN)
+    maxfev : int, optional
+        Max number of model evaluations for each aflare1 fit, see
+        flarefit.FitFlare (Default is 200)
+    maxtime : float, optional
+        Max wall time in seconds for each aflare1 fit. Makes the results
+        depend on the machine's load (Default is None, no limit)
+
+    Returns
+    -------
+    numpy structured array, one row per flare, with columns named as in
+    the FlareStats header, plus ED68i and ED90i
+    '''
+    names = [h.strip() for h in _FlareStatsHeader.split(',')] + ['ED68i', 'ED90i']
+    nfl = len(istart)
+    out = np.zeros(nfl, dtype=[(nm, 'float') for nm in names])
+    if nfl == 0:
+        return out
+
+    if ed68 is None:
+        ed68 = np.zeros(nfl) + np.nan
+    if ed90 is None:
+        ed90 = np.zeros(nfl) + np.nan
+
+    n = len(time)
+    istart = np.array(istart, dtype='int')
+    istop = np.array(istop, dtype='int')
+
+    # can't have flare start/stop at same point
+    x = np.where((istart == istop))
+    istop[x] = istop[x] + 1
+    istart[x] = istart[x] - 1
+
+    # need to have flare at least 3 datapoints long
+    x = np.where((istop - istart < 2))
+    istop[x] = istop[x] + 1
+
+    # keep the flares inside the data
+    istart = np.clip(istart, 0, n - 1)
+    istop = np.clip(istop, 0, n - 1)
+
+    tstart = time[istart]
+    tstop = time[istop]
+    dur0 = tstop - tstart
+
+    # continuum regions around each flare, same duration as the flare,
+    # but spaced by half a duration on either side
+    c1a = np.searchsorted(time, tstart - dur0, side='left')
+    c1b = np.searchsorted(time, tstart - dur0/2., side='right')
+    c2a = np.searchsorted(time, tstop + dur0/2., side='left')
+    c2b = np.searchsorted(time, tstop + dur0, side='right')
+
+    # if NO continuum regions are found, then just use 1st/last point of flare
+    nocont = ((np.maximum(c1b - c1a, 0) + np.maximum(c2b - c2a, 0)) == 0)
+    ci1, cs1 = runlength.Ranges(c1a, c1b)
+    ci2, cs2 = runlength.Ranges(c2a, c2b)
+    noc = np.where(nocont)[0]
+    contindx = np.concatenate((ci1, ci2, istart[noc], istop[noc]))
+    contseg = np.concatenate((cs1, cs2, noc, noc))
+
+    # keep each flare's continuum points together
+    csort = np.argsort(contseg, kind='mergesort')
+    contindx = contindx[csort]
+    contseg = contseg[csort]
+    ncont = np.bincount(contseg, minlength=nfl)
+    coffs = np.append(0, np.cumsum(ncont)[:-1])
+
+    # poly fit to the cont. regions, in time relative to each flare
+    # start & in units of its duration, for all flares at once
+    nc = cpoly + 1
+    uc = (time[contindx] - tstart[contseg]) / dur0[contseg]
+    fc = flux[contindx]
+
+    umom = np.zeros((2 * nc - 1, nfl))
+    fmom = np.zeros((nc, nfl))
+    uk = np.ones_like(uc)
+    for k in range(2 * nc - 1):
+        umom[k] = np.bincount(contseg, weights=uk, minlength=nfl)
+        if k < nc:
+            fmom[k] = np.bincount(contseg, weights=uk * fc, minlength=nfl)
+        uk = uk * uc
+
+    A = np.zeros((nfl, nc, nc))
+    for r in range(nc):
+        for c in range(nc):
+            A[:, r, c] = umom[r + c]
+    B = fmom.T.copy()
+
+    # with no continuum points, the fit is only a line
+    for k in range(2, nc):
+        A[noc, k, :] = 0.
+        A[noc, :, k] = 0.
+        A[noc, k, k] = 1.
+        B[noc, k] = 0.
+
+    contfit = np.einsum('ijk,ik->ij', np.linalg.pinv(A), B)
+
+    def _polyval(fit, u):
+        val = np.zeros_like(u)
+        for k in range(nc - 1, -1, -1):
+            val = val * u + fit[:, k]
+        return val
+
+    # the flare points, for all flares
+    findx, fseg = runlength.Ranges(istart, istop + 1)
+    flaretime = time[findx]
+    flareflux = flux[findx]
+    contline = _polyval(contfit[fseg], (flaretime - tstart[fseg]) / dur0[fseg])
+    fresid = flareflux - contline
+    cresid = fc - _polyval(contfit[contseg], uc)
+
+    offs = np.append(0, np.cumsum(istop - istart + 1)[:-1])
+
+    # fewer continuum points than polynomial terms happens often for short
+    # flares. Use the polyfit least-squares answer for these few, to match
+    # FlareStats exactly
+    corder = np.zeros(nfl, dtype='int') + cpoly
+    corder[noc] = 1
+    for i in np.where((ncont < corder + 1))[0]:
+        ci = contindx[coffs[i]:coffs[i] + ncont[i]]
+        fi = findx[offs[i]:offs[i] + istop[i] - istart[i] + 1]
+        cfit_i = np.polyfit(time[ci], flux[ci], corder[i])
+        fresid[offs[i]:offs[i] + len(fi)] = flux[fi] - np.polyval(cfit_i, time[fi])
+        cresid[coffs[i]:coffs[i] + ncont[i]] = flux[ci] - np.polyval(cfit_i, time[ci])
+
+    medflux = np.nanmedian(model)
+
+    # measure flare amplitude
+    fmax = np.maximum.reduceat(fresid, offs)
+    ampl = fmax / medflux
+
+    # the 1st point in each flare at the max
+    imax = np.lexsort((-fresid, fseg))[offs]
+    tpeak = flaretime[imax]
+
+    # FWHM from the points below half max
+    p05 = (fresid <= ampl[fseg] * 0.5)
+    tlo = np.minimum.reduceat(np.where(p05, flaretime, np.inf), offs)
+    thi = np.maximum.reduceat(np.where(p05, flaretime, -np.inf), offs)
+    fwhm = thi - tlo
+    x = np.where((np.bincount(fseg, weights=p05, minlength=nfl) == 0))
+    fwhm[x] = dur0[x] * 0.25
+
+    # normalized chi square of the flare vs the model
+    chi2 = ((flareflux - model[findx]) / error[findx])**2.0
+    flare_chisq = np.bincount(fseg, weights=chi2, minlength=nfl) / (istop - istart + 1)
+
+    # measure flare ED, trapezoid rule within each flare
+    yrel = fresid / medflux
+    xsec = flaretime * 60.0 * 60.0 * 24.0
+    trap = np.append(0.5 * (yrel[1:] + yrel[:-1]) * (xsec[1:] - xsec[:-1]), 0)
+    trap[np.cumsum(istop - istart + 1) - 1] = 0 # don't span between flares
+    ed = np.bincount(fseg, weights=trap, minlength=nfl)
+
+    # split the flares back up for the fits & KS tests
+    fsplit = offs[1:]
+    csplit = coffs[1:]
+
+    fl_time = np.split(flaretime, fsplit)
+    fl_flux = np.split(flareflux, fsplit)
+    fl_model = np.split(model[findx], fsplit)
+    fl_resid = np.split(fresid, fsplit)
+    ct_resid = np.split(cresid, csplit)
+
+    from scipy import stats
+
+    for i in range(nfl):
+        # fit flare with single aflare model
+        pguess = (tpeak[i], fwhm[i], ampl[i])
+        popt1 = FitFlare(fl_time[i], fl_resid[i] / medflux, pguess,
+                         maxfev=maxfev, maxtime=maxtime)
+
+        out['t_peak_aflare1'][i] = popt1[0]
+        out['t_FWHM_aflare1'][i] = popt1[1]
+        out['amplitude_aflare1'][i] = popt1[2]
+
+        # measure KS stats of flare versus model, and versus continuum regions
+        out['KS_d_model'][i], out['KS_p_model'][i] = stats.ks_2samp(fl_flux[i], fl_model[i])
+        out['KS_d_cont'][i], out['KS_p_cont'][i] = stats.ks_2samp(fl_resid[i], ct_resid[i])
+
+    out['t_start'] = tstart
+    out['t_stop'] = tstop
+    out['t_peak'] = tpeak
+    out['amplitude'] = ampl
+    out['FWHM'] = fwhm
+    out['duration'] = dur0
+    out['flare_chisq'] = flare_chisq
+    out['Equiv_Dur'] = ed
+    out['ED68i'] = ed68
+    out['ED90i'] = ed90
+
+    return out
 
 
 def MeasureS2N(flux, error, model, istart=-1, istop=-1):
@@ -674,7 +941,7 @@ def MeasureS2N(flux, error, model, istart=-1, istop=-1):
     return s2n
 
 
-def FlarePer(time, minper=0.1, maxper=30.0, nper=20000):
+def FlarePer(time, minper=0.1, maxper=30.0, nper=20000, grid=None):
     '''
     Look for periodicity in the flare occurrence times. Could be due to:
     a) mis-identified periodic things (e.g. heartbeat stars)
@@ -683,24 +950,21 @@ def FlarePer(time, minper=0.1, maxper=30.0, nper=20000):
     d) bugs in code
     e) aliens
 
+    grid : dict, optional
+        The output of periodogram.LSGrid for these times, if already made
     '''
 
     # use energy = 1 for flare times.
     # This will create something like the window function
     energy = np.ones_like(time)
 
-    # Use Jake Vanderplas faster version!
-    pgram = LombScargleFast(fit_offset=False)
-    pgram.optimizer.set(period_range=(minper,maxper))
+    # same fast algorithm as Jake Vanderplas' gatspy version
+    if grid is None:
+        grid = LSGrid(time, minper=minper, maxper=maxper, nper=nper)
 
-    pgram = pgram.fit(time, energy - np.nanmedian(energy))
+    pwr = LSPower(grid, energy - np.nanmedian(energy))
 
-    df = (1./minper - 1./maxper) / nper
-    f0 = 1./maxper
-    pwr = pgram.score_frequency_grid(f0, df, nper)
-
-    freq = f0 + df * np.arange(nper)
-    per = 1./freq
+    per = grid['per']
 
     pk = per[np.argmax(pwr)] # peak period
     pp = np.max(pwr) # peak period power
@@ -718,8 +982,6 @@ def MultiFind(time, flux, error, flags, mode=3,
     '''
 
 
-    # the bad data points (search where bad < 1)
-    bad = FlagCuts(flags, returngood=False)
     flux_i = np.copy(flux)
 
     if (mode == 1):
@@ -729,16 +991,15 @@ def MultiFind(time, flux, error, flags, mode=3,
         flux_model3 = detrend.MultiBoxcar(time, flux, error, kernel=3.0)
 
         flux_model = (flux_model1 + flux_model2 + flux_model3) / 3.
-        flux_diff = flux - flux_model
 
     if (mode == 2):
         # first do a pass thru w/ largebox to get obvious flares
         box1 = detrend.MultiBoxcar(time, flux_i, error, kernel=2.0, numpass=2)
-        sin1 = detrend.FitSin(time, box1, error, maxnum=2, maxper=(max(time)-min(time)))
+        sin1 = detrend.FitSin(time, box1, error, maxnum=2, maxper=(max(time)-min(time)),
+                              linear=True)
 
         box2 = detrend.MultiBoxcar(time, flux_i - sin1, error, kernel=0.25)
         flux_model = (box2 + sin1)
-        flux_diff = flux - flux_model
 
 
     if (mode == 3):
@@ -747,27 +1008,60 @@ def MultiFind(time, flux, error, flags, mode=3,
 
         box1 = detrend.MultiBoxcar(time, flux, error, kernel=2.0, numpass=2)
         sin1 = detrend.FitSin(time, box1, error, maxnum=5, maxper=(max(time)-min(time)),
-                              per2=False, debug=debug)
+                              per2=False, linear=True, debug=debug)
         # sin1 = detrend.FitMedSin(time, box1, error)
         box3 = detrend.MultiBoxcar(time, flux - sin1, error, kernel=0.3)
 
-        dt = np.nanmedian(time[1:] - time[0:-1])
-
         exptime_m = (np.nanmax(time) - np.nanmin(time)) / len(time)
         # ksep used to = 0.07...
         flux_model = detrend.IRLSSpline(time, box3, error, numpass=20, debug=debug, ksep=exptime_m*10.) + sin1
 
+    # run final flare-find on DATA - MODEL
+    istart, istop = FindResid(time, flux, flux_model, error, flags,
+                              matched=(mode == 3), gapwindow=gapwindow,
+                              minsep=minsep, debug=debug)
+
+    return istart, istop, flux_model
+
+
+def FindResid(time, flux, flux_model, error, flags, matched=True,
+              gapwindow=0.1, minsep=3, debug=False):
+    '''
+    The final step of MultiFind: search DATA - MODEL for flare candidates,
+    and combine them in to events. Split out so the same search can be
+    re-run with an existing model (e.g. by FakeFlares).
+
+    Parameters
+    ----------
+    time, flux, flux_model, error, flags : 1d numpy arrays
+    matched : bool, optional
+        If True, correlate the residuals with a short aflare1 template
+        before the search, as MultiFind mode 3 does. (Default is True)
+    gapwindow : float, optional
+        Ignore candidates within this many days of either end
+    minsep : int, optional
+        The number of datapoints required between individual events
+
+    Returns
+    -------
+    istart, istop
+    '''
+    # the bad data points (search where bad < 1)
+    bad = FlagCuts(flags, returngood=False)
+
+    flux_diff = flux - flux_model
+
+    if matched is True:
+        from scipy import signal
+        dt = np.nanmedian(time[1:] - time[0:-1])
         signalfwhm = dt * 2
         ftime = np.arange(0, 2, dt)
         modelfilter = aflare1(ftime, 1, signalfwhm, 1)
-        flux_diff = signal.correlate(flux - flux_model, modelfilter, mode='same')
+        flux_diff = signal.correlate(flux_diff, modelfilter, mode='same')
 
-
-    # run final flare-find on DATA - MODEL
     isflare = FINDflare(flux_diff, error, N1=3, N3=2,
                         returnbinary=True, avg_std=True)
 
-
     # now pick out final flare candidate points from above
     cand1 = np.where((bad < 1) & (isflare > 0))[0]
 
@@ -776,14 +1070,8 @@ def MultiFind(time, flux, error, flags, mode=3,
     cand1 = np.delete(cand1, x1)
     cand1 = np.delete(cand1, x2)
 
-    # print(len(cand1))
-    if (len(cand1) < 1):
-        istart = np.array([])
-        istop = np.array([])
-    else:
-        # find start and stop index, combine neighboring candidates in to same events
-        istart = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
-        istop = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
+    # find start and stop index, combine neighboring candidates in to same events
+    istart, istop = runlength.GroupIndex(cand1, minsep=minsep)
 
     # if start & stop times are the same, add 1 more datum on the end
     to1 = np.where((istart-istop == 0))
@@ -791,14 +1079,14 @@ def MultiFind(time, flux, error, flags, mode=3,
         istop[to1] += 1
 
     if debug is True:
+        plt = _Pyplot()
         plt.figure()
         plt.scatter(time, flux, alpha=0.5)
         plt.plot(time,flux_model, c='black')
         plt.scatter(time[cand1], flux[cand1], c='red')
         plt.show()
 
-    # print(istart, len(istart))
-    return istart, istop, flux_model
+    return istart, istop
 
 
 # sketching some baby step ideas w/a matched filter
@@ -819,61 +1107,214 @@ def MatchedFilterFind(time, flux, signalfwhm=0.01):
 '''
 
 
-def FakeFlares(time, flux, error, flags, tstart, tstop,
-               nfake=100, npass=1, ampl=(0.1,100), dur=(0.5,60),
-               outfile='', savefile=False, gapwindow=0.1,
-               verboseout=False, display=False, debug=False):
+def FakeCompleteness(ed_fake, rec_fake, nbins=20):
     '''
-    Create nfake number of events, inject them in to data
-    Use grid of amplitudes and durations, keep ampl in relative flux units
-    Keep track of energy in Equiv Dur
+    The fraction of injected flares that were recovered, in bins of
+    equivalent duration
 
-    duration defined in minutes
-    amplitude defined multiples of the median error
+    Returns
+    -------
+    ed_bin_center, rec_bin
+    '''
+    # the number of events per bin recovered
+    rec_bin_N, ed_bin = np.histogram(ed_fake, weights=rec_fake, bins=nbins)
+    # the number of events per bin
+    rec_bin_D, _ = np.histogram(ed_fake, bins=nbins)
+
+    ed_bin_center = (ed_bin[1:] + ed_bin[:-1])/2.
 
-    still need to implement npass, to re-do whole thing and average results
+    rec_bin = rec_bin_N / rec_bin_D
+
+    return ed_bin_center, rec_bin
+
+
+def FakeEDLimits(ed_bin_center, rec_bin):
     '''
+    Smooth the completeness curve from FakeCompleteness, and find the
+    smallest ED where 68% and 90% of fake flares are recovered.
+    -99 if the curve never gets there.
 
-    # QUESTION: how many fake flares can I inject at once?
-    # i.e. can I get away with doing fewer re-runs with more flares injected?
+    Returns
+    -------
+    ed68, ed90
+    '''
+    from scipy.signal import wiener
 
-    std = np.nanmedian(error)
+    rl = np.isfinite(rec_bin)
+    frac_rec_sm = wiener(rec_bin[rl], 3)
 
-    ampl_fake = (np.random.random(nfake) * (ampl[1] - ampl[0]) + ampl[0]) * std
-    dur_fake =  (np.random.random(nfake) * (dur[1] - dur[0]) + dur[0]) / 60. / 24.
+    # use this completeness curve to estimate 68% complete
+    x68 = np.where((frac_rec_sm >= 0.68))
+    if len(x68[0])>0:
+        ed68_i = min(ed_bin_center[rl][x68])
+    else:
+        ed68_i = -99
 
-    t0_fake = np.zeros(nfake, dtype='float')
-    s2n_fake = np.zeros(nfake, dtype='float')
-    ed_fake = np.zeros(nfake, dtype='float')
+    x90 = np.where((frac_rec_sm >= 0.90))
+    if len(x90[0])>0:
+        ed90_i = min(ed_bin_center[rl][x90])
+    else:
+        ed90_i = -99
 
-    new_flux = np.array(flux, copy=True)
+    return ed68_i, ed90_i
 
-    for k in range(nfake):
-        # generate random peak time, avoid known flares
-        isok = False
-        while isok is False:
-            # choose a random peak time
-            t0 =  np.random.choice(time)
 
-            if len(tstart)>0:
-                x = np.where((t0 >= tstart) & (t0 <= tstop))
-                if (len(x[0]) < 1):
-                    isok = True
-            else:
-                isok = True
+def _FakeRecovered(t0_fake, tstart, tstop):
+    '''
+    Which injected flares (by peak time) overlap a recovered event
+    '''
+    rec = intervals.InIntervals(t0_fake, intervals.IntervalIndex(tstart, tstop))
+    return np.array(rec, dtype='float')
+
+
+def LocalModel(time, flux, error, model, tstart, tstop, pad=0.1):
+    '''
+    Update an existing light curve model only near a set of events, e.g.
+    the fake flares injected by FakeFlares, instead of re-fitting the
+    whole light curve.
+
+    Within each window (event +/- pad days, overlapping windows merged),
+    the residuals from the model are smoothed the same way as the last
+    steps of MultiFind (mode 3): a MultiBoxcar, then the iterative
+    IRLSSpline. The result is added to the model there.
+
+    Parameters
+    ----------
+    time, flux, error, model : 1d numpy arrays
+    tstart, tstop : arrays
+        the time range of each event
+    pad : float, optional
+        Days to extend each window on either side (Default is 0.1)
+
+    Returns
+    -------
+    the updated model
+    '''
+    flux_model = np.array(model, dtype='float', copy=True)
+
+    exptime_m = (np.nanmax(time) - np.nanmin(time)) / len(time)
+
+    w0 = np.searchsorted(time, np.asarray(tstart) - pad)
+    w1 = np.searchsorted(time, np.asarray(tstop) + pad, side='right')
+    w0, w1 = runlength.MergeRanges(w0, w1)
+
+    for a, b in zip(w0, w1):
+        indx = np.arange(a, b)
+        ok = np.isfinite(time[indx]) & np.isfinite(flux[indx]) & \
+             np.isfinite(error[indx]) & np.isfinite(model[indx])
+        indx = indx[ok]
+        if len(indx) < 10:
+            continue
+
+        resid = flux[indx] - model[indx]
+        try:
+            box = detrend.MultiBoxcar(time[indx], resid, error[indx], kernel=0.3)
+            fix = detrend.IRLSSpline(time[indx], box, error[indx], numpass=20,
+                                     ksep=exptime_m*10.)
+        except (ValueError, np.linalg.LinAlgError):
+            # too few points for the spline knots, keep the old model here
+            continue
 
-        t0_fake[k] = t0
+        flux_model[indx] = flux_model[indx] + fix
 
-        # generate the fake flare
-        fl_flux = aflare1(time, t0, dur_fake[k], ampl_fake[k])
+    return flux_model
 
-        # in_fl = np.where((time >= t0-dur_fake[k]) & (time <= t0 + 3.0*dur_fake[k]))
 
-        s2n_fake[k] = np.sqrt( np.sum((fl_flux**2.0) / (std**2.0)) )
-        ed_fake[k] = EquivDur(time, fl_flux)
+def FakeSeed(seedid, trial):
+    '''
+    A reproducible random seed for one fake flare trial, made from an ID
+    for the light curve segment, e.g. (KIC, segment number), and the
+    trial number. Does not depend on the python hash seed, or on which
+    process runs the trial.
+    '''
+    return zlib.crc32(repr((seedid, trial)).encode('utf-8')) & 0xffffffff
+
 
-        # inject flare in to light curve
-        new_flux = new_flux + fl_flux
+def _FakeInject(time, flux, tstart, tstop, ampl_fake, dur_fake, rng):
+    '''
+    Inject fake flares w/ the given amplitudes & durations (days) at random
+    peak times that avoid the known flares.
+
+    Returns
+    -------
+    new_flux, t0_fake, ed_fake
+    '''
+    nfake = len(ampl_fake)
+
+    # generate random peak times, avoid known flares
+    t0_fake = intervals.SampleOutside(time, intervals.IntervalIndex(tstart, tstop),
+                                      nfake, rng=rng)
+
+    # generate all the fake flares at once, each only within its own support
+    fl_indx, fl_id, fl_flux = aflare_sparse(time, t0_fake, dur_fake, ampl_fake)
+
+    # ED of each flare, trapezoid rule w/o spanning between flares
+    fl_sec = time[fl_indx] * 60.0 * 60.0 * 24.0
+    trap = np.append(0.5 * (fl_flux[1:] + fl_flux[:-1]) * (fl_sec[1:] - fl_sec[:-1]), 0)
+    trap[np.append(fl_id[1:] != fl_id[:-1], True)] = 0
+    ed_fake = np.bincount(fl_id, weights=trap, minlength=nfake)
+
+    # inject flares in to light curve
+    new_flux = flux + np.bincount(fl_indx, weights=fl_flux, minlength=len(time))
+
+    return new_flux, t0_fake, ed_fake
+
+
+def _FakeTrial(kw):
+    '''
+    One fake flare trial: inject, re-run the flare search, and see which
+    fake flares were recovered. Takes a single dict of arguments so it can
+    be sent to a multiprocessing Pool.
+
+    If kw['ampl_fake'] / kw['dur_fake'] are None, nfake amplitudes and
+    durations are drawn uniformly from the ampl & dur ranges. If
+    kw['edrange'] is set, only draws with EDs (seconds) in that range
+    are kept.
+
+    Returns
+    -------
+    ed_fake, rec_fake, rec_full (None unless validating)
+    '''
+    time = kw['time']
+    error = kw['error']
+    flags = kw['flags']
+    model = kw['model']
+    gapwindow = kw['gapwindow']
+    debug = kw['debug']
+
+    rng = np.random.RandomState(kw['seed'])
+
+    ampl_fake = kw['ampl_fake']
+    dur_fake = kw['dur_fake']
+    if ampl_fake is None:
+        ampl, dur, nfake = kw['ampl'], kw['dur'], kw['nfake']
+        ampl_fake = (rng.random_sample(nfake) * (ampl[1] - ampl[0]) + ampl[0]) * kw['std']
+        dur_fake =  (rng.random_sample(nfake) * (dur[1] - dur[0]) + dur[0]) / 60. / 24.
+
+        if kw.get('edrange') is not None:
+            # aim for the ED's near the completeness transition: keep
+            # drawing the same way, but only keep flares in the ED range.
+            # This way the mix of amplitudes & durations at a given ED,
+            # and so the completeness there, is not changed.
+            ampl_ok = np.array([])
+            dur_ok = np.array([])
+            for k in range(100):
+                a_k = (rng.random_sample(nfake * 4) * (ampl[1] - ampl[0]) + ampl[0]) * kw['std']
+                d_k = (rng.random_sample(nfake * 4) * (dur[1] - dur[0]) + dur[0]) / 60. / 24.
+                ed_k = aflare1_ed(d_k * 60. * 60. * 24., a_k)
+                ok = (ed_k >= kw['edrange'][0]) & (ed_k <= kw['edrange'][1])
+                ampl_ok = np.append(ampl_ok, a_k[ok])
+                dur_ok = np.append(dur_ok, d_k[ok])
+                if len(ampl_ok) >= nfake:
+                    break
+
+            # (if the range is hard to hit, fill in w/ the uniform draws)
+            nok = min(len(ampl_ok), nfake)
+            ampl_fake[:nok] = ampl_ok[:nok]
+            dur_fake[:nok] = dur_ok[:nok]
+
+    new_flux, t0_fake, ed_fake = _FakeInject(time, kw['flux'], kw['tstart'], kw['tstop'],
+                                             ampl_fake, dur_fake, rng)
 
     '''
     Re-run flare finding for data + fake flares
@@ -881,32 +1322,197 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
     '''
 
     # all the hard decision making should go here
-    istart, istop, flux_model = MultiFind(time, new_flux, error, flags, gapwindow=gapwindow, debug=debug)
+    if model is None:
+        istart, istop, flux_model = MultiFind(time, new_flux, error, flags, gapwindow=gapwindow, debug=debug)
+    else:
+        # only re-fit the model near each fake flare
+        flux_model = LocalModel(time, new_flux, error, model, t0_fake - dur_fake,
+                                t0_fake + aflare1_support() * dur_fake, pad=kw['localpad'])
+        istart, istop = FindResid(time, new_flux, flux_model, error, flags,
+                                  gapwindow=gapwindow, debug=debug)
+
+    # do any injected flares overlap recovered flares?
+    rec_fake = _FakeRecovered(t0_fake, time[istart], time[istop])
 
-    rec_fake = np.zeros(nfake)
+    rec_full = None
+    if (kw['validate'] is True) and (model is not None):
+        # compare to the full re-run of the flare search
+        istart_f, istop_f, _ = MultiFind(time, new_flux, error, flags, gapwindow=gapwindow, debug=debug)
+        rec_full = _FakeRecovered(t0_fake, time[istart_f], time[istop_f])
 
-    if len(istart)>0: # in case no flares are recovered, even after injection
-        for k in range(nfake): # go thru all recovered flares
-            # do any injected flares overlap recovered flares?
-            rec = np.where((t0_fake[k] >= time[istart]) &
-                           (t0_fake[k] <= time[istop]))
+    return ed_fake, rec_fake, rec_full
 
-            if (len(rec[0]) > 0):
-                rec_fake[k] = 1
+
+def _FakeRunTrials(kwlist, nproc=1):
+    '''
+    Run a list of _FakeTrial's, in parallel if nproc > 1, and return the
+    results in the same order as kwlist (so the output does not depend
+    on the number of processes)
+    '''
+    if (nproc > 1) and (len(kwlist) > 1):
+        pool = multiprocessing.Pool(processes=min(nproc, len(kwlist)))
+        try:
+            out = pool.map(_FakeTrial, kwlist, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        out = [_FakeTrial(kw) for kw in kwlist]
+    return out
+
+
+def FakeEDLimitsCI(ed_fake, rec_fake, nbins=20, nboot=100, rng=None):
+    '''
+    Bootstrap the ED68 & ED90 limits, by re-sampling the fake flares
+    (with replacement) and re-making the completeness curve each time.
+
+    Returns
+    -------
+    ed68_ci, ed90_ci : (16th, 84th) percentiles of each limit. If any
+        re-sample never reaches 68% (or 90%) completeness, that interval
+        is (-99, -99).
+    '''
+    if rng is None:
+        rng = np.random
+
+    nf = len(ed_fake)
+    ed68_b = np.zeros(nboot)
+    ed90_b = np.zeros(nboot)
+    for b in range(nboot):
+        r = rng.randint(0, nf, nf)
+        ed68_b[b], ed90_b[b] = FakeEDLimits(*FakeCompleteness(ed_fake[r], rec_fake[r], nbins=nbins))
+
+    ci = []
+    for edb in (ed68_b, ed90_b):
+        if np.any((edb == -99)):
+            ci.append((-99, -99))
+        else:
+            ci.append(tuple(np.percentile(edb, [16, 84])))
+
+    return ci[0], ci[1]
+
+
+def FakeFlares(time, flux, error, flags, tstart, tstop,
+               nfake=100, npass=1, ampl=(0.1,100), dur=(0.5,60),
+               outfile='', savefile=False, gapwindow=0.1,
+               verboseout=False, display=False, debug=False,
+               model=None, localpad=0.1, validate=False,
+               seedid=None, nproc=1, adaptive=False, edtol=0.1,
+               maxfake=2000, nboot=100):
+    '''
+    Create nfake number of events, inject them in to data
+    Use grid of amplitudes and durations, keep ampl in relative flux units
+    Keep track of energy in Equiv Dur
+
+    duration defined in minutes
+    amplitude defined multiples of the median error
+
+    This is repeated for npass independent trials. The recovered fake
+    flares from all trials are put in to one set of ED bins, before the
+    completeness curve is smoothed and the ED68/ED90 limits are found.
+    Trials can be run in parallel with nproc > 1 processes.
+
+    Each trial has its own random seed, from FakeSeed(seedid, trial), so
+    given a seedid, e.g. (KIC, segment), the results are reproducible and
+    identical for any nproc. If seedid is None the trial seeds are drawn
+    from the global np.random state.
+
+    By default the whole MultiFind search is re-run on data + fake flares.
+    If the "model" from the real search is given (normalized the same way
+    as flux), it is re-used instead: the model is only updated in windows
+    around each fake flare (see LocalModel, "localpad" days on either
+    side), and then only the final search step (FindResid) is re-run.
+
+    With validate=True (and a model given), the full MultiFind is ALSO
+    run, and the ED68/ED90 limits from both are compared. If savefile is
+    set, the comparison is written to the outfile as a "#" comment line.
+
+    With adaptive=True, rounds of npass trials (of nfake flares each) are
+    run until the bootstrap 68% confidence intervals on both ED68 and ED90
+    are narrower than edtol times their values, or maxfake flares have
+    been injected. After the first (uniform) round, the new fake flares
+    are aimed at EDs around the current 68%-90% completeness transition.
+    The total number of injections used is written to the outfile.
+    '''
+
+    # QUESTION: how many fake flares can I inject at once?
+    # i.e. can I get away with doing fewer re-runs with more flares injected?
+
+    std = np.nanmedian(error)
 
     # nbins = int(nfake/10.)
     # if nbins < 10:
     #     nbins = 10
     nbins = 20
 
-    # the number of events per bin recovered
-    rec_bin_N, ed_bin = np.histogram(ed_fake, weights=rec_fake, bins=nbins)
-    # the number of events per bin
-    rec_bin_D, _ = np.histogram(ed_fake, bins=nbins)
+    if seedid is None:
+        bootrng = np.random.RandomState(np.random.randint(0, 2**31 - 1))
+    else:
+        bootrng = np.random.RandomState(FakeSeed(seedid, 'bootstrap'))
+
+    out = []
+    edrange = None
+    trial = 0
+    while True:
+        kwlist = []
+        for k in range(npass):
+            if seedid is None:
+                seed = np.random.randint(0, 2**31 - 1)
+            else:
+                seed = FakeSeed(seedid, trial)
+            trial = trial + 1
 
-    ed_bin_center = (ed_bin[1:] + ed_bin[:-1])/2.
+            kwlist.append({'time':time, 'flux':flux, 'error':error,
+                           'flags':flags, 'tstart':tstart, 'tstop':tstop, 'model':model,
+                           'std':std, 'nfake':nfake, 'ampl':ampl, 'dur':dur,
+                           'ampl_fake':None, 'dur_fake':None, 'edrange':edrange,
+                           'seed':seed, 'gapwindow':gapwindow, 'localpad':localpad,
+                           'validate':validate, 'debug':debug})
 
-    rec_bin = rec_bin_N / rec_bin_D
+        out = out + _FakeRunTrials(kwlist, nproc=nproc)
+
+        ed_fake = np.concatenate([o[0] for o in out])
+        rec_fake = np.concatenate([o[1] for o in out])
+        ntotal = len(ed_fake)
+
+        if (adaptive is False) or (ntotal >= maxfake):
+            break
+
+        # has the ED68 & ED90 estimate settled down?
+        ed68_ci, ed90_ci = FakeEDLimitsCI(ed_fake, rec_fake, nbins=nbins,
+                                          nboot=nboot, rng=bootrng)
+        if debug is True:
+            print('FakeFlares: ' + str(ntotal) + ' injected, ED68 CI = ' +
+                  str(ed68_ci) + ', ED90 CI = ' + str(ed90_ci))
+
+        if (ed68_ci[0] > 0) and (ed90_ci[0] > 0):
+            if ((ed68_ci[1] - ed68_ci[0]) <= edtol * np.mean(ed68_ci)) and \
+               ((ed90_ci[1] - ed90_ci[0]) <= edtol * np.mean(ed90_ci)):
+                break
+            # focus the next round on the completeness transition
+            edrange = (ed68_ci[0] / 2., ed90_ci[1] * 2.)
+        else:
+            edrange = None
+
+    ed_bin_center, rec_bin = FakeCompleteness(ed_fake, rec_fake, nbins=nbins)
+
+    if (validate is True) and (model is not None):
+        rec_full = np.concatenate([o[2] for o in out])
+
+        ed68_l, ed90_l = FakeEDLimits(ed_bin_center, rec_bin)
+        ed68_f, ed90_f = FakeEDLimits(*FakeCompleteness(ed_fake, rec_full, nbins=nbins))
+
+        valstring = '# validate local vs full: ED68 = ' + str(ed68_l) + ', ' + str(ed68_f) + \
+                    ', ED90 = ' + str(ed90_l) + ', ' + str(ed90_f) + \
+                    ', recovered = ' + str(int(np.sum(rec_fake))) + ', ' + \
+                    str(int(np.sum(rec_full))) + ', agree = ' + \
+                    str(int(np.sum(rec_fake == rec_full))) + '/' + str(ntotal) + '\n'
+        if debug is True:
+            print(valstring)
+        if savefile is True:
+            ff = open(outfile, 'a+')
+            ff.write(valstring)
+            ff.close()
 
     if savefile is True:
         # look to see if output folder exists
@@ -921,29 +1527,14 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
         rl = np.isfinite(rec_bin)
         w_in = rec_bin[rl]
 
+        from scipy.signal import wiener
         frac_rec_sm = wiener(w_in, 3)
 
-        # print('>')
-        # print('rl ', len(rl), rl)
-        # print('rec_bin ', len(rec_bin), rec_bin)
-        # print('w_in', np.size(w_in), w_in)
-        # print('frac_rec_sm', len(frac_rec_sm), frac_rec_sm)
-
-        # use this completeness curve to estimate 68% complete
-        x68 = np.where((frac_rec_sm >= 0.68))
-        if len(x68[0])>0:
-            ed68_i = min(ed_bin_center[rl][x68])
-        else:
-            ed68_i = -99
-
-        x90 = np.where((frac_rec_sm >= 0.90))
-        if len(x90[0])>0:
-            ed90_i = min(ed_bin_center[rl][x90])
-        else:
-            ed90_i = -99
+        # use this completeness curve to estimate 68% & 90% complete
+        ed68_i, ed90_i = FakeEDLimits(ed_bin_center, rec_bin)
 
         outstring = str(min(time)) + ', ' + str(max(time)) + ', ' + str(std) + \
-                    ', ' + str(nfake) + ', ' + str(ampl[0]) + ', ' + str(ampl[1]) + \
+                    ', ' + str(ntotal) + ', ' + str(ampl[0]) + ', ' + str(ampl[1]) + \
                     ', ' + str(dur[0]) + ', ' + str(dur[1]) + \
                     ', ' + str(ed68_i) + ', ' + str(ed90_i) + '\n'
 
@@ -971,30 +1562,163 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
     return ed_bin_center, rec_bin
 
 
+def _EmulateED(emu, time, error, exptime, maxsig=0.1, outfile=''):
+    '''
+    Ask the completeness emulator for the ED68 & ED90 limits of one
+    segment (error in relative flux units, exptime in days). If both
+    uncertainties are below maxsig (dex), write the usual .fake line
+    (w/ nfake = 0) and return the limits, otherwise return None.
+    '''
+    std = np.nanmedian(error)
+    ed68, ed90, sig68, sig90 = emulator.PredictED(emu, std, np.nanmax(time) - np.nanmin(time),
+                                                  np.nanmedian(exptime) * 60. * 24.)
+    if max(sig68[0], sig90[0]) >= maxsig:
+        return None
+
+    # same columns as FakeFlares, using its default ampl & dur ranges
+    outstring = str(min(time)) + ', ' + str(max(time)) + ', ' + str(std) + \
+                ', 0, 0.1, 100, 0.5, 60, ' + str(ed68[0]) + ', ' + str(ed90[0]) + '\n'
+    if len(outfile) > 0:
+        ff = open(outfile, 'a+')
+        ff.write(outstring)
+        ff.close()
+
+    return ed68[0], ed90[0]
+
+
 # objectid = '9726699'  # GJ 1243
-def RunLC(file='', objectid='', ftype='sap', lctype='',
-          display=False, readfile=False, debug=False, dofake=True,
-          dbmode='fits', gapwindow=0.1, maxgap=0.125, verbosefake=False, nfake=100):
+def _MakeOutdir(outdir):
+    if not os.path.isdir(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            pass
+    return
+
+
+def FileID(file, prefix='kplr'):
     '''
-    Main wrapper to obtain and process a light curve
+    The object ID (KIC or EPIC number) from a MAST light curve file name,
+    e.g. kplr000757076-2009166043257_llc.fits or ktwo201367065-c01_llc.fits.
+    Only the file name is used, so folders (or tarballs) in the path don't
+    matter.
+
+    Parameters
+    ----------
+    file : str
+    prefix : str, optional
+        'kplr' for Kepler, 'ktwo' for K2 (Default is 'kplr')
+
+    Returns
+    -------
+    objectid (str, without the leading 0's), and the file name
     '''
+    name = os.path.basename(file.split('::')[-1])
+    i0 = name.find(prefix)
+    if i0 == -1:
+        raise ValueError('FileID: no ' + prefix + ' in the file name ' + name)
+    i0 = i0 + len(prefix)
+    i1 = i0
+    while (i1 < len(name)) and name[i1].isdigit():
+        i1 = i1 + 1
+    if i1 == i0:
+        raise ValueError('FileID: no object ID after ' + prefix + ' in ' + name)
+    return str(int(name[i0:i1])), name
+
+
+def LCOutfile(file='', objectid='', dbmode='fits', makedir=True):
+    '''
+    The object ID and output file name (without the .flare/.fake
+    extension) that RunLC uses for a light curve, without reading it.
 
+    Parameters
+    ----------
+    file : str
+        the light curve file (not used for dbmode='mysql'). For
+        dbmode='store', the store directory, or "storedir::KIC" (see
+        lcstore.py)
+    objectid : str
+        the object ID (only used for dbmode='mysql', and for 'store' if
+        the KIC is not in file)
+    dbmode : str
+    makedir : bool, optional
+        create the output directory if needed (Default is True)
 
-    # pick and process a totally random LC.
-    # important for reality checking!
-    if (objectid is 'random'):
-        obj, num = np.loadtxt('get_objects.out', skiprows=1, unpack=True, dtype='str')
-        rand_id = int(np.random.random() * len(obj))
-        objectid = obj[rand_id]
-        print('Random ObjectID Selected: ' + objectid)
+    Returns
+    -------
+    objectid, outfile
+    '''
+    outdir = None
 
-    # get the data
-    if debug is True:
-        print(str(datetime.datetime.now()) + ' GetLC started')
-        print(file, objectid)
+    if dbmode == 'mysql':
+        # put flare output in to a set of subdirectories.
+        # use first 3 digits to help keep directories to ~1k files
+        outdir = 'aprun/' + objectid[0:3] + '/'
+        outfile = outdir + objectid
+
+    elif dbmode == 'fits':
+        # the file name only, so folders (or tarballs, "archive.tgz::member")
+        # in the path don't matter
+        objectid, name = FileID(file, prefix='kplr')
+        outdir = 'aprun/' + objectid[0:3] + '/'
+        outfile = outdir + name[name.find('kplr'):]
+
+    elif dbmode == 'k2fits':
+        # as for 'fits'. The campaign is in the file name, so each
+        # campaign of a target gets its own output
+        objectid, name = FileID(file, prefix='ktwo')
+        outdir = 'aprun/k2/' + objectid[0:3] + '/'
+        outfile = outdir + name[name.find('ktwo'):]
+
+    elif dbmode == 'k2':
+        objectid, _ = FileID(file, prefix='ktwo')
+        # just put the output right along side the input. Not awesome, but works
+        outfile = file
+
+    elif dbmode == 'vdb':
+        objectid = str(int(file[file.find('lightcurve_')+11:file.find('-')]))
+        # put the output in the local research dir
+        outdir = expanduser("~") + '/research/k2_cluster_flares/aprun/' + objectid[0:3] + '/'
+        outfile = outdir + file[file.find('lightcurve_')+11:]
+
+    elif dbmode == 'csv':
+        objectid = '0000'
+        outdir = expanduser("~") + '/research/k2_cluster_flares/aprun/'
+        outfile = outdir + file[file.find('lightcurve_') + 11:]
+
+    elif dbmode == 'everest':
+        objectid = str(int(file[file.find('everest')+15:file.find('-')]))
+        outdir = expanduser("~") + '/research/k2_cluster_flares/aprun/' + objectid[0:3] + '/'
+        outfile = outdir + file[file.find('everest')+15:]
+
+    elif dbmode == 'txt':
+        objectid = file[0:3]
+        outfile = file
+
+    elif dbmode == 'store':
+        # file is the store directory (and maybe the KIC), see lcstore.SplitJob
+        _, objectid = lcstore.SplitJob(file, objectid=objectid)
+        outdir = 'aprun/' + objectid[0:3] + '/'
+        outfile = outdir + objectid
+
+    else:
+        raise ValueError('LCOutfile: unknown dbmode ' + str(dbmode))
 
-    #####################
-    if dbmode is 'mysql':
+    if (makedir is True) and (outdir is not None):
+        _MakeOutdir(outdir)
+
+    return objectid, outfile
+
+
+def ReadLC(file='', objectid='', dbmode='fits', ftype='sap', lctype='', readfile=False):
+    '''
+    Read a light curve, for any of the RunLC dbmode's
+
+    Returns
+    -------
+    qtr, time, lcflag, exptime, flux_raw, error
+    '''
+    if dbmode == 'mysql':
         data_raw = GetLCdb(objectid, readfile=readfile, type=lctype, onecadence=False)
 
         data = OneCadence(data_raw)
@@ -1017,101 +1741,94 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
             flux_raw = data[:,2]
             error = data[:,3]
 
-        # put flare output in to a set of subdirectories.
-        # use first 3 digits to help keep directories to ~1k files
-        fldr = objectid[0:3]
-        outdir = 'aprun/' + fldr + '/'
-        if not os.path.isdir(outdir):
-            try:
-                os.makedirs(outdir)
-            except OSError:
-                pass
-        # open the output file to store data on every flare recovered
-        outfile = outdir + objectid
-
-
-    ######################
-    elif dbmode is 'fits':
-        objectid = str(int( file[file.find('kplr')+4:file.find('-')] ))
+    elif dbmode == 'fits':
         qtr, time, lcflag, exptime, flux_raw, error = GetLCfits(file)
 
-        # put flare output in to a set of subdirectories.
-        # use first 3 digits to help keep directories to ~1k files
-        fldr = objectid[0:3]
-        outdir = 'aprun/' + fldr + '/'
-        if not os.path.isdir(outdir):
-            try:
-                os.makedirs(outdir)
-            except OSError:
-                pass
-
-        outfile = outdir + file[file.find('kplr'):]
-        # file.replace('data', 'results')
-
-    ######################
-    elif dbmode is 'k2':
-        objectid = str(int( file[file.find('ktwo')+4:file.find('-')] ))
-        qtr, time, lcflag, exptime, flux_raw, error = GetLCk2(file)
+    elif dbmode == 'k2fits':
+        qtr, time, lcflag, exptime, flux_raw, error = GetLCk2fits(file)
 
-        # just put the output right along side the input. Not awesome, but works
-        outfile = file
+    elif dbmode == 'k2':
+        qtr, time, lcflag, exptime, flux_raw, error = GetLCk2(file)
 
-    ######################
-    elif dbmode is 'vdb':
-        objectid = str(int(file[file.find('lightcurve_')+11:file.find('-')]))
+    elif (dbmode == 'vdb') or (dbmode == 'csv'):
         qtr, time, lcflag, exptime, flux_raw, error = GetLCvdb(file)
 
-        # put the output in the local research dir
-        fldr = objectid[0:3]
-        home = expanduser("~")
-        outdir = home + '/research/k2_cluster_flares/aprun/' + fldr + '/'
-        if not os.path.isdir(outdir):
-            try:
-                os.makedirs(outdir)
-            except OSError:
-                pass
-        outfile = outdir + file[file.find('lightcurve_')+11:]
+    elif dbmode == 'everest':
+        qtr, time, lcflag, exptime, flux_raw, error = GetLCeverest(file)
 
-    ######################
-    elif dbmode is 'csv':
-        objectid = '0000'
-        qtr, time, lcflag, exptime, flux_raw, error = GetLCvdb(file)
+    elif dbmode == 'txt':
+        qtr, time, lcflag, exptime, flux_raw, error = GetLCtxt(file)
 
-        # put the output in the local research dir
-        fldr = objectid[0:3]
-        home = expanduser("~")
-        outdir = home + '/research/k2_cluster_flares/aprun/'
-        if not os.path.isdir(outdir):
-            try:
-                os.makedirs(outdir)
-            except OSError:
-                pass
-        outfile = outdir + file[file.find('lightcurve_') + 11:]
+    elif dbmode == 'store':
+        storedir, kic = lcstore.SplitJob(file, objectid=objectid)
+        qtr, time, lcflag, exptime, flux_raw, error = lcstore.GetLCstore(kic, storedir,
+                                                                         ftype=ftype)
 
-    ######################
-    elif dbmode is 'everest':
-        objectid = str(int(file[file.find('everest')+15:file.find('-')]))
-        qtr, time, lcflag, exptime, flux_raw, error = GetLCeverest(file)
+    else:
+        raise ValueError('ReadLC: unknown dbmode ' + str(dbmode))
 
-        # put the output in the local research dir
-        fldr = objectid[0:3]
-        home = expanduser("~")
-        outdir = home + '/research/k2_cluster_flares/aprun/' + fldr + '/'
-        if not os.path.isdir(outdir):
-            try:
-                os.makedirs(outdir)
-            except OSError:
-                pass
-        outfile = outdir + file[file.find('everest')+15:]
+    return qtr, time, lcflag, exptime, flux_raw, error
 
-    ######################
-    elif dbmode is 'txt':
-        objectid = file[0:3]
-        qtr, time, lcflag, exptime, flux_raw, error = GetLCtxt(file)
 
-        # just put the output right along side the input. Not awesome, but works
-        outfile = file
+def RunLC(file='', objectid='', ftype='sap', lctype='',
+          display=False, readfile=False, debug=False, dofake=True,
+          dbmode='fits', gapwindow=0.1, maxgap=0.125, verbosefake=False, nfake=100,
+          fakemode='full', npass=1, nproc=1, fakeadapt=False, fakeedtol=0.1,
+          fakemax=2000, emufile=None, emumaxsig=0.1, data=None, writer=None):
+    '''
+    Main wrapper to obtain and process a light curve
+
+    fakemode sets how the fake flare tests re-run the flare search:
+    'full' re-runs all of MultiFind, 'local' re-uses the model from the
+    real search and only updates it around each fake flare, 'validate'
+    does both and writes a comparison line to the .fake file.
+
+    The fake flare tests are repeated npass times per gap, run on nproc
+    processes, with random seeds made from (objectid, segment), where the
+    segment is its start time. This does not depend on where the data was
+    read from (file path, tarball, store), and each quarter still gets
+    its own seeds when quarters are run one file at a time.
+    With fakeadapt=True, batches of fake flares are added until the ED68
+    and ED90 limits are known to within a fraction fakeedtol, or fakemax
+    flares are used (see FakeFlares).
+
+    If a completeness emulator is given (emufile, the .npz file from
+    emulator.FitEmulator, or the emulator dict), its ED68/ED90 limits are
+    used instead of the fake flare test for any gap where both predictions
+    are good to better than emumaxsig (dex).
+
+    For pipelined batch runs, the light curve can be read ahead of time
+    (data, the output of ReadLC), and the .flare output handed to a
+    function instead of written here (writer, called as
+    writer(filename, text)).
+
+    Returns the number of epochs in the light curve.
+    '''
+
+    if isinstance(emufile, str):
+        emu = emulator.LoadEmulator(emufile)
+    else:
+        emu = emufile
+
 
+    # pick and process a totally random LC.
+    # important for reality checking!
+    if (objectid == 'random'):
+        obj, num = np.loadtxt('get_objects.out', skiprows=1, unpack=True, dtype='str')
+        rand_id = int(np.random.random() * len(obj))
+        objectid = obj[rand_id]
+        print('Random ObjectID Selected: ' + objectid)
+
+    # get the data
+    if debug is True:
+        print(str(datetime.datetime.now()) + ' GetLC started')
+        print(file, objectid)
+
+    objectid, outfile = LCOutfile(file=file, objectid=objectid, dbmode=dbmode)
+    if data is None:
+        data = ReadLC(file=file, objectid=objectid, dbmode=dbmode, ftype=ftype,
+                      lctype=lctype, readfile=readfile)
+    qtr, time, lcflag, exptime, flux_raw, error = data
 
     if debug is True:
         print('outfile = ' + outfile)
@@ -1151,7 +1868,17 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
         if debug is True:
             print(str(datetime.datetime.now()) + ' FakeFlares started')
 
-        if dofake is True:
+        # is the completeness emulator sure enough to skip the fake flares?
+        emu_ed = None
+        if (dofake is True) and (emu is not None):
+            emu_ed = _EmulateED(emu, time[dl[i]:dr[i]],
+                                error[dl[i]:dr[i]] / np.nanmedian(flux_model_i),
+                                exptime[dl[i]:dr[i]], maxsig=emumaxsig,
+                                outfile=outfile + '.fake')
+
+        if (dofake is True) and (emu_ed is not None):
+            ed68_i, ed90_i = emu_ed
+        elif dofake is True:
             medflux = np.nanmedian(flux_model_i) # flux needs to be normalized
 
             if len(istart_i)>0:
@@ -1160,31 +1887,32 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
             else:
                 t_tmp1 = []
                 t_tmp2 = []
+            if fakemode == 'full':
+                model_i = None
+            else:
+                model_i = flux_model_i/medflux - 1.0
+
             ed_fake, frac_rec = FakeFlares(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]]/medflux - 1.0,
                                            error[dl[i]:dr[i]]/medflux, lcflag[dl[i]:dr[i]],
                                            t_tmp1, t_tmp2,
                                            savefile=True, verboseout=verbosefake, gapwindow=gapwindow,
                                            outfile=outfile + '.fake', display=display,
-                                           nfake=nfake, debug=debug)
-
-            rl = np.isfinite(frac_rec)
-            frac_rec_sm = wiener(frac_rec[rl], 3)
+                                           nfake=nfake, debug=debug, model=model_i,
+                                           validate=(fakemode == 'validate'),
+                                           npass=npass, nproc=nproc,
+                                           seedid=(str(objectid), '%.4f' % time[dl[i]]),
+                                           adaptive=fakeadapt, edtol=fakeedtol,
+                                           maxfake=fakemax)
 
-            # use this completeness curve to estimate 68% complete
-            x68 = np.where((frac_rec_sm >= 0.68))
-            if len(x68[0])>0:
-                ed68_i = min(ed_fake[rl][x68])
-            else:
-                ed68_i = -99
-
-            x90 = np.where((frac_rec_sm >= 0.90))
-            if len(x90[0])>0:
-                ed90_i = min(ed_fake[rl][x90])
-            else:
-                ed90_i = -99
+            # use this completeness curve to estimate 68% & 90% complete
+            ed68_i, ed90_i = FakeEDLimits(ed_fake, frac_rec)
 
             if display is True:
-                # print(np.shape(ed_fake), np.shape(frac_rec), np.shape(rl), np.shape(frac_rec_sm))
+                from scipy.signal import wiener
+                plt = _Pyplot()
+                rl = np.isfinite(frac_rec)
+                frac_rec_sm = wiener(frac_rec[rl], 3)
+
                 plt.figure()
                 plt.plot(ed_fake, frac_rec, c='k')
                 plt.plot(ed_fake[rl], frac_rec_sm, c='red', linestyle='dashed', lw=2)
@@ -1237,6 +1965,7 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
     if display is True:
         print(str(len(istart))+' flare candidates found')
 
+        plt = _Pyplot()
         plt.figure()
         plt.plot(time, flux_gap, 'k', alpha=0.7, lw=0.8)
 
@@ -1312,24 +2041,27 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
 
     if debug is True:
         print(str(datetime.datetime.now()) + 'Getting FlareStats')
-    # loop over EACH FLARE, compute stats
+    # compute stats for ALL flares at once
+    stats_all = FlareStatsBatch(time, flux_gap, error, flux_model, istart, istop,
+                                ed68=ed68, ed90=ed90)
+
     for i in range(0,len(istart)):
-        stats_i = FlareStats(time, flux_gap, error, flux_model,
-                             istart=istart[i], istop=istop[i])
+        stats_i = stats_all[i]
 
         outstring = outstring + str(stats_i[0])
         for k in range(1,len(stats_i)):
             outstring = outstring + ', ' + str(stats_i[k])
-
-        outstring = outstring + ', ' + str(ed68[i]) + ', ' + str(ed90[i])
         outstring = outstring + '\n'
 
 
-    fout = open(outfile + '.flare', 'w')
-    fout.write(outstring)
-    fout.close()
+    if writer is None:
+        fout = open(outfile + '.flare', 'w')
+        fout.write(outstring)
+        fout.close()
+    else:
+        writer(outfile + '.flare', outstring)
 
-    return
+    return len(time)
 
 
 # let this file be called from the terminal directly. e.g.:
@@ -0,0 +1,590 @@
+'''
+Run appaloosa over a whole list of light curves on one (many-core)
+machine, with a pool of worker processes. No Condor needed.
+
+The light curves are handed out one at a time, biggest (slowest) first,
+so idle workers keep taking the next one and the run doesn't end waiting
+on one big file. Light curves that already have a .flare file are
+skipped, so a killed run can just be started again.
+
+With --pipeline, each process also overlaps its I/O with the compute:
+reader threads read & decode the next few light curves while the
+current one is being searched, and a writer thread writes the results.
+This keeps the cores busy when the files are on slow (e.g. NFS) disks.
+
+Run from the terminal, e.g.:
+$ python batch.py --list all_fits.lis -j 32
+$ python batch.py --list all_fits.lis -j 32 --pipeline
+
+Like the rest of appaloosa, this uses plain "import appaloosa" style
+imports of its neighbours, so run it as a script (from any folder, e.g.
+$ python ~/python/appaloosa/appaloosa/batch.py ...), not with python -m.
+
+The list can also hold quarter tarballs (Q*_public/*.tgz) instead of
+extracted FITS files. Each tarball is read straight through, in on-disk
+order, by one reader in pipeline mode (see tarlc.py), and light curves
+inside a tarball can be listed as "archive.tgz::member".
+'''
+
+import os
+import sys
+import argparse
+import traceback
+import threading
+import multiprocessing
+import time as _time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import appaloosa
+import emulator
+import worker
+import condor
+import tarlc
+import fitsread
+
+# the completeness emulator, loaded once by each pool process
+_EMU = None
+
+
+def EstimateCost(file, dbmode='fits'):
+    '''
+    A rough run time for one light curve, from its file size and cadence
+    (see condor.EstimateCost). Only used to order the work.
+
+    Returns
+    -------
+    float, 0 if the file can't be found
+    '''
+    if dbmode == 'mysql':
+        return 0.
+    return condor.EstimateCost(file)
+
+
+def _Outfile(file, dbmode):
+    if dbmode == 'mysql':
+        _, outfile = appaloosa.LCOutfile(objectid=file, dbmode=dbmode, makedir=False)
+    else:
+        _, outfile = appaloosa.LCOutfile(file=file, dbmode=dbmode, makedir=False)
+    return outfile
+
+
+def _ClearFake(file, dbmode):
+    # a .fake file without a .flare is from a run that didn't finish,
+    # and FakeFlares appends to it
+    outfile = _Outfile(file, dbmode)
+    if os.path.isfile(outfile + '.fake'):
+        os.remove(outfile + '.fake')
+    return
+
+
+def IsDone(file, dbmode='fits'):
+    '''
+    Has RunLC already finished this light curve? (the .flare file is
+    only written at the very end of RunLC)
+    '''
+    return os.path.isfile(_Outfile(file, dbmode) + '.flare')
+
+
+def _Todo(files, dbmode, resume):
+    '''
+    The files left to run, biggest first (so the last jobs to finish are
+    the short ones), and the number skipped
+    '''
+    nskip = 0
+    if resume is True:
+        # (whole tarballs are checked member by member as they are read)
+        todo = [f for f in files if tarlc.IsTar(f) or not IsDone(f, dbmode=dbmode)]
+        nskip = len(files) - len(todo)
+    else:
+        todo = list(files)
+
+    cost = [EstimateCost(f, dbmode=dbmode) for f in todo]
+    order = sorted(range(len(todo)), key=lambda k: -cost[k])
+    return [todo[k] for k in order], nskip
+
+
+def _InitPool(emufile):
+    global _EMU
+    if isinstance(emufile, str):
+        _EMU = emulator.LoadEmulator(emufile)
+    else:
+        _EMU = emufile
+    return
+
+
+def _BatchOne(job):
+    '''
+    Run one light curve. Returns (file, number of epochs, run time,
+    error message or None, FITS bytes read)
+    '''
+    file, dbmode, kwargs = job
+    t0 = _time.time()
+    b0 = _BytesRead()
+
+    kwargs = dict(kwargs)
+    if _EMU is not None:
+        kwargs['emufile'] = _EMU
+
+    try:
+        _ClearFake(file, dbmode)
+
+        if dbmode == 'mysql':
+            npts = appaloosa.RunLC(objectid=file, dbmode=dbmode, **kwargs)
+        else:
+            npts = appaloosa.RunLC(file=file, dbmode=dbmode, **kwargs)
+        err = None
+    except Exception:
+        npts = 0
+        err = traceback.format_exc()
+    finally:
+        worker._ResetState()
+
+    return file, npts, _time.time() - t0, err, _BytesRead() - b0
+
+
+def _BytesRead():
+    # FITS header + table bytes read so far by this process
+    return fitsread.STATS['header_bytes'] + fitsread.STATS['data_bytes']
+
+
+def Batch(files, nproc=1, dbmode='fits', resume=True, emufile=None,
+          report=10, **kwargs):
+    '''
+    Run RunLC on a list of light curves with a pool of processes.
+
+    Parameters
+    ----------
+    files : list of str
+        light curve files (or object ID's for dbmode='mysql')
+    nproc : int, optional
+        number of processes (Default is 1, run everything in this process)
+    dbmode : str, optional
+        passed to RunLC (Default is 'fits')
+    resume : bool, optional
+        skip light curves that already have a .flare file (Default is True)
+    emufile : str, optional
+        completeness emulator for RunLC, loaded once per process
+    report : int, optional
+        print the progress & throughput every this many light curves
+    kwargs :
+        any other RunLC options (e.g. nfake, fakemode, ...). The fake
+        flare tests in each RunLC are run serially (nproc=1), the
+        parallelism here is over light curves.
+
+    Returns
+    -------
+    (number finished, number failed, number skipped)
+    '''
+    kwargs.setdefault('display', False)
+    kwargs.setdefault('debug', False)
+    kwargs['nproc'] = 1
+
+    todo, nskip = _Todo(files, dbmode, resume)
+    jobs = [(f, dbmode, kwargs) for f in todo]
+
+    print('Batch: ' + str(len(jobs)) + ' light curves to run, ' + str(nskip) +
+          ' already done, on ' + str(nproc) + ' processes')
+    sys.stdout.flush()
+
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=_InitPool, initargs=(emufile,))
+        results = pool.imap_unordered(_BatchOne, jobs, chunksize=1)
+    else:
+        pool = None
+        _InitPool(emufile)
+        results = (_BatchOne(job) for job in jobs)
+
+    nok = 0
+    nfail = 0
+    npts = 0
+    nbytes = 0
+    t0 = _time.time()
+
+    try:
+        for file, npts_i, dt_i, err, nbytes_i in results:
+            nbytes = nbytes + nbytes_i
+            if err is None:
+                nok = nok + 1
+                npts = npts + npts_i
+            else:
+                nfail = nfail + 1
+                print('Batch: FAILED ' + file)
+                print(err)
+
+            if (report > 0) and ((nok + nfail) % report == 0):
+                _Throughput(nok, nfail, len(jobs), npts, _time.time() - t0)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print('Batch: finished')
+    _Throughput(nok, nfail, len(jobs), npts, _time.time() - t0, nbytes=nbytes)
+
+    return nok, nfail, nskip
+
+
+def _Throughput(nok, nfail, ntot, npts, dt, nbytes=None):
+    dt = max(dt, 1e-9)
+    print('Batch: ' + str(nok + nfail) + '/' + str(ntot) + ' (' + str(nfail) +
+          ' failed) in ' + str(round(dt, 1)) + ' s, ' +
+          str(round(nok / dt, 3)) + ' LCs/s, ' +
+          str(round(npts / dt, 1)) + ' points/s')
+    if (nbytes is not None) and (nbytes > 0):
+        print('Batch: FITS data read ' + str(round(nbytes / 1048576., 1)) + ' MB, ' +
+              str(round(nbytes / 1024. / max(nok + nfail, 1), 1)) + ' kB per LC')
+    sys.stdout.flush()
+    return
+
+
+# for the light curves in tarballs: the member names, and how to read
+# them, for each dbmode
+_TARMODES = {'fits':('kplr*.fits', 'GetLCfits'),
+             'k2fits':('ktwo*.fits', 'GetLCk2fits')}
+
+
+def _PipeReadTar(tarpath, dataq, dbmode, resume, busy, lock):
+    '''
+    Read every light curve in a tarball, in one pass, on to dataq
+    '''
+    t0 = _time.time()
+    try:
+        if dbmode not in _TARMODES:
+            raise ValueError('tarballs can only be read with dbmode ' +
+                             ' or '.join(sorted(_TARMODES.keys())) + ', not ' + str(dbmode))
+        pattern, getlc = _TARMODES[dbmode]
+        getlc = getattr(appaloosa, getlc)
+
+        for file, fobj in tarlc.IterMembers(tarpath, pattern=pattern):
+            if (resume is True) and IsDone(file, dbmode=dbmode):
+                continue
+            try:
+                data = getlc(fobj)
+                err = None
+            except Exception:
+                data = None
+                err = traceback.format_exc()
+            with lock:
+                busy['read'] += _time.time() - t0
+
+            dataq.put((file, data, err))
+            t0 = _time.time()
+    except Exception:
+        dataq.put((tarpath, None, traceback.format_exc()))
+    return
+
+
+def _PipeRead(jobq, dataq, dbmode, resume, busy, lock):
+    '''
+    Reader thread: take file names from jobq, read & decode them, and put
+    them on dataq (which blocks when the compute falls behind)
+    '''
+    while True:
+        file = jobq.get()
+        if file is None:
+            break
+
+        if tarlc.IsTar(file):
+            _PipeReadTar(file, dataq, dbmode, resume, busy, lock)
+            continue
+
+        t0 = _time.time()
+        try:
+            if dbmode == 'mysql':
+                data = appaloosa.ReadLC(objectid=file, dbmode=dbmode)
+            else:
+                data = appaloosa.ReadLC(file=file, dbmode=dbmode)
+            err = None
+        except Exception:
+            data = None
+            err = traceback.format_exc()
+        with lock:
+            busy['read'] += _time.time() - t0
+
+        dataq.put((file, data, err))
+
+    dataq.put(None)
+    return
+
+
+def _PipeWrite(writeq, busy):
+    '''
+    Writer thread: write out each (file name, text) from writeq. A failed
+    write (disk full, permissions...) is counted in busy['wfail'] and
+    its partial file removed, and the thread carries on, so the compute
+    never blocks on a full writeq.
+    '''
+    while True:
+        item = writeq.get()
+        if item is None:
+            break
+
+        t0 = _time.time()
+        try:
+            fout = open(item[0], 'w')
+            try:
+                fout.write(item[1])
+            finally:
+                fout.close()
+        except Exception:
+            busy['wfail'] += 1
+            print('Pipeline: FAILED writing ' + item[0])
+            print(traceback.format_exc())
+            sys.stdout.flush()
+            # don't leave a partial .flare file, it would look done
+            try:
+                os.remove(item[0])
+            except OSError:
+                pass
+        busy['write'] += _time.time() - t0
+    return
+
+
+def Pipeline(jobq, dbmode='fits', nread=2, depth=4, emufile=None, resume=True,
+             **kwargs):
+    '''
+    Run RunLC on the files from jobq in this process, with nread reader
+    threads reading ahead and a writer thread for the .flare output.
+
+    Parameters
+    ----------
+    jobq : queue
+        file names to run, followed by one None per reader thread. Can be
+        a multiprocessing.Queue shared with other processes.
+    dbmode : str, optional
+    nread : int, optional
+        number of reader threads (Default is 2)
+    depth : int, optional
+        the most light curves to hold in memory waiting to be run, and
+        the most outputs waiting to be written (Default is 4)
+    emufile : str, optional
+        completeness emulator for RunLC
+    resume : bool, optional
+        skip light curves in tarballs that already have a .flare file
+    kwargs :
+        any other RunLC options
+
+    Returns
+    -------
+    dict with the number of light curves done ('nok') & failed ('nfail'),
+    the number of epochs run ('npts'), the wall time ('wall'), and the
+    busy time of each stage ('read', summed over the reader threads,
+    'compute', 'write'), and the time the compute waited on the readers
+    ('starved'), plus the FITS bytes read ('bytes'). Light curves whose
+    output couldn't be written count as failed.
+    '''
+    if isinstance(emufile, str):
+        kwargs['emufile'] = emulator.LoadEmulator(emufile)
+    elif emufile is not None:
+        kwargs['emufile'] = emufile
+
+    out = _PipeStats()
+    b0 = _BytesRead()
+    lock = threading.Lock()
+
+    dataq = queue.Queue(maxsize=depth)
+    writeq = queue.Queue(maxsize=depth)
+
+    t0 = _time.time()
+    readers = [threading.Thread(target=_PipeRead, args=(jobq, dataq, dbmode, resume, out, lock))
+               for _ in range(nread)]
+    writer = threading.Thread(target=_PipeWrite, args=(writeq, out))
+    for th in readers + [writer]:
+        th.daemon = True
+        th.start()
+
+    def _write(fname, text):
+        writeq.put((fname, text))
+
+    ndone = 0
+    while ndone < nread:
+        t1 = _time.time()
+        item = dataq.get()
+        out['starved'] += _time.time() - t1
+        if item is None:
+            # one reader has run out of files
+            ndone = ndone + 1
+            continue
+
+        file, data, err = item
+        t1 = _time.time()
+        if err is None:
+            try:
+                _ClearFake(file, dbmode)
+                if dbmode == 'mysql':
+                    npts = appaloosa.RunLC(objectid=file, dbmode=dbmode, data=data,
+                                           writer=_write, **kwargs)
+                else:
+                    npts = appaloosa.RunLC(file=file, dbmode=dbmode, data=data,
+                                           writer=_write, **kwargs)
+            except Exception:
+                err = traceback.format_exc()
+            finally:
+                worker._ResetState()
+        out['compute'] += _time.time() - t1
+
+        if err is None:
+            out['nok'] += 1
+            out['npts'] += npts
+        else:
+            out['nfail'] += 1
+            print('Pipeline: FAILED ' + file)
+            print(err)
+        sys.stdout.flush()
+
+    writeq.put(None)
+    writer.join()
+    out['nok'] -= out['wfail']
+    out['nfail'] += out['wfail']
+    out['wall'] = _time.time() - t0
+    out['bytes'] = _BytesRead() - b0
+
+    return out
+
+
+def _PipeStats():
+    '''
+    The (zeroed) stats dict that Pipeline returns
+    '''
+    return {'nok':0, 'nfail':0, 'wfail':0, 'npts':0, 'read':0., 'compute':0.,
+            'write':0., 'starved':0., 'wall':0., 'bytes':0}
+
+
+def _PipeProc(jobq, resq, dbmode, nread, depth, emufile, resume, kwargs):
+    resq.put(Pipeline(jobq, dbmode=dbmode, nread=nread, depth=depth,
+                      emufile=emufile, resume=resume, **kwargs))
+    return
+
+
+def PipelineBatch(files, nproc=1, dbmode='fits', resume=True, emufile=None,
+                  nread=2, depth=4, **kwargs):
+    '''
+    Like Batch, but each of the nproc processes runs a Pipeline: reading,
+    flare finding and writing overlap. All the processes pull file names
+    from one shared queue, biggest files first.
+
+    Parameters
+    ----------
+    files : list of str
+    nproc : int, optional
+    dbmode : str, optional
+    resume : bool, optional
+    emufile : str, optional
+    nread : int, optional
+        reader threads per process (Default is 2)
+    depth : int, optional
+        read-ahead & write queue length per process (Default is 4)
+    kwargs :
+        any other RunLC options
+
+    Returns
+    -------
+    (number finished, number failed, number skipped)
+    '''
+    kwargs.setdefault('display', False)
+    kwargs.setdefault('debug', False)
+    kwargs['nproc'] = 1
+
+    todo, nskip = _Todo(files, dbmode, resume)
+
+    print('PipelineBatch: ' + str(len(todo)) + ' files to run, ' + str(nskip) +
+          ' already done, on ' + str(nproc) + ' processes x ' + str(nread) + ' readers')
+    sys.stdout.flush()
+
+    jobq = multiprocessing.Queue()
+    for f in todo:
+        jobq.put(f)
+    for _ in range(nproc * nread):
+        jobq.put(None)
+
+    t0 = _time.time()
+    if nproc > 1:
+        resq = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_PipeProc,
+                                         args=(jobq, resq, dbmode, nread, depth, emufile,
+                                               resume, kwargs))
+                 for _ in range(nproc)]
+        for p in procs:
+            p.start()
+
+        # a process that dies (e.g. killed for memory) never sends its
+        # stats, so don't wait for those
+        res = []
+        dead = []
+        while len(res) + len(dead) < nproc:
+            try:
+                res.append(resq.get(timeout=5))
+            except queue.Empty:
+                dead = [p for p in procs if (p.exitcode is not None) and (p.exitcode != 0)]
+        for p in procs:
+            p.join()
+        for p in dead:
+            print('PipelineBatch: a process died (exit code ' + str(p.exitcode) +
+                  '), the light curves it was running are not done. Run again '
+                  'to pick them up.')
+    else:
+        res = [Pipeline(jobq, dbmode=dbmode, nread=nread, depth=depth,
+                        emufile=emufile, resume=resume, **kwargs)]
+    wall = _time.time() - t0
+
+    tot = _PipeStats()
+    for key in tot:
+        tot[key] = sum([r[key] for r in res])
+
+    print('PipelineBatch: finished')
+    _Throughput(tot['nok'], tot['nfail'], tot['nok'] + tot['nfail'], tot['npts'], wall,
+                nbytes=tot['bytes'])
+
+    # fraction of the time each stage was busy, averaged over the processes
+    # (and over the reader threads, for the read stage)
+    busy = max(tot['wall'], 1e-9)
+    print('PipelineBatch: utilization read ' + str(round(tot['read'] / busy / nread, 3)) +
+          ', compute ' + str(round(tot['compute'] / busy, 3)) +
+          ', write ' + str(round(tot['write'] / busy, 3)) +
+          ', compute waiting on reads ' + str(round(tot['starved'] / busy, 3)))
+    sys.stdout.flush()
+
+    return tot['nok'], tot['nfail'], nskip
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run appaloosa on a list of light curves with a process pool')
+    parser.add_argument('--list', required=True, help='file with one light curve path per line')
+    parser.add_argument('-j', '--nproc', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--dbmode', default='fits')
+    parser.add_argument('--nfake', type=int, default=100)
+    parser.add_argument('--fakemode', default='full', choices=('full', 'local', 'validate'))
+    parser.add_argument('--emufile', default=None)
+    parser.add_argument('--noresume', action='store_true', help='re-run light curves that are already done')
+    parser.add_argument('--pipeline', action='store_true', help='overlap reading, compute and writing')
+    parser.add_argument('--nread', type=int, default=2, help='reader threads per process, with --pipeline')
+    parser.add_argument('--depth', type=int, default=4, help='read-ahead per process, with --pipeline')
+    args = parser.parse_args(argv)
+
+    files = list(worker.IterList(args.list))
+
+    if (args.pipeline is False) and any([tarlc.IsTar(f) for f in files]):
+        print('Batch: the list has tarballs, running with --pipeline to read them in order')
+        args.pipeline = True
+
+    if args.pipeline is True:
+        nok, nfail, nskip = PipelineBatch(files, nproc=args.nproc, dbmode=args.dbmode,
+                                          resume=(not args.noresume), emufile=args.emufile,
+                                          nread=args.nread, depth=args.depth,
+                                          nfake=args.nfake, fakemode=args.fakemode)
+    else:
+        nok, nfail, nskip = Batch(files, nproc=args.nproc, dbmode=args.dbmode,
+                                  resume=(not args.noresume), emufile=args.emufile,
+                                  nfake=args.nfake, fakemode=args.fakemode)
+
+    if nfail > 0:
+        return 1
+    return 0
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python batch.py --list files.lis -j 32
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+'''
+Timing benchmarks for the slow parts of appaloosa.
+
+Run them all from the terminal like so:
+$ python bench.py
+
+or just check the import time of appaloosa.py against its budget (exits
+with status 1 if it is over):
+$ python bench.py import
+
+Array lengths default to one quarter of Kepler short cadence (SLC) data,
+~90 days at 1-minute sampling.
+'''
+
+import os
+import sys
+import subprocess
+import numpy as np
+import time as _time
+
+# one Kepler quarter of 1-minute data
+NSLC = 129600
+
+# allowed wall time (seconds) for "import appaloosa" in a fresh python
+IMPORT_BUDGET = 0.5
+
+# modules that should only be loaded when their code path runs
+_LAZY = ('matplotlib', 'astropy', 'pandas', 'gatspy', 'MySQLdb', 'scipy.stats',
+         'scipy.signal', 'scipy.optimize')
+
+
+def _timeit(func, nrep=3):
+    '''
+    Best wall time (in seconds) of nrep calls to func()
+    '''
+    best = np.inf
+    for k in range(nrep):
+        t0 = _time.time()
+        func()
+        best = min(best, _time.time() - t0)
+    return best
+
+
+def _fakelc(n=NSLC, seed=42):
+    '''
+    Simple spotted-star light curve w/ noise, in 1-minute cadence
+    '''
+    rng = np.random.RandomState(seed)
+    time = np.arange(n) / 60. / 24.
+    flux = 1000. + 5. * np.sin(time * 2. * np.pi / 3.3) + rng.normal(0, 1, n)
+    error = np.ones(n)
+    return time, flux, error
+
+
+def BenchRollingMedian(n=NSLC, windows=(10, 120, 1296), nrep=3):
+    '''
+    Compare rolling.RollingMedian to the pandas version, for the kernel
+    sizes used by MultiBoxcar (~2hr of SLC) and QtrFlat (len/100)
+    '''
+    from rolling import RollingMedian
+    import rolling
+
+    _, flux, _ = _fakelc(n)
+
+    try:
+        import pandas as pd
+        haz_pandas = True
+    except ImportError:
+        haz_pandas = False
+
+    print('BenchRollingMedian: n = ' + str(n) +
+          ', bottleneck = ' + str(rolling.haz_bottleneck))
+
+    for w in windows:
+        t_new = _timeit(lambda: RollingMedian(flux, w, center=True), nrep=nrep)
+        outstring = '  window = ' + str(w) + ': RollingMedian ' + \
+                    str(round(t_new, 4)) + ' s'
+
+        if haz_pandas is True:
+            if hasattr(pd, 'rolling_median'):
+                pfunc = lambda: pd.rolling_median(flux, w, center=True)
+            else:
+                pfunc = lambda: pd.Series(flux).rolling(w, center=True).median()
+            t_pd = _timeit(pfunc, nrep=nrep)
+
+            # make sure we are timing the same answer
+            a = RollingMedian(flux, w, center=True)
+            b = np.asarray(pfunc(), dtype='float')
+            same = np.allclose(a, b, equal_nan=True)
+
+            outstring = outstring + ', pandas ' + str(round(t_pd, 4)) + \
+                        ' s, match = ' + str(same)
+        print(outstring)
+
+    return
+
+
+def BenchFitFlare(nflare=300, nrep=1, seed=42):
+    '''
+    Compare flarefit.FitFlare to the old curve_fit call on a set of fake
+    flare candidates, with a fraction of them pure noise (pathological).
+    Reports wall time per fit, the failure rate (-99 or NaN), and the
+    median fractional error on the recovered FWHM for the real flares.
+    '''
+    import warnings
+    from scipy.optimize import curve_fit
+    from aflare import aflare1
+    from flarefit import FitFlare
+
+    rng = np.random.RandomState(seed)
+    dt = 1. / 60. / 24.
+
+    cands = []
+    for k in range(nflare):
+        npts = rng.randint(4, 40)
+        t = np.arange(npts) * dt
+        fwhm = rng.uniform(2., 10.) * dt
+        ampl = 10.**rng.uniform(-2.5, -0.5)
+        tpeak = t[rng.randint(0, max(npts // 4, 1))] + rng.uniform(0, dt)
+        f = rng.normal(0, 0.003, npts)
+        real = (k % 4 != 0) # every 4th candidate is just noise
+        if real:
+            f = f + aflare1(t, tpeak, fwhm, ampl)
+        # warm start, measured same way as FlareStats does
+        p0 = (t[np.argmax(f)], max(np.sum(f > np.max(f) * 0.5) * dt, dt), np.max(f))
+        cands.append((t, f, p0, real, (tpeak, fwhm, ampl)))
+
+    def _old():
+        out = []
+        for t, f, p0, _, _ in cands:
+            try:
+                popt, _ = curve_fit(aflare1, t, f, p0=p0)
+            except (ValueError, TypeError):
+                popt = np.array([np.nan, np.nan, np.nan])
+            except RuntimeError:
+                popt = np.array([-99., -99., -99.])
+            out.append(popt)
+        return np.array(out)
+
+    def _new():
+        return np.array([FitFlare(t, f, p0) for t, f, p0, _, _ in cands])
+
+    print('BenchFitFlare: ' + str(nflare) + ' candidates')
+    real = np.array([c[3] for c in cands])
+    ftrue = np.array([c[4][1] for c in cands])
+
+    for name, func in (('curve_fit', _old), ('FitFlare', _new)):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            t_fit = _timeit(func, nrep=nrep)
+            popt = func()
+
+        fail = ~np.isfinite(popt[:,0]) | (popt[:,0] == -99)
+        ok = real & ~fail
+        ferr = np.median(np.abs(popt[ok,1] - ftrue[ok]) / ftrue[ok])
+
+        print('  ' + name + ': ' + str(round(t_fit / nflare * 1e3, 3)) +
+              ' ms/fit, failed ' + str(round(np.mean(fail[real]) * 100., 1)) +
+              '% (real), ' + str(round(np.mean(fail[~real]) * 100., 1)) +
+              '% (noise), FWHM frac. error ' + str(round(ferr, 3)))
+
+    return
+
+
+def BenchFlareModel(n=NSLC, nfake=(10, 100, 1000), tol=1e-4, nrep=3, seed=42):
+    '''
+    Inject nfake flares in to a light curve the old way (aflare1 over the
+    whole time array, once per flare) and with aflare.aflare_many, which
+    only evaluates each flare within its support
+    '''
+    from aflare import aflare1, aflare_many
+
+    time, _, _ = _fakelc(n)
+    rng = np.random.RandomState(seed)
+
+    print('BenchFlareModel: n = ' + str(n) + ', tol = ' + str(tol))
+    for nf in nfake:
+        tpeak = rng.choice(time, nf)
+        fwhm = rng.uniform(0.5, 60., nf) / 60. / 24.
+        ampl = rng.uniform(0.1, 100., nf)
+
+        def _old():
+            model = np.zeros_like(time)
+            for k in range(nf):
+                model = model + aflare1(time, tpeak[k], fwhm[k], ampl[k])
+            return model
+
+        t_old = _timeit(_old, nrep=nrep)
+        t_new = _timeit(lambda: aflare_many(time, tpeak, fwhm, ampl, tol=tol), nrep=nrep)
+        err = np.max(np.abs(_old() - aflare_many(time, tpeak, fwhm, ampl, tol=tol)))
+
+        print('  nfake = ' + str(nf) + ': aflare1 loop ' + str(round(t_old, 4)) +
+              ' s, aflare_many ' + str(round(t_new, 4)) + ' s, max diff / max ampl = ' +
+              str(err / np.max(ampl)))
+
+    return
+
+
+def BenchImport(budget=IMPORT_BUDGET, nrep=5):
+    '''
+    Time "import appaloosa" in a fresh python process (best of nrep),
+    and check that none of the slow/optional modules in _LAZY get
+    loaded along with it.
+
+    Returns
+    -------
+    True if the import is within budget and loads nothing from _LAZY
+    '''
+    code = ('import sys, time; t0 = time.time(); import appaloosa; '
+            'dt = time.time() - t0; '
+            'print(dt); print(",".join(sorted(m for m in sys.modules '
+            'if m.startswith(' + repr(_LAZY) + '))))')
+
+    best = np.inf
+    loaded = ''
+    for k in range(nrep):
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        lines = out.decode('utf-8').split('\n')
+        best = min(best, float(lines[0]))
+        loaded = lines[1].strip()
+
+    ok = (best <= budget) and (len(loaded) == 0)
+
+    print('BenchImport: import appaloosa ' + str(round(best, 3)) + ' s (budget ' +
+          str(budget) + ' s)')
+    if len(loaded) > 0:
+        print('  loaded at import: ' + loaded)
+    if ok is False:
+        print('  FAILED')
+
+    return ok
+
+
+def BenchReadText(n=NSLC, nrep=3, seed=42):
+    '''
+    Read a K2-style ASCII light curve (12 columns, keep 4, as GetLCk2
+    does) with np.loadtxt, and with textread.ReadText
+    '''
+    import tempfile
+    from textread import ReadText
+
+    rng = np.random.RandomState(seed)
+    data = rng.normal(size=(n, 12))
+    fd, file = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        np.savetxt(file, data, header='time ... flux error quality', comments='')
+
+        kw = {'usecols':(0, 7, 8, 9), 'skiprows':1}
+        t_old = _timeit(lambda: np.loadtxt(file, unpack=True, **kw), nrep=nrep)
+        t_new = _timeit(lambda: ReadText(file, **kw), nrep=nrep)
+        same = all([np.array_equal(a, b) for a, b in
+                    zip(np.loadtxt(file, unpack=True, **kw), ReadText(file, **kw))])
+    finally:
+        os.remove(file)
+
+    print('BenchReadText: n = ' + str(n) + ', np.loadtxt ' + str(round(t_old, 4)) +
+          ' s, ReadText ' + str(round(t_new, 4)) + ' s, same = ' + str(same))
+
+    return
+
+
+def BenchReadFits(n=NSLC, nrep=3, seed=42):
+    '''
+    Read a Kepler-style light curve table (time, flux, error, quality,
+    keeping the rows with finite flux) with astropy, and with
+    fitsread.ReadBintable. Also checks that asking for other dtypes gives
+    the same values as casting the astropy columns.
+    '''
+    import tempfile
+    from astropy.io import fits
+    from fitsread import ReadBintable
+
+    rng = np.random.RandomState(seed)
+    flux = rng.normal(size=n).astype('float32')
+    flux[rng.uniform(size=n) < 0.01] = np.nan
+    cols = [fits.Column(name='TIME', format='D', array=np.arange(n) / 1440.),
+            fits.Column(name='PDCSAP_FLUX', format='E', array=flux),
+            fits.Column(name='PDCSAP_FLUX_ERR', format='E', array=np.abs(flux)),
+            fits.Column(name='SAP_QUALITY', format='J', array=rng.randint(0, 4, size=n))]
+    fd, file = tempfile.mkstemp(suffix='.fits')
+    os.close(fd)
+    try:
+        fits.BinTableHDU.from_columns(cols).writeto(file, overwrite=True)
+        names = ['TIME', 'PDCSAP_FLUX', 'PDCSAP_FLUX_ERR', 'SAP_QUALITY']
+        dtypes = {'PDCSAP_FLUX':'float64', 'SAP_QUALITY':'float32'}
+
+        def _astropy(dtypes={}):
+            with fits.open(file) as hdu:
+                data = hdu[1].data
+                ok = np.isfinite(data['PDCSAP_FLUX'])
+                return [np.array(data[c][ok], dtype=dtypes.get(c, data[c].dtype.newbyteorder('=')))
+                        for c in names]
+
+        def _fitsread(dtypes=None):
+            return ReadBintable(file, names, finite=['PDCSAP_FLUX'], dtypes=dtypes)
+
+        t_old = _timeit(_astropy, nrep=nrep)
+        t_new = _timeit(_fitsread, nrep=nrep)
+        same = True
+        for ref, out in ((_astropy(), _fitsread()), (_astropy(dtypes), _fitsread(dtypes))):
+            same &= all([(a.dtype == b.dtype) and np.array_equal(a, b) for a, b in zip(ref, out)])
+    finally:
+        os.remove(file)
+
+    print('BenchReadFits: n = ' + str(n) + ', astropy ' + str(round(t_old, 4)) +
+          ' s, ReadBintable ' + str(round(t_new, 4)) + ' s, same = ' + str(same))
+
+    return
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python bench.py
+if __name__ == "__main__":
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'import'):
+        if len(sys.argv) > 2:
+            sys.exit(int(not BenchImport(budget=float(sys.argv[2]))))
+        sys.exit(int(not BenchImport()))
+
+    BenchImport()
+    BenchRollingMedian()
+    BenchFitFlare()
+    BenchFlareModel()
+    BenchReadText()
+    BenchReadFits()
@@ -6,6 +6,10 @@ import numpy as np
 import os
 from os.path import expanduser
 import time
+import heapq
+
+# rough RunLC run time (seconds) per MB of Kepler FITS file
+_SECPERMB = {'slc':60., 'llc':30.}
 
 
 def HexTime():
@@ -110,7 +114,128 @@ def PrepUW(prefix=''):
     return
 
 
-def PrepWWU(prefix='', nice=False, bin=10):
+def EstimateCost(file, secpermb=None):
+    '''
+    A rough run time (in seconds) for one light curve, from its file size
+    and cadence type (short cadence if "slc" is in the file name).
+
+    Parameters
+    ----------
+    file : str
+    secpermb : dict, optional
+        seconds of run time per MB of file, for 'slc' and 'llc'.
+        (Default is _SECPERMB, tune it to the throughput batch.py reports)
+
+    Returns
+    -------
+    float, 0 if the file can't be found
+    '''
+    if secpermb is None:
+        secpermb = _SECPERMB
+
+    try:
+        mb = os.path.getsize(file) / 1048576.
+    except OSError:
+        return 0.
+
+    if file.find('slc') > -1:
+        return mb * secpermb['slc']
+    return mb * secpermb['llc']
+
+
+def PackJobs(files, cost, target=3600.):
+    '''
+    Pack light curves in to jobs of about the same total run time, using
+    the longest-first rule: the files are sorted by cost, and each goes
+    to whichever job has the least work so far.
+
+    Parameters
+    ----------
+    files : list of str
+    cost : array
+        the estimated run time of each file, e.g. from EstimateCost
+    target : float, optional
+        the run time to aim for per job, in the same units as cost.
+        Sets the number of jobs. (Default is 3600)
+
+    Returns
+    -------
+    list of jobs (each a list of files), and the total cost of each job
+    '''
+    cost = np.asarray(cost, dtype='float')
+    njob = int(max(1, min(len(files), np.ceil(np.sum(cost) / target))))
+
+    jobs = [[] for _ in range(njob)]
+    load = [(0., j) for j in range(njob)]
+
+    for k in np.argsort(-cost, kind='mergesort'):
+        tot, j = heapq.heappop(load)
+        jobs[j].append(files[k])
+        heapq.heappush(load, (tot + cost[k], j))
+
+    jcost = np.zeros(njob)
+    for tot, j in load:
+        jcost[j] = tot
+
+    return jobs, jcost
+
+
+def WriteJobs(jobs, chunkdir, prefix='chunk_'):
+    '''
+    Write each job (a list of light curve files) to a chunk list file, to
+    be run by one worker.py process
+
+    Parameters
+    ----------
+    jobs : list of lists of str
+    chunkdir : str
+        where to write the chunk_NNNNN.lis files
+
+    Returns
+    -------
+    list of the chunk file names
+    '''
+    if not os.path.isdir(chunkdir):
+        try:
+            os.makedirs(chunkdir)
+        except OSError:
+            pass
+
+    chunks = []
+    for job in jobs:
+        cname = os.path.join(chunkdir, prefix + str(len(chunks)).zfill(5) + '.lis')
+        fc = open(cname, 'w')
+        for f in job:
+            fc.write(f + '\n')
+        fc.close()
+        chunks.append(cname)
+
+    return chunks
+
+
+def WriteChunks(files, chunkdir, chunksize=500, prefix='chunk_'):
+    '''
+    Split a list of light curve files in to chunk list files of equal
+    length, each to be run by one worker.py process
+
+    Parameters
+    ----------
+    files : list of str
+    chunkdir : str
+        where to write the chunk_NNNNN.lis files
+    chunksize : int, optional
+        number of light curves per chunk (Default is 500)
+
+    Returns
+    -------
+    list of the chunk file names
+    '''
+    jobs = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+    return WriteJobs(jobs, chunkdir, prefix=prefix)
+
+
+def PrepWWU(prefix='', nice=False, bin=10, worker=False, chunksize=500,
+            target=None, secpermb=None):
     '''
     Generate the Condor config file needed to script the running of Appaloosa,
     and the little helper shell script. Built for running on the WWU CS Compute Cluster.
@@ -120,6 +245,18 @@ def PrepWWU(prefix='', nice=False, bin=10):
     prefix : str, optional
         What prefix to call this run. By default a unique string of HEX code is used,
         based on the timestamp.
+    worker : bool, optional
+        If True, each Condor job runs one worker.py process over a chunk
+        of "chunksize" light curves, instead of one python process per
+        light curve. (Default is False)
+    chunksize : int, optional
+        light curves per job in worker mode (Default is 500)
+    target : float, optional
+        If given, pack the light curves in to worker jobs of about this
+        many seconds each (see EstimateCost and PackJobs), instead of
+        using a fixed chunksize. Implies worker=True.
+    secpermb : dict, optional
+        passed to EstimateCost
 
     Returns
     -------
@@ -156,6 +293,26 @@ def PrepWWU(prefix='', nice=False, bin=10):
     # the path to the actual science code
     python_code = home + '/python/appaloosa/appaloosa.py'
 
+    if target is not None:
+        # jobs of about equal run time, rather than equal number of files
+        files = [dir + k for k in kid]
+        cost = [EstimateCost(f, secpermb=secpermb) for f in files]
+        jobs, jcost = PackJobs(files, cost, target=target)
+
+        print(str(len(files)) + ' files packed in to ' + str(len(jobs)) +
+              ' jobs, est. run time per job: ' + str(round(np.min(jcost))) +
+              ' to ' + str(round(np.max(jcost))) + ' sec')
+
+        python_code = home + '/python/appaloosa/worker.py --list'
+        kid = WriteJobs(jobs, workdir + 'chunks/')
+        dir = ''
+
+    elif worker is True:
+        # each job is a list of light curves, run by a single worker
+        python_code = home + '/python/appaloosa/worker.py --list'
+        kid = WriteChunks([dir + k for k in kid], workdir + 'chunks/', chunksize=chunksize)
+        dir = ''
+
     # 2222222222222222 create CONDOR .cfg file
     for i in range(bin):
         if bin is 1:
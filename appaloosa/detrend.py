@@ -3,14 +3,11 @@ Use this file to keep various detrending methods
 
 '''
 import numpy as np
-from pandas import rolling_median #, rolling_mean, rolling_std, rolling_skew
-from scipy.optimize import curve_fit
-from gatspy.periodic import LombScargleFast
-from gatspy.periodic import SuperSmoother
+from rolling import RollingMedian
+from periodogram import LSGrid, LSPower
 # import pywt
-from scipy import signal
-from scipy.interpolate import LSQUnivariateSpline, UnivariateSpline
-import matplotlib.pyplot as plt
+# scipy.optimize, scipy.linalg & gatspy are imported in the functions
+# that use them, to keep the import of this module (and appaloosa) fast
 
 
 def rolling_poly(time, flux, error, order=3, window=0.5):
@@ -18,35 +15,110 @@ def rolling_poly(time, flux, error, order=3, window=0.5):
     Fit polynomials in a sliding window
     Name convention meant to match the pandas rolling_ stats
 
+    Each point is fit with a weighted (w = 1/error) polynomial over all
+    points within +/- window/2 in time. Instead of re-fitting every
+    window from scratch, running sums of the weighted moments
+    (sum w^2 t^k, sum w^2 t^k f) are kept as the window slides, so each
+    point only costs solving a small (order+1)x(order+1) system.
+
     Parameters
     ----------
     time : 1-d numpy array
+        assumes data is already sorted!
     flux : 1-d numpy array
     error : 1-d numpy array
     order : int, optional
     window : float, optional
+        the width of the window, in units of time
 
     Returns
     -------
+    The smoothed flux. Points within window/2 of the start are set to 0.
     '''
 
-    # This is SUPER slow... maybe useful in some places (LLC only?).
-    # Can't be sped up much w/ indexing, because needs to move fixed
-    # windows of time...
-
-    smo = np.zeros_like(flux)
+    smo = np.zeros_like(flux, dtype='float')
 
     w1 = np.where((time >= time[0] + window / 2.0) &
                   (time <= time[-1] + window / 2.0 ))[0]
-
-    for i in range(0,len(w1)):
-        x = np.where((time[w1] >= time[w1][i] - window / 2.0) &
-                     (time[w1] <= time[w1][i] + window / 2.0))
-
-        fit = np.polyfit(time[w1][x], flux[w1][x], order,
-                          w = (1. / error[w1][x]) )
-
-        smo[w1[i]] = np.polyval(fit, time[w1][i])
+    if len(w1) == 0:
+        return smo
+
+    tw = np.array(time[w1], dtype='float')
+    wt = 1. / np.array(error[w1], dtype='float')**2.
+    # subtract off the median to keep the sums well behaved
+    fmed = np.nanmedian(flux[w1])
+    fw = np.array(flux[w1], dtype='float') - fmed
+
+    nc = order + 1
+
+    # the range of points in each output point's window
+    lo = np.searchsorted(tw, tw - window / 2.0, side='left')
+    hi = np.searchsorted(tw, tw + window / 2.0, side='right')
+
+    # binomial coefficients, to shift the moments to each output point
+    binom = np.zeros((2 * nc - 1, 2 * nc - 1))
+    for k in range(2 * nc - 1):
+        binom[k, 0] = 1.
+        for j in range(1, k + 1):
+            binom[k, j] = binom[k - 1, j - 1] + binom[k - 1, j]
+
+    # Work thru the data in blocks one window long. Within each block the
+    # time is measured relative to the block center, in units of window/2,
+    # which keeps the high powers of time in the running sums small.
+    hw = window / 2.0
+    blk = np.floor((tw - tw[0]) / window).astype('int')
+    bedge = np.append(np.where((blk[1:] != blk[:-1]))[0] + 1, [0, len(tw)])
+    bedge = np.unique(bedge)
+
+    for b in range(len(bedge) - 1):
+        o1 = bedge[b]
+        o2 = bedge[b + 1]
+        a = lo[o1]
+        z = hi[o2 - 1]
+
+        tref = tw[0] + (blk[o1] + 0.5) * window
+        u = (tw[a:z] - tref) / hw
+
+        # running (cumulative) moment sums over this block
+        P = np.zeros((2 * nc - 1, z - a + 1))
+        Q = np.zeros((nc, z - a + 1))
+        uk = wt[a:z].copy()
+        for k in range(2 * nc - 1):
+            P[k, 1:] = np.cumsum(uk)
+            if k < nc:
+                Q[k, 1:] = np.cumsum(uk * fw[a:z])
+            uk = uk * u
+
+        # moments within each output window = difference of running sums
+        i1 = lo[o1:o2] - a
+        i2 = hi[o1:o2] - a
+        S = P[:, i2] - P[:, i1]
+        F = Q[:, i2] - Q[:, i1]
+
+        # shift the moments to be centered on each output point
+        uc = -(tw[o1:o2] - tref) / hw
+        M = np.zeros_like(S)
+        N = np.zeros_like(F)
+        for k in range(2 * nc - 1):
+            for j in range(k + 1):
+                M[k] = M[k] + binom[k, j] * S[j] * uc**(k - j)
+                if k < nc:
+                    N[k] = N[k] + binom[k, j] * F[j] * uc**(k - j)
+
+        # normal equations for each output point
+        A = np.zeros((o2 - o1, nc, nc))
+        for r in range(nc):
+            for c in range(nc):
+                A[:, r, c] = M[r + c]
+
+        try:
+            coeff = np.linalg.solve(A, N.T[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # too few points in some window, use least-squares solution
+            coeff = np.einsum('ijk,ik->ij', np.linalg.pinv(A), N.T)
+
+        # centered on each point, so the fit value is just the constant
+        smo[w1[o1:o2]] = coeff[:, 0] + fmed
 
     return smo
 
@@ -71,7 +143,7 @@ def GapFlat(time, flux, order=3, maxgap=0.125):
         krnl = int(float(dl[i]-dr[i]) / 100.0)
         if (krnl < 10):
             krnl = 10
-        flux_sm = rolling_median(flux[dl[i]:dr[i]], krnl)
+        flux_sm = RollingMedian(flux[dl[i]:dr[i]], krnl)
 
         indx = np.isfinite(flux_sm)
 
@@ -109,9 +181,9 @@ def QtrFlat(time, flux, qtr, order=3):
         if (krnl < 10):
             krnl = 10
 
-        flux_sm = rolling_median(np.array(flux[x], dtype='float'), krnl)
+        flux_sm = RollingMedian(flux[x], krnl)
 
-        indx = np.isfinite(flux_sm) # get rid of NaN's put in by rolling_median.
+        indx = np.isfinite(flux_sm) # get rid of NaN's put in by RollingMedian.
 
         fit = np.polyfit(time[x][indx], flux_sm[indx], order)
 
@@ -159,10 +231,46 @@ def _sinfunc2(t, per1, amp1, t01, per2, amp2, t02, yoff):
              np.sin((t - t02) * 2.0 * np.pi / per2) * amp2 + yoff
     return output
 
+def _sinsum(t, *p):
+    # p = [yoff, per1, amp1, t01, per2, amp2, t02, ...]
+    output = np.zeros_like(t) + p[0]
+    for i in range(1, len(p), 3):
+        output = output + np.sin((t - p[i+2]) * 2.0 * np.pi / p[i]) * p[i+1]
+    return output
+
+
+def _SinLinFit(time, flux, pers):
+    '''
+    With the periods fixed, fitting a sum of sin curves is linear:
+    each is a*sin + b*cos, plus one offset for them all.
+    Solve for all of them at once w/ least squares.
+
+    Returns
+    -------
+    the parameters in the form used by _sinsum:
+    [yoff, per1, amp1, t01, per2, amp2, t02, ...]
+    '''
+    A = np.ones((len(time), 2 * len(pers) + 1))
+    for i in range(len(pers)):
+        A[:, 2*i + 1] = np.sin(time * 2.0 * np.pi / pers[i])
+        A[:, 2*i + 2] = np.cos(time * 2.0 * np.pi / pers[i])
+
+    coef = np.linalg.lstsq(A, flux, rcond=-1)[0]
+
+    # a*sin(x) + b*cos(x) = amp * sin(x + phi)
+    pfit = [coef[0]]
+    for i in range(len(pers)):
+        amp = np.hypot(coef[2*i + 1], coef[2*i + 2])
+        phi = np.arctan2(coef[2*i + 2], coef[2*i + 1])
+        pfit = pfit + [pers[i], amp, -phi * pers[i] / (2.0 * np.pi)]
+
+    return pfit
+
 
 def FitSin(time, flux, error, maxnum=5, nper=20000,
            minper=0.1, maxper=30.0, plim=0.25,
-           returnmodel=True, debug=False, per2=False):
+           returnmodel=True, debug=False, per2=False,
+           linear=False, polish=False, grid=None):
     '''
     Use Lomb Scargle to find periods, fit sins, remove, repeat.
 
@@ -178,10 +286,23 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
     maxper:
     plim:
     debug:
+    linear: bool, optional
+        If True, fix each period at the Lomb Scargle peak, and solve for
+        the amplitudes & phases of ALL periods found so far at once with
+        linear least squares, instead of a nonlinear fit of each sin.
+        Much faster, and can't fail to converge. (Default is False)
+    polish: bool, optional
+        If linear=True, finish with one nonlinear fit of all the sin
+        curves (periods free), starting from the linear solution.
+        (Default is False)
+    grid: dict, optional
+        The output of periodogram.LSGrid for this time & error, if already
+        computed. Otherwise it is made here, once for all the passes.
 
     Returns
     -------
     '''
+    from scipy.optimize import curve_fit
     # periods = np.linspace(minper, maxper, nper)
 
     flux_out = np.array(flux, copy=True)
@@ -193,22 +314,22 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
     medflux = np.nanmedian(flux)
     # ti = time[dl[i]:dr[i]]
 
-    for k in range(0, maxnum):
-        # Use Jake Vanderplas faster version!
-        pgram = LombScargleFast(fit_offset=False)
-        pgram.optimizer.set(period_range=(minper,maxper))
-        pgram = pgram.fit(time,
-                          flux_out - medflux,
-                          error)
+    # for linear=True, the periods found so far, and the joint fit to them
+    pers = []
+    pfit_lin = [0.]
 
-        df = (1./minper - 1./maxper) / nper
-        f0 = 1./maxper
-        pwr = pgram.score_frequency_grid(f0, df, nper)
+    # the frequency grid & time sampling terms are the same for every pass
+    if grid is None:
+        grid = LSGrid(time, error, minper=minper, maxper=maxper, nper=nper)
 
-        freq = f0 + df * np.arange(nper)
-        per = 1./freq
+    per = grid['per']
+    pok = np.where((per < dt) & (per > minper))
+
+    for k in range(0, maxnum):
+        # same fast algorithm as Jake Vanderplas' gatspy version,
+        # only the residual flux changes between passes
+        pwr = LSPower(grid, flux_out - medflux)
 
-        pok = np.where((per < dt) & (per > minper))
         pk = per[pok][np.argmax(pwr[pok])]
         pp = np.max(pwr)
 
@@ -219,7 +340,14 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
         # if a period w/ enough power is detected
         if (pp > plim):
             # fit sin curve to window and subtract
-            if per2 is True:
+            if linear is True:
+                pers.append(pk)
+                if per2 is True:
+                    pers.append(pk/2.)
+                pfit_lin = _SinLinFit(time, flux-medflux, pers)
+                flux_out = flux - _sinsum(time, *pfit_lin)
+
+            elif per2 is True:
                 p0 = [pk, 3.0 * np.nanstd(flux_out-medflux), 0.0,
                       pk/2., 1.5 * np.nanstd(flux_out-medflux), 0.1, 0.0]
                 try:
@@ -246,9 +374,25 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
                 flux_out = flux_out - _sinfunc(time, *pfit)
                 sin_out = sin_out + _sinfunc(time, *pfit)
 
+        elif linear is True:
+            # nothing was removed, so every later trial finds the same peak
+            sin_out = sin_out + medflux * (maxnum - k)
+            break
+
         # add the median flux for this window BACK in
         sin_out = sin_out + medflux
 
+    if linear is True:
+        if (polish is True) and (len(pers) > 0):
+            try:
+                pfit_lin, pcov = curve_fit(_sinsum, time, flux-medflux, p0=pfit_lin)
+            except RuntimeError:
+                if debug is True:
+                    print('Curve_Fit polish no good, keeping linear fit')
+
+        flux_out = flux - _sinsum(time, *pfit_lin)
+        sin_out = sin_out + _sinsum(time, *pfit_lin)
+
     # if debug is True:
     #     plt.figure()
     #     plt.plot(time, flux)
@@ -280,6 +424,7 @@ def FitMedSin(time, flux, error, nper=20000,
 
     
     # Use Jake Vanderplas supersmoother version
+    from gatspy.periodic import SuperSmoother
     pgram = SuperSmoother()
     pgram.optimizer.period_range=(minper,maxper)
     pgram = pgram.fit(time,
@@ -356,7 +501,7 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
     # now take N passes of rejection on it
     for k in range(0, numpass):
         # rolling median in this data span with the kernel size
-        flux_i_sm = rolling_median(flux_i, nptsmooth, center=True)
+        flux_i_sm = RollingMedian(flux_i, nptsmooth, center=True)
         indx = np.isfinite(flux_i_sm)
 
         if (sum(indx) > 1):
@@ -388,26 +533,89 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
         return np.array(indx_out, dtype='int')
 
 
-def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=False):
+def _BsplineBasis(x, knots, order=3):
+    '''
+    Evaluate the (order+1) non-zero B-spline basis functions at each x,
+    using the Cox-de Boor recursion on all points at once.
+
+    Parameters
+    ----------
+    x : 1-d numpy array
+        must be within the range of knots
+    knots : 1-d numpy array
+        the full knot vector, with (order+1) repeated knots at each end
+    order : int, optional
+
+    Returns
+    -------
+    basis : (len(x), order+1) array
+        value of basis functions (span-order) to (span) at each x
+    span : int array
+        the knot span index for each x
+    '''
+    ncoef = len(knots) - order - 1
+
+    span = np.searchsorted(knots, x, side='right') - 1
+    span = np.clip(span, order, ncoef - 1)
+
+    basis = np.zeros((len(x), order + 1))
+    basis[:, 0] = 1.
+    left = np.zeros((len(x), order + 1))
+    right = np.zeros((len(x), order + 1))
+
+    for j in range(1, order + 1):
+        left[:, j] = x - knots[span + 1 - j]
+        right[:, j] = knots[span + j] - x
+        saved = np.zeros(len(x))
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+
+    return basis, span
+
+
+def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3,
+               tol=1e-4, debug=False):
     '''
     IRLS = Iterative Re-weight Least Squares
 
+    A least-squares spline with evenly spaced knots is fit, then the
+    weights are updated to down-weight outliers, and the fit repeated.
+
+    The B-spline basis is only evaluated once. Each pass just re-builds
+    the (banded) weighted normal equations and solves them with a banded
+    Cholesky decomposition. The weights are the same as would be given
+    to scipy.interpolate.LSQUnivariateSpline.
+
     Parameters
     ----------
     time
     flux
     error
     Q
-    ksep
-    numpass
+    ksep : float, optional
+        the spacing between knots, in units of time
+    numpass : int, optional
+        the maximum number of re-weighting passes
     order
+    tol : float, optional
+        stop early once the weights change by less than this fraction
+        between passes (Default is 1e-4). Set to 0 to always use numpass
 
     Returns
     -------
-
+    The spline model evaluated at each time
     '''
+    from scipy.linalg import cholesky_banded, cho_solve_banded
+
     weight = 1. / (error**2.0)
 
+    if not (np.all(np.isfinite(time)) and np.all(np.isfinite(flux)) and
+            np.all(np.isfinite(weight))):
+        raise ValueError('IRLSSpline: array must not contain infs or NaNs')
+
     knots = np.arange(np.nanmin(time) + ksep, np.nanmax(time) - ksep, ksep)
 
     if debug is True:
@@ -422,15 +630,54 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
         # plt.scatter(knots, knots*0. + np.median(flux))
         # plt.show()
 
+    # the full knot vector, same end conditions as LSQUnivariateSpline
+    tk = np.concatenate((np.zeros(order + 1) + time[0], knots,
+                         np.zeros(order + 1) + time[-1]))
+    ncoef = len(tk) - order - 1
+
+    # build the basis ONCE
+    basis, span = _BsplineBasis(time, tk, order=order)
+    col = span - order # the 1st non-zero coefficient for each point
+
     for k in range(numpass):
-        spl = LSQUnivariateSpline(time, flux, knots, k=order, check_finite=True, w=weight)
-        # spl = UnivariateSpline(time, flux, w=weight, k=order, s=1)
+        # LSQUnivariateSpline minimizes sum((w * (y - s))^2)
+        wt2 = weight**2.0
+
+        # weighted normal eqns, in upper banded form for cholesky_banded
+        ab = np.zeros((order + 1, ncoef))
+        rhs = np.zeros(ncoef)
+        for a in range(order + 1):
+            wb = wt2 * basis[:, a]
+            rhs = rhs + np.bincount(col + a, weights=wb * flux, minlength=ncoef)
+            for b in range(a, order + 1):
+                ab[order + a - b, :] += np.bincount(col + b, weights=wb * basis[:, b],
+                                                    minlength=ncoef)
 
-        chisq = ((flux - spl(time))**2.) / (error**2.0)
+        try:
+            cfac = cholesky_banded(ab, lower=False)
+        except np.linalg.LinAlgError:
+            # knots w/ no data inside them (e.g. small gaps). Their coefficients
+            # don't touch any data, so just nudge the diagonal to make solvable
+            ab[order, :] += 1e-10 * np.max(ab[order, :])
+            cfac = cholesky_banded(ab, lower=False)
+        coef = cho_solve_banded((cfac, False), rhs)
+
+        model = np.sum(basis * coef[col[:, np.newaxis] + np.arange(order + 1)], axis=1)
+
+        chisq = ((flux - model)**2.) / (error**2.0)
+
+        weight_new = Q / ((error**2.0) * (chisq + Q))
+
+        dw = np.max(np.abs(weight_new - weight) / weight)
+        weight = weight_new
+
+        if debug is True:
+            print('IRLSSpline: pass ' + str(k) + ', max weight change = ' + str(dw))
 
-        weight = Q / ((error**2.0) * (chisq + Q))
+        if dw < tol:
+            break
 
-    return spl(time)
+    return model
 
 
 
@@ -0,0 +1,201 @@
+'''
+Completeness emulator: predict the ED68 & ED90 limits of a light curve
+segment from its cadence, length and noise, instead of running FakeFlares.
+
+The emulator is a linear fit of log10(ED68) and log10(ED90) against
+log10 of the segment's median relative error, duration (days) and
+cadence (minutes), trained on the .fake files from past runs. Each
+prediction comes with an uncertainty (in dex), so RunLC can fall back to
+the full fake flare test when the emulator is unsure.
+
+Build one from a list of .fake files, made e.g. like so:
+$ find aprun/* -name "*.fake" > fakes.lis
+$ python emulator.py fakes.lis emulator.npz
+'''
+
+import numpy as np
+
+# Kepler short & long cadence, in minutes
+_SLC = 54.2 / 60.
+_LLC = 30 * 54.2 / 60.
+
+
+def SegmentFeatures(std, dur, cadence):
+    '''
+    The emulator's features for each segment.
+
+    Parameters
+    ----------
+    std : float or array
+        median error of the segment, in relative flux units
+    dur : float or array
+        length of the segment in days
+    cadence : float or array
+        exposure time in minutes
+
+    Returns
+    -------
+    2-d array, one row per segment: (1, log std, log dur, log cadence)
+    '''
+    std = np.atleast_1d(np.asarray(std, dtype='float'))
+    dur = np.atleast_1d(np.asarray(dur, dtype='float'))
+    cadence = np.atleast_1d(np.asarray(cadence, dtype='float'))
+
+    return np.column_stack((np.ones(len(std)), np.log10(std),
+                            np.log10(dur), np.log10(cadence)))
+
+
+def ReadFakeCorpus(fakelist, cadence=None):
+    '''
+    Read the per-segment results from many .fake files
+
+    Only the summary lines are used (t_min, t_max, std, nfake, amplmin,
+    amplmax, durmin, durmax, ed68, ed90): "#" comment lines, the extra
+    verbose lines, segments where the limits were not found (-99), and
+    lines from the emulator itself (nfake = 0) are skipped.
+
+    Parameters
+    ----------
+    fakelist : str or list
+        A file with one .fake path per line, or a list of paths
+    cadence : float, optional
+        Exposure time in minutes. By default it is taken from the file
+        name, short cadence if it contains "slc", long cadence otherwise
+        (the same rule as postprocess.PostCondor)
+
+    Returns
+    -------
+    std, dur, cadence, ed68, ed90 : arrays, one value per segment
+    '''
+    if isinstance(fakelist, str):
+        files = np.loadtxt(fakelist, dtype='str', ndmin=1)
+    else:
+        files = fakelist
+
+    rows = []
+    for fname in files:
+        if cadence is None:
+            if (fname.find('slc') == -1):
+                cad = _LLC
+            else:
+                cad = _SLC
+        else:
+            cad = cadence
+
+        ff = open(fname, 'r')
+        for line in ff:
+            if line.startswith('#'):
+                continue
+            cols = line.split(',')
+            if len(cols) != 10:
+                continue
+            try:
+                vals = [float(c) for c in cols]
+            except ValueError:
+                continue
+
+            tmin, tmax, std, nfake = vals[0:4]
+            ed68, ed90 = vals[8:10]
+            if (nfake > 0) and (ed68 > 0) and (ed90 > 0) and (std > 0) and (tmax > tmin):
+                rows.append((std, tmax - tmin, cad, ed68, ed90))
+        ff.close()
+
+    rows = np.array(rows, dtype='float').reshape(-1, 5)
+    return rows[:,0], rows[:,1], rows[:,2], rows[:,3], rows[:,4]
+
+
+def FitEmulator(fakelist, cadence=None, outfile=None):
+    '''
+    Fit the emulator to a corpus of .fake files (see ReadFakeCorpus)
+
+    Parameters
+    ----------
+    fakelist : str or list
+    cadence : float, optional
+    outfile : str, optional
+        If given, save the emulator here (as .npz) for LoadEmulator
+
+    Returns
+    -------
+    dict with the fit coefficients ('coef', one column each for ED68 &
+    ED90), the scaled covariance ('xtxi'), the rms scatter in dex ('rms')
+    and the number of segments used ('nseg')
+    '''
+    std, dur, cad, ed68, ed90 = ReadFakeCorpus(fakelist, cadence=cadence)
+
+    X = SegmentFeatures(std, dur, cad)
+    Y = np.column_stack((np.log10(ed68), np.log10(ed90)))
+
+    nseg, nfeat = X.shape
+    if nseg <= nfeat:
+        raise ValueError('FitEmulator: need more than ' + str(nfeat) +
+                         ' segments, found ' + str(nseg))
+
+    # use pinv, in case e.g. all segments have the same cadence
+    xtxi = np.linalg.pinv(np.dot(X.T, X))
+    coef = np.dot(xtxi, np.dot(X.T, Y))
+
+    resid = Y - np.dot(X, coef)
+    rms = np.sqrt(np.sum(resid**2., axis=0) / (nseg - nfeat))
+
+    emu = {'coef':coef, 'xtxi':xtxi, 'rms':rms, 'nseg':nseg}
+
+    if outfile is not None:
+        SaveEmulator(emu, outfile)
+
+    return emu
+
+
+def SaveEmulator(emu, outfile):
+    '''
+    Save the emulator from FitEmulator to an .npz file
+    '''
+    np.savez(outfile, coef=emu['coef'], xtxi=emu['xtxi'], rms=emu['rms'],
+             nseg=emu['nseg'])
+    return
+
+
+def LoadEmulator(file):
+    '''
+    Read an emulator saved by SaveEmulator
+    '''
+    data = np.load(file)
+    emu = {'coef':data['coef'], 'xtxi':data['xtxi'], 'rms':data['rms'],
+           'nseg':int(data['nseg'])}
+    data.close()
+    return emu
+
+
+def PredictED(emu, std, dur, cadence):
+    '''
+    Predict the ED68 & ED90 limits (in seconds) for segments
+
+    Parameters
+    ----------
+    emu : dict
+        from FitEmulator or LoadEmulator
+    std, dur, cadence : float or array
+        see SegmentFeatures
+
+    Returns
+    -------
+    ed68, ed90, sig68, sig90 : arrays
+        the predicted limits, and their 1-sigma prediction uncertainty
+        in dex (the fit scatter plus the uncertainty of the fit itself)
+    '''
+    X = SegmentFeatures(std, dur, cadence)
+    logED = np.dot(X, emu['coef'])
+
+    lever = np.sum(np.dot(X, emu['xtxi']) * X, axis=1)
+    sig = emu['rms'][np.newaxis, :] * np.sqrt(1. + lever)[:, np.newaxis]
+
+    return 10.**logED[:,0], 10.**logED[:,1], sig[:,0], sig[:,1]
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python emulator.py fakes.lis emulator.npz
+if __name__ == "__main__":
+    import sys
+    emu = FitEmulator(sys.argv[1], outfile=sys.argv[2])
+    print('FitEmulator: ' + str(emu['nseg']) + ' segments, rms = ' +
+          str(emu['rms'][0]) + ' (ED68), ' + str(emu['rms'][1]) + ' (ED90) dex')
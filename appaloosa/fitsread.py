@@ -0,0 +1,291 @@
+'''
+Lean reader for FITS binary tables, e.g. Kepler/K2 light curve files.
+
+Only does what GetLCfits & GetLCeverest need: find a binary table
+extension, and pull out a few columns. The file is memory mapped and the
+table is viewed in place as big-endian records, so only the columns that
+are asked for get decoded. The rows to keep (e.g. finite flux) are found
+once, and each column is gathered & byte swapped in to a native array in
+a single pass, with no intermediate copies.
+
+Running totals of the bytes read are kept in STATS, e.g. to report the
+I/O per light curve in batch runs.
+'''
+
+import os
+import mmap
+import gzip
+import threading
+import numpy as np
+
+_BLOCK = 2880
+_CARD = 80
+
+# bytes per element for each binary table TFORM code
+_TFORM_SIZE = {'L':1, 'X':1, 'B':1, 'I':2, 'J':4, 'K':8, 'A':1,
+               'E':4, 'D':8, 'C':8, 'M':16, 'P':8, 'Q':16}
+_TFORM_DTYPE = {'L':'i1', 'B':'u1', 'I':'>i2', 'J':'>i4', 'K':'>i8', 'A':'S1',
+                'E':'>f4', 'D':'>f8', 'C':'>c8', 'M':'>c16'}
+
+# running totals: files read, header bytes, table bytes mapped, and the
+# bytes of the columns actually decoded
+STATS = {'nfile':0, 'header_bytes':0, 'data_bytes':0, 'col_bytes':0}
+_LOCK = threading.Lock()
+
+
+def _ParseHeader(buf, pos):
+    '''
+    Read the header that starts at byte pos
+
+    Returns
+    -------
+    dict of keyword: value, and the byte where the data starts
+    '''
+    hdr = {}
+    while True:
+        if pos + _BLOCK > len(buf):
+            raise ValueError('fitsread: header runs past the end of the file')
+        block = bytes(buf[pos:pos + _BLOCK]).decode('ascii', 'replace')
+        pos = pos + _BLOCK
+
+        for k in range(0, _BLOCK, _CARD):
+            card = block[k:k + _CARD]
+            key = card[0:8].strip()
+            if key == 'END':
+                return hdr, pos
+            if card[8:10] != '= ':
+                continue
+
+            val = card[10:]
+            if val.lstrip().startswith("'"):
+                # string, '' is an escaped quote
+                val = val.lstrip()[1:]
+                end = val.find("'")
+                while (end > -1) and (val[end + 1:end + 2] == "'"):
+                    end = val.find("'", end + 2)
+                hdr[key] = val[:end].replace("''", "'").rstrip()
+            else:
+                val = val.split('/')[0].strip()
+                if val in ('T', 'F'):
+                    hdr[key] = (val == 'T')
+                else:
+                    try:
+                        hdr[key] = int(val)
+                    except ValueError:
+                        try:
+                            hdr[key] = float(val)
+                        except ValueError:
+                            hdr[key] = val
+
+
+def _DataSize(hdr):
+    '''
+    Size in bytes of the data part of an HDU, padded to whole blocks
+    '''
+    naxis = hdr.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    n = 1
+    for k in range(1, naxis + 1):
+        n = n * hdr['NAXIS' + str(k)]
+    n = (n + hdr.get('PCOUNT', 0)) * hdr.get('GCOUNT', 1) * abs(hdr['BITPIX']) // 8
+    return ((n + _BLOCK - 1) // _BLOCK) * _BLOCK
+
+
+def _TableDtype(hdr):
+    '''
+    numpy (big-endian) record dtype for a binary table's rows
+    '''
+    names = []
+    formats = []
+    offsets = []
+    off = 0
+    for k in range(1, hdr['TFIELDS'] + 1):
+        tform = hdr['TFORM' + str(k)].strip()
+        j = 0
+        while (j < len(tform)) and tform[j].isdigit():
+            j = j + 1
+        repeat = int(tform[:j]) if j > 0 else 1
+        code = tform[j]
+
+        if code == 'X':
+            size = (repeat + 7) // 8
+        else:
+            size = repeat * _TFORM_SIZE[code]
+
+        name = hdr.get('TTYPE' + str(k), 'COL' + str(k)).strip()
+        if (code in _TFORM_DTYPE) and (size > 0):
+            fmt = _TFORM_DTYPE[code]
+            if code == 'A':
+                fmt = 'S' + str(repeat)
+            elif repeat > 1:
+                fmt = (fmt, (repeat,))
+            names.append(name)
+            formats.append(fmt)
+            offsets.append(off)
+        off = off + size
+
+    return np.dtype({'names':names, 'formats':formats, 'offsets':offsets,
+                     'itemsize':hdr['NAXIS1']})
+
+
+def _OpenBuffer(file):
+    '''
+    The bytes of the file, memory mapped if it is a plain file on disk
+
+    Returns
+    -------
+    buffer, and a function to call when done with it
+    '''
+    if not isinstance(file, str):
+        # already open, e.g. a member of a tarball
+        data = file.read()
+        return data, lambda: None
+
+    f = open(file, 'rb')
+    if f.read(2) == b'\x1f\x8b':
+        f.close()
+        f = gzip.GzipFile(file, 'rb')
+        data = f.read()
+        f.close()
+        return data, lambda: None
+
+    if os.fstat(f.fileno()).st_size == 0:
+        f.close()
+        raise ValueError('fitsread: ' + file + ' is empty')
+
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close():
+        try:
+            mm.close()
+        finally:
+            f.close()
+
+    return mm, _close
+
+
+def ReadBintable(file, columns, finite=None, ext=1, dtypes=None, info=None):
+    '''
+    Read some of the columns of a FITS binary table
+
+    Parameters
+    ----------
+    file : str or file object
+    columns : list of str
+        the column names (TTYPE) to read
+    finite : list of str, optional
+        only keep the rows where all of these columns are finite
+    ext : int or str, optional
+        the extension number, or its EXTNAME (Default is 1)
+    dtypes : dict, optional
+        output dtype for any of the columns. By default each column is
+        returned as the native byte order version of its FITS type.
+    info : dict, optional
+        If given, filled with the number of rows ('nrows', 'nkeep') and
+        bytes read ('header_bytes', 'data_bytes', 'col_bytes')
+
+    Returns
+    -------
+    list of native arrays, one per column
+    '''
+    buf, close = _OpenBuffer(file)
+    table = None
+    col = None
+    try:
+        pos = 0
+        iext = 0
+        hdr, pos = _ParseHeader(buf, pos)
+        hbytes = pos
+        while True:
+            if isinstance(ext, int):
+                found = (iext == ext)
+            else:
+                found = (iext > 0) and (hdr.get('EXTNAME', '').upper() == ext.upper())
+            if found:
+                break
+            pos = pos + _DataSize(hdr)
+            iext = iext + 1
+            if pos >= len(buf):
+                raise ValueError('fitsread: extension ' + str(ext) + ' not found')
+            start = pos
+            hdr, pos = _ParseHeader(buf, pos)
+            hbytes = hbytes + pos - start
+
+        if hdr.get('XTENSION', '').strip() != 'BINTABLE':
+            raise ValueError('fitsread: extension ' + str(ext) + ' is not a binary table')
+
+        nrows = hdr['NAXIS2']
+        rowdt = _TableDtype(hdr)
+        table = np.frombuffer(buf, dtype=rowdt, count=nrows, offset=pos)
+
+        for name in columns:
+            if name not in rowdt.names:
+                raise KeyError('fitsread: no column ' + name)
+
+        # the rows to keep, found once for all the columns
+        if finite:
+            ok = np.ones(nrows, dtype='bool')
+            for name in finite:
+                ok &= np.isfinite(table[name])
+            keep = np.flatnonzero(ok)
+        else:
+            keep = None
+
+        out = []
+        cbytes = 0
+        for name in columns:
+            col = table[name]
+            if (dtypes is not None) and (name in dtypes):
+                dt = np.dtype(dtypes[name])
+            else:
+                dt = col.dtype.newbyteorder('=')
+
+            if keep is None:
+                arr = col.astype(dt)
+            else:
+                # gather the kept rows in the file's byte order, then cast
+                # (np.take can't cast in to an out array of another type)
+                arr = col[keep].astype(dt)
+            out.append(arr)
+            cbytes = cbytes + col.dtype.itemsize * nrows
+
+    except BaseException:
+        table = None
+        col = None
+        try:
+            close()
+        except BufferError:
+            # the traceback can still hold views of the memory map, which
+            # is then freed along with them. Raise the real error instead.
+            pass
+        raise
+
+    # no views of the memory map can be left when it is closed
+    table = None
+    col = None
+    close()
+
+    nkeep = nrows if keep is None else len(keep)
+    with _LOCK:
+        STATS['nfile'] += 1
+        STATS['header_bytes'] += hbytes
+        STATS['data_bytes'] += nrows * rowdt.itemsize
+        STATS['col_bytes'] += cbytes
+
+    if info is not None:
+        info.update({'nrows':nrows, 'nkeep':nkeep, 'header_bytes':hbytes,
+                     'data_bytes':nrows * rowdt.itemsize, 'col_bytes':cbytes})
+
+    return out
+
+
+def ResetStats():
+    '''
+    Set the STATS counters back to 0, and return what they were
+    '''
+    with _LOCK:
+        old = dict(STATS)
+        for key in STATS:
+            STATS[key] = 0
+    return old
@@ -0,0 +1,181 @@
+'''
+Fit the single-peak analytic flare model (aflare1) to flare candidates
+
+FitFlare is used by FlareStats & FlareStatsBatch in place of a plain
+curve_fit call. It is a small Levenberg-Marquardt solver that uses the
+analytic Jacobian from aflare.aflare1_jac, keeps the parameters within
+physical bounds, starts from the measured tpeak/FWHM/amplitude, and gives
+up after a set number of model evaluations, so bad candidates fail
+quickly. A wall time limit can also be set, but then the results depend
+on the machine (and its load), so it is off by default.
+'''
+
+import numpy as np
+import time as _time
+from aflare import aflare1_jac, _aflare1_shape
+
+
+def FitFlare(time, flux, p0, error=None, maxfev=200, maxtime=None,
+             window=None, xtol=1e-4, ftol=1e-6, full_output=False):
+    '''
+    Fit one flare with the aflare1 model, by bounded least squares.
+
+    Parameters
+    ----------
+    time : 1-d array
+    flux : 1-d array
+        The flare flux with the continuum removed, in relative units
+    p0 : 3 element array
+        The starting guess (tpeak, fwhm, ampl), e.g. the values measured
+        directly from the light curve in FlareStats. Non-finite values
+        are replaced by simple estimates from the data.
+    error : 1-d array, optional
+        If given, the residuals are weighted by 1/error. (Default is
+        equal weights, as the old curve_fit call did)
+    maxfev : int, optional
+        The maximum number of model evaluations (Default is 200)
+    maxtime : float, optional
+        The maximum wall time for the fit, in seconds. Fits that hit it
+        depend on the machine's speed and load, so results are only
+        reproducible without it. (Default is None, no limit)
+    window : 2 element array, optional
+        If given, only fit the points from tpeak - window[0]*fwhm to
+        tpeak + window[1]*fwhm of the starting guess. (Default is None,
+        use all the points)
+    xtol : float, optional
+        Stop when the step in every parameter is smaller than this
+        fraction of the fwhm (or amplitude). (Default is 1e-4)
+    ftol : float, optional
+        Stop when the fractional change in chisq is smaller than this.
+        (Default is 1e-6)
+    full_output : bool, optional
+        If True, also return a dict with the exit 'status' ('ok', 'bad',
+        'maxfev' or 'timeout'), the number of model evaluations ('nfev'),
+        and the wall time used ('time'). (Default is False)
+
+    Returns
+    -------
+    popt : array of best fit (tpeak, fwhm, ampl). Same flag values as
+        FlareStats: NaN's if the data could not be fit (e.g. too few
+        points), and -99's if the fit did not converge within the budget.
+    '''
+    t0 = _time.time()
+
+    time = np.asarray(time, dtype='float')
+    flux = np.asarray(flux, dtype='float')
+    if error is None:
+        wt = np.ones_like(flux)
+    else:
+        wt = 1. / np.asarray(error, dtype='float')
+
+    p0 = np.array(p0, dtype='float')
+
+    ok = np.isfinite(time) & np.isfinite(flux) & np.isfinite(wt)
+    if (window is not None) and np.all(np.isfinite(p0[0:2])) and (p0[1] > 0):
+        ok = ok & (time >= p0[0] - window[0] * p0[1]) & \
+             (time <= p0[0] + window[1] * p0[1])
+
+    time = time[ok]
+    flux = flux[ok]
+    wt = wt[ok]
+
+    info = {'status':'ok', 'nfev':0, 'time':0.}
+    popt = np.array([np.nan, np.nan, np.nan])
+
+    # need at least as many points as parameters
+    if len(time) < 3:
+        info['status'] = 'bad'
+        info['time'] = _time.time() - t0
+        if full_output is True:
+            return popt, info
+        return popt
+
+    tmin = np.min(time)
+    tmax = np.max(time)
+    dt = np.median(np.diff(np.sort(time)))
+    if not (dt > 0):
+        dt = (tmax - tmin) / len(time)
+
+    # physical limits: peak within the data, positive amplitude, and a
+    # width of at least a tenth of the cadence
+    lo = np.array([tmin, dt * 0.1, 0.])
+    hi = np.array([tmax, (tmax - tmin) * 10. + dt, np.inf])
+
+    # warm start from the measured values, filling in anything missing
+    guess = np.array([time[np.argmax(flux)], (tmax - tmin) / 4., np.max(flux)])
+    bad = ~np.isfinite(p0) | ((p0 <= lo) & (np.arange(3) > 0))
+    p0[bad] = guess[bad]
+    p0 = np.clip(p0, lo, hi)
+
+    def _resid(p):
+        # same as aflare1(time, *p), without the np.piecewise overhead
+        return (_aflare1_shape((time - p[0]) / p[1]) * np.abs(p[2]) - flux) * wt
+
+    # bounded Levenberg-Marquardt. With only 3 parameters each step is a
+    # 3x3 solve, so this is much lighter than the general purpose solvers
+    r = _resid(p0)
+    cost = np.dot(r, r)
+    info['nfev'] = 1
+    lam = 1e-3
+    done = False
+
+    while not done:
+        if (maxtime is not None) and (_time.time() - t0 > maxtime):
+            info['status'] = 'timeout'
+            break
+        if info['nfev'] >= maxfev:
+            info['status'] = 'maxfev'
+            break
+
+        J = aflare1_jac(time, p0[0], p0[1], p0[2]) * wt[:, np.newaxis]
+        A = np.dot(J.T, J)
+        g = np.dot(J.T, r)
+        dA = np.diag(A) + 1e-30
+
+        # hold any parameter that is at a bound & being pushed past it
+        free = ~(((p0 <= lo) & (g > 0)) | ((p0 >= hi) & (g < 0)))
+        if np.sum(free) == 0:
+            done = True
+            break
+        Af = A[free][:, free]
+
+        # increase the damping until a step lowers the chisq
+        while info['nfev'] < maxfev:
+            dp = np.zeros(3)
+            try:
+                dp[free] = -np.linalg.solve(Af + lam * np.diag(dA[free]), g[free])
+            except np.linalg.LinAlgError:
+                lam = lam * 10.
+                continue
+
+            p1 = np.clip(p0 + dp, lo, hi)
+            r1 = _resid(p1)
+            cost1 = np.dot(r1, r1)
+            info['nfev'] += 1
+
+            if np.isfinite(cost1) and (cost1 <= cost):
+                # converged if the step (in units of fwhm & ampl) or the
+                # change in chisq is tiny
+                dstep = np.abs(p1 - p0) / np.array([p0[1], p0[1], max(p0[2], 1e-30)])
+                if (np.max(dstep) < xtol) or (cost - cost1 <= ftol * cost):
+                    done = True
+                p0, r, cost = p1, r1, cost1
+                lam = max(lam / 10., 1e-10)
+                break
+
+            lam = lam * 10.
+            if lam > 1e10:
+                # can't go any further downhill
+                done = True
+                break
+
+    if done is True:
+        popt = p0
+    else:
+        popt = np.array([-99., -99., -99.])
+
+    info['time'] = _time.time() - t0
+
+    if full_output is True:
+        return popt, info
+    return popt
@@ -0,0 +1,90 @@
+'''
+Sorted interval index, for finding which points fall inside any of a set
+of (possibly overlapping) [start, stop] intervals, e.g. flare events.
+
+The intervals are sorted by start time, and the running maximum of the
+stop times is kept. A point x is inside some interval if, of all the
+intervals that start at or before x, the furthest reaching one gets to x.
+That makes each lookup one searchsorted, for any number of intervals.
+
+Used by FakeFlares to place fake flares away from the known flares, and
+to match fake flares to the recovered events.
+'''
+
+import numpy as np
+
+
+def IntervalIndex(tstart, tstop):
+    '''
+    Build the index for a set of closed intervals [tstart, tstop].
+
+    Parameters
+    ----------
+    tstart : array
+    tstop : array
+
+    Returns
+    -------
+    (starts, reach) : sorted start times, and the running max of the
+        stop times in that order
+    '''
+    tstart = np.asarray(tstart, dtype='float').ravel()
+    tstop = np.asarray(tstop, dtype='float').ravel()
+
+    srt = np.argsort(tstart, kind='mergesort')
+    starts = tstart[srt]
+    reach = np.maximum.accumulate(tstop[srt]) if len(srt) > 0 else tstop[srt]
+
+    return starts, reach
+
+
+def InIntervals(x, index):
+    '''
+    Is each x inside (or on the edge of) any of the intervals?
+
+    Parameters
+    ----------
+    x : array
+    index : tuple
+        from IntervalIndex
+
+    Returns
+    -------
+    boolean array, same length as x
+    '''
+    starts, reach = index
+    x = np.asarray(x, dtype='float')
+
+    if len(starts) == 0:
+        return np.zeros(x.shape, dtype='bool')
+
+    # the last interval that starts at or before each x
+    j = np.searchsorted(starts, x, side='right') - 1
+    return (j >= 0) & (reach[np.maximum(j, 0)] >= x)
+
+
+def SampleOutside(x, index, n, rng=np.random):
+    '''
+    Draw n values of x (with replacement, all equally likely) from the
+    ones that are NOT inside any interval.
+
+    Parameters
+    ----------
+    x : array
+        e.g. the time array of a light curve
+    index : tuple
+        from IntervalIndex
+    n : int
+    rng : numpy RandomState, optional
+
+    Returns
+    -------
+    array of n values from x
+    '''
+    x = np.asarray(x)
+    ok = np.where(~InIntervals(x, index))[0]
+
+    if len(ok) == 0:
+        raise ValueError('SampleOutside: every point is inside an interval')
+
+    return x[ok[rng.randint(0, len(ok), n)]]
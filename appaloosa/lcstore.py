@@ -0,0 +1,333 @@
+'''
+Star-major light curve store, built from the quarter-major Kepler archive.
+
+The archive comes one quarter (and one FITS file per star) at a time, see
+misc/getdata.sh & misc/unpackdata.sh. BuildStore reads through all of
+the FITS files once and writes every star's data from every quarter
+next to each other, in one .npy file per column:
+
+    time.npy, sap_flux.npy, sap_flux_err.npy, pdcsap_flux.npy,
+    pdcsap_flux_err.npy, sap_quality.npy, lcflag.npy, quarter.npy
+
+plus index.npy, with the KIC, first row and number of rows for each star
+(sorted by KIC). Within a star the rows are in order of quarter, cadence
+(short first) and time. lcflag follows the database convention: 0 for
+short cadence, 1 for long cadence.
+
+The columns are opened as memory maps, so reading a star is a slice of
+each column with no copy, and only the pages for that star are read
+from disk.
+
+Build a store from a list of FITS files, e.g.:
+$ find Q*_public/ -name '*.fits' > all_fits.lis
+$ python lcstore.py all_fits.lis kepler_store/
+
+then run appaloosa on any star, with all of its quarters at once:
+>>> RunLC(file='kepler_store/', objectid='10000490', dbmode='store')
+
+or, as the batch drivers (batch.py, worker.py, taskqueue.py) do, with
+the star given in the file name as "storedir::KIC":
+>>> RunLC(file='kepler_store/::10000490', dbmode='store')
+
+A list of these for every star in a store can be made with:
+$ python lcstore.py jobs kepler_store/ > store_jobs.lis
+$ python batch.py --list store_jobs.lis --dbmode store -j 32
+'''
+
+import os
+import sys
+import numpy as np
+
+# column name in the store: (FITS column name, dtype)
+_COLUMNS = {'time':('TIME', 'float64'),
+            'sap_flux':('SAP_FLUX', 'float32'),
+            'sap_flux_err':('SAP_FLUX_ERR', 'float32'),
+            'pdcsap_flux':('PDCSAP_FLUX', 'float32'),
+            'pdcsap_flux_err':('PDCSAP_FLUX_ERR', 'float32'),
+            'sap_quality':('SAP_QUALITY', 'int32')}
+
+_INDEX_DTYPE = [('kic', 'int64'), ('start', 'int64'), ('count', 'int64')]
+
+# the stores opened so far, by directory
+_OPEN = {}
+
+
+def FileKIC(file):
+    '''
+    The KIC number from a Kepler FITS file name, kplrNNNNNNNNN-...
+    (see appaloosa.FileID)
+    '''
+    from appaloosa import FileID
+    return int(FileID(file, prefix='kplr')[0])
+
+
+def FileLCflag(file, header=None):
+    '''
+    The cadence of a Kepler FITS file, as the database lcflag: 0 for short
+    cadence, 1 for long. From the OBSMODE keyword in the primary header if
+    given, otherwise the _slc/_llc at the end of the file name (not the
+    folders, which could have "slc" in them).
+    '''
+    if header is not None:
+        obsmode = str(header.get('OBSMODE', '')).strip().lower()
+        if obsmode.startswith('short'):
+            return 0
+        if obsmode.startswith('long'):
+            return 1
+
+    name = os.path.basename(file.split('::')[-1])
+    if name.find('_slc') > -1:
+        return 0
+    return 1
+
+
+def SplitJob(file, objectid=''):
+    '''
+    The store directory and KIC for a light curve in a store, given either
+    as file="storedir::KIC", or as file="storedir" and objectid="KIC".
+
+    Returns
+    -------
+    storedir, KIC (str)
+    '''
+    storedir = file
+    if file.find('::') > -1:
+        storedir, kic = file.split('::', 1)
+        if len(str(objectid)) == 0:
+            objectid = kic
+
+    if len(str(objectid).strip()) == 0:
+        raise ValueError('lcstore: no KIC for ' + str(file) + ', give it as '
+                         'objectid or as file="storedir::KIC"')
+    return storedir, str(int(objectid))
+
+
+def StoreJobs(storedir):
+    '''
+    Every star in a store, as "storedir::KIC", e.g. for a batch.py list
+
+    Returns
+    -------
+    list of str
+    '''
+    index = np.load(os.path.join(storedir, 'index.npy'))
+    return [storedir + '::' + str(kic) for kic in index['kic']]
+
+
+def _ScanFits(files):
+    '''
+    Read only the headers of each file, to get its KIC, quarter, cadence,
+    start time and number of rows
+
+    Returns
+    -------
+    structured array, one entry per file
+    '''
+    from astropy.io import fits
+
+    scan = np.zeros(len(files), dtype=[('kic', 'int64'), ('quarter', 'int16'),
+                                       ('lcflag', 'int8'), ('tstart', 'float64'),
+                                       ('nrows', 'int64'), ('ifile', 'int64')])
+    for k in range(len(files)):
+        hdu = fits.open(files[k])
+        scan['kic'][k] = FileKIC(files[k])
+        scan['quarter'][k] = hdu[0].header.get('QUARTER', -1)
+        scan['lcflag'][k] = FileLCflag(files[k], header=hdu[0].header)
+        scan['tstart'][k] = hdu[1].header.get('TSTART', 0.)
+        scan['nrows'][k] = hdu[1].header['NAXIS2']
+        scan['ifile'][k] = k
+        hdu.close()
+
+    return scan
+
+
+def BuildStore(files, storedir, verbose=True):
+    '''
+    Build a star-major store from Kepler light curve FITS files.
+
+    The headers are scanned first to lay out the store, then each file's
+    data is read once and copied straight in to its place in the
+    (memory mapped) output columns.
+
+    Parameters
+    ----------
+    files : str or list
+        A file with one FITS path per line, or a list of paths
+    storedir : str
+        where to write the store
+    verbose : bool, optional
+
+    Returns
+    -------
+    the index (structured array of kic, start, count)
+    '''
+    from astropy.io import fits
+
+    if isinstance(files, str):
+        files = list(np.loadtxt(files, dtype='str', ndmin=1))
+
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+
+    scan = _ScanFits(files)
+
+    # star-major order: by KIC, then quarter, short cadence first, time
+    scan = scan[np.lexsort((scan['tstart'], scan['lcflag'], scan['quarter'], scan['kic']))]
+    rowstart = np.append(0, np.cumsum(scan['nrows']))
+    ntot = int(rowstart[-1])
+
+    # the index: where each star starts, and how many rows it has
+    ukic, first, count = np.unique(scan['kic'], return_index=True, return_counts=True)
+    index = np.zeros(len(ukic), dtype=_INDEX_DTYPE)
+    index['kic'] = ukic
+    index['start'] = rowstart[first]
+    index['count'] = [np.sum(scan['nrows'][first[k]:first[k] + count[k]])
+                      for k in range(len(ukic))]
+
+    cols = {}
+    for name in _COLUMNS:
+        cols[name] = np.lib.format.open_memmap(os.path.join(storedir, name + '.npy'),
+                                               mode='w+', dtype=_COLUMNS[name][1],
+                                               shape=(ntot,))
+    lcflag = np.lib.format.open_memmap(os.path.join(storedir, 'lcflag.npy'),
+                                       mode='w+', dtype='int8', shape=(ntot,))
+    quarter = np.lib.format.open_memmap(os.path.join(storedir, 'quarter.npy'),
+                                        mode='w+', dtype='int16', shape=(ntot,))
+
+    for k in range(len(scan)):
+        i0 = rowstart[k]
+        i1 = rowstart[k + 1]
+
+        hdu = fits.open(files[scan['ifile'][k]])
+        data_rec = hdu[1].data
+        for name in _COLUMNS:
+            cols[name][i0:i1] = data_rec[_COLUMNS[name][0]]
+        hdu.close()
+
+        lcflag[i0:i1] = scan['lcflag'][k]
+        quarter[i0:i1] = scan['quarter'][k]
+
+        if (verbose is True) and ((k + 1) % 1000 == 0):
+            print('BuildStore: ' + str(k + 1) + ' / ' + str(len(scan)) + ' files')
+            sys.stdout.flush()
+
+    for name in cols:
+        cols[name].flush()
+    lcflag.flush()
+    quarter.flush()
+
+    np.save(os.path.join(storedir, 'index.npy'), index)
+
+    if verbose is True:
+        print('BuildStore: ' + str(len(index)) + ' stars, ' + str(ntot) +
+              ' rows, from ' + str(len(scan)) + ' files')
+
+    return index
+
+
+def OpenStore(storedir):
+    '''
+    Open a store (memory mapped, read only). Stores are only opened once
+    per process, later calls return the same dict.
+
+    Returns
+    -------
+    dict of the columns, plus 'index'
+    '''
+    storedir = os.path.abspath(storedir)
+    if storedir in _OPEN:
+        return _OPEN[storedir]
+
+    store = {'index':np.load(os.path.join(storedir, 'index.npy'))}
+    for name in list(_COLUMNS.keys()) + ['lcflag', 'quarter']:
+        store[name] = np.load(os.path.join(storedir, name + '.npy'), mmap_mode='r')
+
+    _OPEN[storedir] = store
+    return store
+
+
+def ReadStar(store, kic):
+    '''
+    All the data for one star, as zero-copy views of the store columns
+
+    Parameters
+    ----------
+    store : dict or str
+        from OpenStore, or the store directory
+    kic : int or str
+
+    Returns
+    -------
+    dict of arrays, one per column
+    '''
+    if isinstance(store, str):
+        store = OpenStore(store)
+
+    index = store['index']
+    kic = int(kic)
+    k = np.searchsorted(index['kic'], kic)
+    if (k >= len(index)) or (index['kic'][k] != kic):
+        raise KeyError('ReadStar: KIC ' + str(kic) + ' is not in the store')
+
+    i0 = index['start'][k]
+    i1 = i0 + index['count'][k]
+
+    star = {}
+    for name in store:
+        if name != 'index':
+            star[name] = store[name][i0:i1]
+    return star
+
+
+def GetLCstore(objectid, storedir, ftype='sap', onecadence=True):
+    '''
+    Read one star from the store, for RunLC (dbmode='store')
+
+    Parameters
+    ----------
+    objectid : str or int
+        the KIC number
+    storedir : str
+    ftype : str, optional
+        'sap' or 'pdc' flux (Default is 'sap')
+    onecadence : bool, optional
+        For quarters with long and short cadence, only keep the short
+        cadence, as OneCadence does for the database. (Default is True)
+
+    Returns
+    -------
+    qtr, time, sap_quality, exptime, flux_raw, error
+    '''
+    star = ReadStar(storedir, objectid)
+
+    if ftype == 'sap':
+        flux = star['sap_flux']
+        error = star['sap_flux_err']
+    else:
+        flux = star['pdcsap_flux']
+        error = star['pdcsap_flux_err']
+
+    ok = np.isfinite(flux)
+    if onecadence is True:
+        # the fastest cadence (lowest lcflag) in each quarter
+        qtr = star['quarter']
+        fastest = np.zeros(np.max(qtr) + 2, dtype='int8') + 1
+        np.minimum.at(fastest, qtr + 1, star['lcflag'])
+        ok = ok & (star['lcflag'] == fastest[qtr + 1])
+
+    exptime = np.where(star['lcflag'][ok] == 0, 54.2 / 60. / 60. / 24.,
+                       30 * 54.2 / 60. / 60. / 24.)
+
+    return (np.asarray(star['quarter'][ok], dtype='float'), star['time'][ok],
+            star['sap_quality'][ok], exptime, flux[ok], error[ok])
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python lcstore.py all_fits.lis kepler_store/
+# $python lcstore.py jobs kepler_store/ > store_jobs.lis
+if __name__ == "__main__":
+    if sys.argv[1] == 'jobs':
+        for job in StoreJobs(sys.argv[2]):
+            print(job)
+    else:
+        BuildStore(sys.argv[1], sys.argv[2])
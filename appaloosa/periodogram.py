@@ -0,0 +1,196 @@
+'''
+Lomb Scargle periodogram on a fixed frequency grid, for repeated use
+
+Same fast algorithm (Press & Rybicki 1989) and normalization as the
+gatspy LombScargleFast(fit_offset=False).score_frequency_grid() that was
+used before. The difference is that everything that depends only on
+the time sampling & errors is computed once by LSGrid, and then each
+new flux array (e.g. the residuals after each FitSin pass) only needs
+one extirpolation and FFT in LSPower.
+
+Typical use:
+>>> grid = LSGrid(time, error, minper=0.1, maxper=30., nper=20000)
+>>> pwr = LSPower(grid, flux)
+>>> per = grid['per']
+'''
+
+import numpy as np
+from math import factorial
+
+
+def _bitceil(N):
+    '''
+    The power of 2 greater than or equal to N
+    '''
+    return 1 << int(N - 1).bit_length()
+
+
+def _TrigGeom(t, df, N, f0=0., freq_factor=1., oversampling=5, Mfft=4):
+    '''
+    Set up the FFT trig sums (as in gatspy's trig_sum) for one time
+    sampling. The extirpolation of each time on to the FFT grid only
+    depends on the times, so it is stored as a sparse set of
+    (grid index, data index, coefficient) triplets.
+    '''
+    df = df * freq_factor
+    f0 = f0 * freq_factor
+
+    Nfft = _bitceil(N * oversampling)
+    t0 = np.min(t)
+
+    geom = {'N':N, 'Nfft':Nfft}
+
+    if f0 > 0:
+        geom['shift'] = np.exp(2j * np.pi * f0 * (t - t0))
+    else:
+        geom['shift'] = None
+
+    if t0 != 0:
+        f = f0 + df * np.arange(Nfft)
+        geom['phase'] = np.exp(2j * np.pi * t0 * f)[:N]
+    else:
+        geom['phase'] = None
+
+    x = ((t - t0) * Nfft * df) % Nfft
+
+    # the easy cases where x lands right on the grid
+    integers = (x % 1 == 0)
+    gindx = [x[integers].astype('int')]
+    dindx = [np.where(integers)[0]]
+    coeff = [np.ones(np.sum(integers))]
+
+    # everything else is spread over the M nearest grid points,
+    # w/ lagrange polynomial weights (Press et al. 1989)
+    M = int(Mfft)
+    didx = np.where(~integers)[0]
+    x = x[~integers]
+    ilo = np.clip((x - M // 2).astype('int'), 0, Nfft - M)
+    numerator = np.prod(x - ilo - np.arange(M)[:, np.newaxis], 0)
+    denominator = factorial(M - 1)
+    for j in range(M):
+        if j > 0:
+            denominator *= j / float(j - M)
+        ind = ilo + (M - 1 - j)
+        gindx.append(ind)
+        dindx.append(didx)
+        coeff.append(numerator / (denominator * (x - ind)))
+
+    geom['gindx'] = np.concatenate(gindx)
+    geom['dindx'] = np.concatenate(dindx)
+    geom['coeff'] = np.concatenate(coeff)
+
+    return geom
+
+
+def _TrigSum(geom, h):
+    '''
+    The sums S_j = sum(h * sin(2 pi f_j t)) and C_j = sum(h * cos(2 pi f_j t))
+    over the frequency grid, using the precomputed geometry from _TrigGeom
+    '''
+    if geom['shift'] is not None:
+        h = h * geom['shift']
+    else:
+        h = np.array(h, dtype='complex')
+
+    hw = h[geom['dindx']] * geom['coeff']
+    Nfft = geom['Nfft']
+    grid = np.bincount(geom['gindx'], weights=hw.real, minlength=Nfft) + \
+           1j * np.bincount(geom['gindx'], weights=hw.imag, minlength=Nfft)
+
+    fftgrid = np.fft.ifft(grid)[:geom['N']]
+    if geom['phase'] is not None:
+        fftgrid = fftgrid * geom['phase']
+
+    C = Nfft * fftgrid.real
+    S = Nfft * fftgrid.imag
+    return S, C
+
+
+def LSGrid(time, error=None, minper=0.1, maxper=30.0, nper=20000,
+           oversampling=5, Mfft=4):
+    '''
+    Precompute everything for the Lomb Scargle periodogram that depends
+    only on the time sampling and errors, for a frequency grid evenly
+    spaced between 1/maxper and 1/minper.
+
+    Parameters
+    ----------
+    time : 1-d numpy array
+    error : 1-d numpy array, optional
+        If not given, all points are weighted equally
+    minper : float, optional
+    maxper : float, optional
+    nper : int, optional
+        number of frequencies in the grid
+    oversampling : int, optional
+        passed to the FFT trig sums, see gatspy (Default is 5)
+    Mfft : int, optional
+        passed to the FFT trig sums, see gatspy (Default is 4)
+
+    Returns
+    -------
+    dict, with the frequency grid ('freq') and periods ('per'),
+    to pass to LSPower
+    '''
+    time = np.array(time, dtype='float')
+    if error is None:
+        error = np.ones_like(time)
+
+    w = 1. / (np.array(error, dtype='float')**2.)
+    w = w / np.sum(w)
+
+    df = (1./minper - 1./maxper) / nper
+    f0 = 1./maxper
+
+    freq = f0 + df * np.arange(nper)
+
+    geom = _TrigGeom(time, df, nper, f0=f0, oversampling=oversampling, Mfft=Mfft)
+
+    # the time-shift (tau) terms at each frequency, only need the weights
+    S2, C2 = _TrigSum(_TrigGeom(time, df, nper, f0=f0, freq_factor=2.,
+                                oversampling=oversampling, Mfft=Mfft), w)
+
+    tan_2omega_tau = S2 / C2
+    S2w = tan_2omega_tau / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+    C2w = 1 / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+
+    grid = {'freq':freq, 'per':1./freq, 'w':w, 'geom':geom,
+            'Cw':np.sqrt(0.5) * np.sqrt(1 + C2w),
+            'Sw':np.sqrt(0.5) * np.sign(S2w) * np.sqrt(1 - C2w),
+            'CC':0.5 * (1 + C2 * C2w + S2 * S2w),
+            'SS':0.5 * (1 - C2 * C2w - S2 * S2w)}
+
+    return grid
+
+
+def LSPower(grid, flux):
+    '''
+    Compute the (normalized) Lomb Scargle power for a flux array, on the
+    frequency grid from LSGrid. The flux must have the same time sampling
+    that was used to make the grid.
+
+    Parameters
+    ----------
+    grid : dict
+        output from LSGrid
+    flux : 1-d numpy array
+
+    Returns
+    -------
+    power at each frequency, grid['freq']
+    '''
+    w = grid['w']
+
+    # center the data
+    y = np.array(flux, dtype='float')
+    y = y - np.dot(w, y)
+
+    Sh, Ch = _TrigSum(grid['geom'], w * y)
+
+    YY = np.dot(w, y**2.)
+    YC = Ch * grid['Cw'] + Sh * grid['Sw']
+    YS = Sh * grid['Cw'] - Ch * grid['Sw']
+
+    power = (YC * YC / grid['CC'] + YS * YS / grid['SS']) / YY
+
+    return power
@@ -0,0 +1,164 @@
+'''
+Rolling (moving window) statistics, used by the detrending methods
+
+These replace the pandas.rolling_* functions, which have been removed
+from pandas. Name and output conventions match the old pandas versions:
+the output has the same length as the input, and is NaN wherever the
+window is not full.
+'''
+
+import numpy as np
+from bisect import bisect_left, insort
+
+try:
+    import bottleneck
+    haz_bottleneck = True
+except ImportError:
+    haz_bottleneck = False
+
+
+def _offset(window, center):
+    '''
+    How many points to shift a trailing-window result by, so each value
+    sits at the middle of its window (as pandas does with center=True)
+    '''
+    if center is True:
+        return int((window - 1) / 2.)
+    else:
+        return 0
+
+
+def _median_sorted(x, window, min_count):
+    '''
+    Trailing rolling median, keeping a sorted copy of the finite values
+    in the window. Each step is a binary search plus one insert/remove,
+    so the whole pass is ~O(n log w).
+    '''
+    n = len(x)
+    out = np.empty(n, dtype='float')
+    out.fill(np.nan)
+
+    xl = x.tolist()
+    ok = np.isfinite(x).tolist()
+    win = []
+
+    for i in range(n):
+        if ok[i]:
+            insort(win, xl[i])
+        if i >= window and ok[i - window]:
+            del win[bisect_left(win, xl[i - window])]
+
+        nw = len(win)
+        if nw >= min_count and nw > 0:
+            h = nw // 2
+            if nw % 2 == 1:
+                out[i] = win[h]
+            else:
+                out[i] = 0.5 * (win[h - 1] + win[h])
+
+    return out
+
+
+def RollingMedian(x, window, center=False, nanaware=False, min_periods=None):
+    '''
+    Median in a sliding window of fixed number of points.
+
+    Parameters
+    ----------
+    x : 1-d numpy array
+    window : int
+        Number of points in the moving window
+    center : bool, optional
+        If True, put the result at the center of the window, otherwise
+        at the right (trailing) edge. (Default is False)
+    nanaware : bool, optional
+        If False, any NaN in the window makes the output NaN, like the
+        old pandas.rolling_median. If True, NaN's are skipped and the
+        median of the remaining values is used. (Default is False)
+    min_periods : int, optional
+        With nanaware=True, the minimum number of finite points needed
+        in the window. (Default is 1)
+
+    Returns
+    -------
+    numpy array, same length as x
+    '''
+    x = np.array(x, dtype='float')
+    window = int(window)
+
+    if window < 1:
+        raise ValueError('RollingMedian: window must be >= 1')
+
+    if nanaware is True:
+        if min_periods is None:
+            min_count = 1
+        else:
+            min_count = min(int(min_periods), window)
+    else:
+        min_count = window
+
+    # pad the end w/ NaN's so the centered windows run off the end cleanly
+    offset = _offset(window, center)
+    if offset > 0:
+        x = np.append(x, np.zeros(offset) + np.nan)
+
+    if min_count > len(x):
+        # window can never be full enough
+        out = np.zeros_like(x) + np.nan
+    elif haz_bottleneck is True:
+        # the double-heap version in C, same engine the old pandas used.
+        # (nothing leaves a window longer than the data, so clip it)
+        out = bottleneck.move_median(x, min(window, len(x)), min_count=min_count)
+    else:
+        out = _median_sorted(x, window, min_count)
+
+    return out[offset:]
+
+
+def RollingStd(x, window, center=False, ddof=1):
+    '''
+    Standard deviation in a sliding window of fixed number of points,
+    like the old pandas.rolling_std (with ddof=1 by default). Any NaN in
+    the window makes the output NaN.
+
+    Parameters
+    ----------
+    x : 1-d numpy array
+    window : int
+        Number of points in the moving window
+    center : bool, optional
+        If True, put the result at the center of the window, otherwise
+        at the right (trailing) edge. (Default is False)
+    ddof : int, optional
+        Delta degrees of freedom (Default is 1, as pandas)
+
+    Returns
+    -------
+    numpy array, same length as x
+    '''
+    x = np.array(x, dtype='float')
+    window = int(window)
+
+    if window < 1:
+        raise ValueError('RollingStd: window must be >= 1')
+
+    # pad the end w/ NaN's so the centered windows run off the end cleanly
+    offset = _offset(window, center)
+    if offset > 0:
+        x = np.append(x, np.zeros(offset) + np.nan)
+
+    out = np.zeros_like(x) + np.nan
+    if (window > len(x)) or (window <= ddof):
+        # window can never be full, or has too few points for ddof
+        return out[offset:]
+
+    # every full window as a row of a (no copy) strided view. Two pass
+    # (mean, then the scatter about it), so large offsets, e.g. flux ~1e4
+    # with scatter ~1, don't lose precision. (bottleneck.move_std and
+    # pandas keep running sums, and are off by up to ~1e-4 there)
+    nwin = len(x) - window + 1
+    wins = np.lib.stride_tricks.as_strided(x, shape=(nwin, window),
+                                           strides=(x.strides[0], x.strides[0]))
+    out[window - 1:] = np.std(wins, axis=1, ddof=ddof)
+
+    return out[offset:]
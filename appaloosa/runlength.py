@@ -0,0 +1,151 @@
+'''
+Vectorized run-length tools for grouping flagged data points
+
+Used by FINDflare to find consecutive candidate points, and by
+DetectCandidate / MultiFind to combine neighboring candidates in to events.
+Ranges does the reverse, expanding many index ranges in to one array.
+'''
+
+import numpy as np
+
+
+def RunLength(mask):
+    '''
+    Find every run of consecutive True (or non-zero) values in a 1-d mask.
+
+    Parameters
+    ----------
+    mask : 1-d array
+        Boolean (or 0/1) array, e.g. the "cindx" array in FINDflare
+
+    Returns
+    -------
+    starts, stops, lengths : int arrays
+        The index of the first and last point in each run, and the number
+        of points in each run. The stop index is inclusive.
+    '''
+    m = np.asarray(mask) > 0
+
+    # pad with zeros so runs touching either end still have 2 edges
+    edges = np.diff(np.concatenate(([0], m.astype('int8'), [0])))
+
+    starts = np.where((edges == 1))[0]
+    stops = np.where((edges == -1))[0] - 1
+    lengths = stops - starts + 1
+
+    return starts, stops, lengths
+
+
+def RunMask(starts, stops, n):
+    '''
+    The inverse of RunLength: make a binary array of length n, with 1's
+    between each start and (inclusive) stop index.
+
+    Parameters
+    ----------
+    starts : int array
+    stops : int array
+    n : int
+        length of the output array
+
+    Returns
+    -------
+    int array of 0's and 1's
+    '''
+    starts = np.asarray(starts, dtype='int')
+    stops = np.asarray(stops, dtype='int')
+
+    # +1 at each start, -1 just past each stop, then add up
+    edges = np.zeros(n + 1, dtype='int')
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, stops + 1, -1)
+
+    return np.array(np.cumsum(edges[:-1]) > 0, dtype='int')
+
+
+def GroupIndex(indx, minsep=3):
+    '''
+    Combine a sorted list of candidate indicies in to events. Neighboring
+    candidates that are within "minsep" points of each other are put in
+    to the same event.
+
+    Parameters
+    ----------
+    indx : int array
+        sorted candidate indicies
+    minsep : int, optional
+        The number of datapoints required between individual events
+        (default is 3)
+
+    Returns
+    -------
+    (event start index, event stop index)
+    '''
+    indx = np.asarray(indx, dtype='int')
+
+    if (len(indx) < 1):
+        return np.array([], dtype='int'), np.array([], dtype='int')
+
+    brk = np.where((indx[1:] - indx[:-1] > minsep))[0]
+
+    istart = indx[np.append([0], brk + 1)]
+    istop = indx[np.append(brk, [len(indx) - 1])]
+
+    return istart, istop
+
+
+def Ranges(starts, stops):
+    '''
+    Concatenate many index ranges [start, stop) in to one array, e.g. all
+    the data points in a list of flares, without a python loop.
+
+    Parameters
+    ----------
+    starts : int array
+    stops : int array
+        The stop index is exclusive, as with range(). Empty (or negative)
+        ranges are skipped.
+
+    Returns
+    -------
+    (indicies, which range each index came from)
+    '''
+    starts = np.asarray(starts, dtype='int')
+    lens = np.asarray(stops, dtype='int') - starts
+    lens[lens < 0] = 0
+
+    seg = np.repeat(np.arange(len(starts)), lens)
+    indx = np.arange(np.sum(lens)) - np.repeat(np.cumsum(lens) - lens, lens) + \
+           np.repeat(starts, lens)
+    return indx, seg
+
+
+def MergeRanges(starts, stops):
+    '''
+    Combine overlapping (or touching) index ranges [start, stop) in to
+    single ranges. The input does not need to be sorted.
+
+    Parameters
+    ----------
+    starts : int array
+    stops : int array
+
+    Returns
+    -------
+    starts, stops : int arrays
+        sorted, non-overlapping ranges
+    '''
+    starts = np.asarray(starts, dtype='int')
+    stops = np.asarray(stops, dtype='int')
+
+    if (len(starts) < 1):
+        return np.array([], dtype='int'), np.array([], dtype='int')
+
+    srt = np.argsort(starts, kind='mergesort')
+    starts = starts[srt]
+    stops = np.maximum.accumulate(stops[srt])
+
+    # a new range begins wherever the start is past all previous stops
+    brk = np.where((starts[1:] > stops[:-1]))[0]
+
+    return starts[np.append([0], brk + 1)], stops[np.append(brk, [len(stops) - 1])]
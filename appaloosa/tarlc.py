@@ -0,0 +1,257 @@
+'''
+Read Kepler light curves straight out of the quarter tarballs
+(Q*_public/*.tgz), without extracting them to disk first.
+
+A light curve inside a tarball is named "archive.tgz::member", e.g.
+    Q1_public/public_Q1_long_1.tgz::kplr000757076-2009166043257_llc.fits
+and can be given to RunLC (dbmode='fits') like any other file.
+
+TarIndex lists each member's name, data offset and size, once per
+tarball, and saves it next to it (archive.tgz.idx). ReadMember then reads
+one member in to memory.
+
+Note on compressed (.tgz) tarballs: gzip can't seek backwards, so getting
+to a member means decompressing everything before it. The open tarball
+is kept, and reads that go forward in the file carry on from where the
+last one stopped, so reading the members in on-disk order (as
+TarManifest lists them, and IterMembers streams them) only decompresses
+the file once. Reading them in random order decompresses from the start
+each time. For random access, use an uncompressed .tar, or lcstore.py.
+
+Each thread keeps its own open tarball, so several reader threads (e.g.
+batch.py --pipeline) can read members at once. Check that this works on
+a real tarball with:
+$ python tarlc.py check Q1_public/public_Q1_long_1.tgz
+'''
+
+import os
+import io
+import sys
+import gzip
+import fnmatch
+import tarfile
+import threading
+
+# the index of each tarball read so far, and a lock for building it
+_INDEX = {}
+_INDEX_LOCK = threading.Lock()
+
+# for each thread, the open (possibly gzip) file handle of the last
+# tarball it read (.fh), and its name (.tarpath), so reads in on-disk
+# order don't restart the decompression. A handle is never shared by two
+# threads, as each read is a seek then a read.
+_LOCAL = threading.local()
+
+
+def IsTar(path):
+    '''
+    Is this a tarball (and not a member of one)?
+    '''
+    if path.find('::') > -1:
+        return False
+    return path.endswith(('.tar', '.tgz', '.tar.gz'))
+
+
+def SplitPath(path):
+    '''
+    Split "archive.tgz::member" in to (archive, member). Returns
+    (path, None) for a normal file.
+    '''
+    if path.find('::') == -1:
+        return path, None
+    tarpath, member = path.split('::', 1)
+    return tarpath, member
+
+
+def _IsGzip(tarpath):
+    f = open(tarpath, 'rb')
+    magic = f.read(2)
+    f.close()
+    return magic == b'\x1f\x8b'
+
+
+def BuildTarIndex(tarpath, pattern='*'):
+    '''
+    Scan through a tarball once, and list its members
+
+    Parameters
+    ----------
+    tarpath : str
+    pattern : str, optional
+        only list members whose (base) name matches this, e.g. '*.fits'
+
+    Returns
+    -------
+    list of (member name, data offset, size), in on-disk order
+    '''
+    index = []
+    tar = tarfile.open(tarpath, mode='r|*')
+    for info in tar:
+        if info.isfile() and fnmatch.fnmatch(os.path.basename(info.name), pattern):
+            index.append((info.name, info.offset_data, info.size))
+    tar.close()
+    return index
+
+
+def TarIndex(tarpath, rebuild=False):
+    '''
+    The index of a tarball (see BuildTarIndex): read from archive.idx if
+    it is there and newer than the tarball, otherwise built and saved
+    there (if the directory is writable).
+
+    Returns
+    -------
+    dict of member name: (data offset, size), and the list of member
+    names in on-disk order
+    '''
+    if (rebuild is False) and (tarpath in _INDEX):
+        return _INDEX[tarpath]
+
+    with _INDEX_LOCK:
+        if (rebuild is False) and (tarpath in _INDEX):
+            # another thread just built it
+            return _INDEX[tarpath]
+        return _TarIndex(tarpath, rebuild)
+
+
+def _TarIndex(tarpath, rebuild):
+    idxfile = tarpath + '.idx'
+    index = None
+    if (rebuild is False) and os.path.isfile(idxfile) and \
+            (os.path.getmtime(idxfile) >= os.path.getmtime(tarpath)):
+        index = []
+        f = open(idxfile, 'r')
+        for line in f:
+            offset, size, name = line.rstrip('\n').split(' ', 2)
+            index.append((name, int(offset), int(size)))
+        f.close()
+
+    if index is None:
+        index = BuildTarIndex(tarpath)
+        try:
+            # write then rename, so no one reads a half written index
+            tmpfile = idxfile + '.' + str(os.getpid())
+            f = open(tmpfile, 'w')
+            for name, offset, size in index:
+                f.write(str(offset) + ' ' + str(size) + ' ' + name + '\n')
+            f.close()
+            os.rename(tmpfile, idxfile)
+        except (IOError, OSError):
+            pass
+
+    members = {}
+    for name, offset, size in index:
+        members[name] = (offset, size)
+        # also allow just the base name, e.g. kplr*.fits without its folder
+        members.setdefault(os.path.basename(name), (offset, size))
+
+    _INDEX[tarpath] = (members, [name for name, _, _ in index])
+    return _INDEX[tarpath]
+
+
+def ReadMember(tarpath, member):
+    '''
+    Read one member of a tarball in to memory
+
+    Parameters
+    ----------
+    tarpath : str
+    member : str
+        the member name, or just its base name
+
+    Returns
+    -------
+    the member's contents (bytes)
+    '''
+    members, _ = TarIndex(tarpath)
+    if member not in members:
+        raise KeyError('ReadMember: ' + member + ' is not in ' + tarpath)
+    offset, size = members[member]
+
+    fh = getattr(_LOCAL, 'fh', None)
+    if (getattr(_LOCAL, 'tarpath', None) != tarpath) or (fh.tell() > offset):
+        # (re)start. For gzip we can only go forward from here
+        if fh is not None:
+            fh.close()
+        if _IsGzip(tarpath):
+            fh = gzip.GzipFile(tarpath, 'rb')
+        else:
+            fh = open(tarpath, 'rb')
+        _LOCAL.tarpath = tarpath
+        _LOCAL.fh = fh
+
+    fh.seek(offset)
+    return fh.read(size)
+
+
+def OpenMember(path):
+    '''
+    A file object for "archive.tgz::member", e.g. to pass to fits.open
+    '''
+    tarpath, member = SplitPath(path)
+    return io.BytesIO(ReadMember(tarpath, member))
+
+
+def TarManifest(tarpath, pattern='*.fits'):
+    '''
+    All the members of a tarball matching pattern, as "archive::member"
+    paths, in on-disk order
+    '''
+    _, names = TarIndex(tarpath)
+    return [tarpath + '::' + name for name in names
+            if fnmatch.fnmatch(os.path.basename(name), pattern)]
+
+
+def IterMembers(tarpath, pattern='*.fits'):
+    '''
+    Stream through a tarball once, in on-disk order, without seeking.
+
+    Yields
+    ------
+    ("archive::member" path, file object with the member's contents)
+    '''
+    tar = tarfile.open(tarpath, mode='r|*')
+    for info in tar:
+        if info.isfile() and fnmatch.fnmatch(os.path.basename(info.name), pattern):
+            yield tarpath + '::' + info.name, io.BytesIO(tar.extractfile(info).read())
+    tar.close()
+
+
+def CheckThreads(tarpath, nthread=4, pattern='*.fits'):
+    '''
+    Read every member of a tarball with ReadMember from nthread threads at
+    once (each thread takes every nthread-th member), and compare them to
+    the members from one pass of IterMembers.
+
+    Returns
+    -------
+    number of members that came back wrong (0 if all is well)
+    '''
+    paths = TarManifest(tarpath, pattern=pattern)
+    got = {}
+
+    def _read(k0):
+        for path in paths[k0::nthread]:
+            got[path] = ReadMember(*SplitPath(path))
+
+    threads = [threading.Thread(target=_read, args=(k,)) for k in range(nthread)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    nbad = len(paths) - len(got)
+    for path, fobj in IterMembers(tarpath, pattern=pattern):
+        if got.get(path) != fobj.read():
+            nbad = nbad + 1
+
+    print('CheckThreads: ' + str(len(paths)) + ' members on ' + str(nthread) +
+          ' threads, ' + str(nbad) + ' wrong')
+    return nbad
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python tarlc.py check Q1_public/public_Q1_long_1.tgz
+if __name__ == "__main__":
+    if (len(sys.argv) > 2) and (sys.argv[1] == 'check'):
+        sys.exit(int(CheckThreads(sys.argv[2]) > 0))
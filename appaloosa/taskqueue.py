@@ -0,0 +1,491 @@
+'''
+Pull-based task queue for running appaloosa on many machines, kept in a
+single SQLite file on a shared filesystem.
+
+Instead of a fixed list of jobs per Condor shard, each worker (on any
+host, started at any time) claims a small batch of light curves, holds a
+lease on them while it works, and marks each one done or failed. A
+worker that dies or hangs stops renewing its leases, and once they
+expire those light curves go back in the queue for someone else. Leases
+are renewed by a background thread, so to catch a worker that is alive
+but stuck, renewal stops once a task has run for longer than maxrun
+seconds. Light curves that keep getting stranded are marked failed after
+maxtries.
+
+Note: SQLite relies on the filesystem's file locking. This is fine on a
+local disk or a well behaved NFS mount, but if the shared filesystem
+does not support locks, run the queue file on one machine's local disk.
+
+Run from the terminal, e.g.:
+$ python taskqueue.py create queue.db all_fits.lis
+$ python taskqueue.py run queue.db --batch 10 --lease 1800     (on each node)
+$ python taskqueue.py status queue.db
+$ python taskqueue.py requeue queue.db
+$ python taskqueue.py demo --nproc 4                    (local test)
+'''
+
+import os
+import sys
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+import time as _time
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    state TEXT NOT NULL DEFAULT 'todo',
+    owner TEXT,
+    lease REAL,
+    tries INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease);
+'''
+
+
+def Connect(dbfile, timeout=120.):
+    '''
+    Open the queue file. Transactions are handled explicitly, so that a
+    claim (find free tasks + mark them as taken) is one locked step.
+    '''
+    conn = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def OwnerID():
+    '''
+    A name for this worker, unique across hosts
+    '''
+    return socket.gethostname() + '-' + str(os.getpid())
+
+
+def CreateQueue(dbfile, files):
+    '''
+    Add light curves to the queue (made if needed). Files that are already
+    in the queue are left alone.
+
+    Parameters
+    ----------
+    dbfile : str
+    files : list of str
+
+    Returns
+    -------
+    number of tasks added
+    '''
+    conn = Connect(dbfile)
+    conn.execute('BEGIN IMMEDIATE')
+    n0 = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    conn.executemany('INSERT OR IGNORE INTO tasks (path) VALUES (?)',
+                     [(f,) for f in files])
+    n1 = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    conn.execute('COMMIT')
+    conn.close()
+    return n1 - n0
+
+
+def Claim(conn, owner, n=10, lease=600., maxtries=3):
+    '''
+    Take up to n tasks from the queue, with a lease of "lease" seconds.
+    Expired leases are put back in the queue first (or marked failed, if
+    they have been tried maxtries times).
+
+    Returns
+    -------
+    list of (task id, path)
+    '''
+    now = _time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute("UPDATE tasks SET state='fail', owner=NULL, "
+                     "error='lease expired ' || tries || ' times' "
+                     "WHERE state='run' AND lease < ? AND tries >= ?", (now, maxtries))
+        conn.execute("UPDATE tasks SET state='todo', owner=NULL "
+                     "WHERE state='run' AND lease < ?", (now,))
+
+        rows = conn.execute("SELECT id, path FROM tasks WHERE state='todo' "
+                            "ORDER BY id LIMIT ?", (n,)).fetchall()
+        conn.executemany("UPDATE tasks SET state='run', owner=?, lease=?, tries=tries+1 "
+                         "WHERE id=?", [(owner, now + lease, r[0]) for r in rows])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return rows
+
+
+def Renew(conn, owner, ids, lease=600.):
+    '''
+    Extend the lease on tasks this owner is still running.
+
+    Returns
+    -------
+    the number of tasks renewed. Fewer than len(ids) means some leases
+    were lost (expired and claimed by someone else).
+    '''
+    if len(ids) == 0:
+        return 0
+    cur = conn.executemany("UPDATE tasks SET lease=? WHERE id=? AND owner=? AND state='run'",
+                           [(_time.time() + lease, i, owner) for i in ids])
+    return cur.rowcount
+
+
+def Hold(conn, owner, id, lease=600.):
+    '''
+    Renew the lease on one task, but only if this owner still holds it
+    and the lease has not run out. Called just before the task is run, so
+    a task that has been handed to someone else is not run twice.
+
+    Returns
+    -------
+    True if the task is still ours
+    '''
+    now = _time.time()
+    cur = conn.execute("UPDATE tasks SET lease=? WHERE id=? AND owner=? "
+                       "AND state='run' AND lease > ?", (now + lease, id, owner, now))
+    return cur.rowcount == 1
+
+
+def Finish(conn, owner, id, error=None):
+    '''
+    Mark a task done (or failed, if an error message is given). Does
+    nothing if this owner has lost the lease.
+
+    Returns
+    -------
+    True if the task was still ours
+    '''
+    if error is None:
+        cur = conn.execute("UPDATE tasks SET state='done', lease=NULL, error=NULL "
+                           "WHERE id=? AND owner=? AND state='run'", (id, owner))
+    else:
+        cur = conn.execute("UPDATE tasks SET state='fail', lease=NULL, error=? "
+                           "WHERE id=? AND owner=? AND state='run'", (error, id, owner))
+    return cur.rowcount == 1
+
+
+def Requeue(dbfile, state='fail'):
+    '''
+    Put all tasks in this state back in the queue, with their tries reset
+
+    Returns
+    -------
+    number of tasks requeued
+    '''
+    conn = Connect(dbfile)
+    cur = conn.execute("UPDATE tasks SET state='todo', owner=NULL, lease=NULL, tries=0 "
+                       "WHERE state=?", (state,))
+    n = cur.rowcount
+    conn.close()
+    return n
+
+
+def Status(dbfile):
+    '''
+    The number of tasks in each state ('todo', 'run', 'done', 'fail')
+    '''
+    conn = Connect(dbfile)
+    counts = dict(conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+    conn.close()
+    for s in ('todo', 'run', 'done', 'fail'):
+        counts.setdefault(s, 0)
+    return counts
+
+
+def _Heartbeat(dbfile, owner, ids, lease, stop, running, maxrun):
+    '''
+    Renew the leases on ids (a list, updated by RunQueue) every lease/3
+    seconds until stop is set. Has its own connection, as sqlite
+    connections can't be shared across threads.
+
+    running[0] is the start time of the task being run (None between
+    tasks). Once that has been going for more than maxrun seconds the
+    worker is taken to be stuck, and its leases are left to expire.
+    '''
+    conn = Connect(dbfile)
+    stuck = False
+    while not stop.wait(lease / 3.):
+        t0 = running[0]
+        if (maxrun is not None) and (t0 is not None) and (_time.time() - t0 > maxrun):
+            if stuck is False:
+                print('RunQueue: task running for over ' + str(maxrun) +
+                      ' s, no longer renewing the leases')
+                sys.stdout.flush()
+                stuck = True
+            continue
+        stuck = False
+        try:
+            Renew(conn, owner, list(ids), lease=lease)
+        except sqlite3.Error:
+            # busy, try again next beat
+            pass
+    conn.close()
+    return
+
+
+def RunQueue(dbfile, func, owner=None, batch=10, lease=600., maxtries=3,
+             maxtasks=None, wait=True, maxrun=14400.):
+    '''
+    Claim and run tasks until the queue is empty.
+
+    Parameters
+    ----------
+    dbfile : str
+    func : function
+        called as func(path) for each task. Any exception marks the task
+        failed (with the traceback), otherwise it is marked done.
+    owner : str, optional
+        name for this worker (Default is OwnerID())
+    batch : int, optional
+        number of tasks to claim at a time (Default is 10)
+    lease : float, optional
+        lease length in seconds. Leases are renewed in the background,
+        so this only needs to be longer than a stalled worker should be
+        allowed to hold its tasks. (Default is 600)
+    maxtries : int, optional
+        give up on a task after its lease has expired this many times
+    maxtasks : int, optional
+        stop after this many tasks (Default is None, no limit)
+    wait : bool, optional
+        If True (default), when there is nothing left to claim but other
+        workers still hold leases, wait for those to finish or expire
+        rather than quitting, in case they need to be re-run.
+    maxrun : float, optional
+        the longest (in seconds) one task may run. After this the leases
+        are no longer renewed, so a hung task goes back in the queue
+        (and counts towards maxtries). None for no limit. If the task
+        does finish later, its result is still recorded if no one else
+        has claimed it. (Default is 14400, 4 hours)
+
+    Returns
+    -------
+    (number done, number failed, number lost). Lost tasks are ones whose
+    lease ran out (and may have gone to another worker) before they were
+    run or before their result could be recorded.
+    '''
+    if owner is None:
+        owner = OwnerID()
+
+    conn = Connect(dbfile)
+
+    held = []
+    running = [None]
+    stop = threading.Event()
+    beat = threading.Thread(target=_Heartbeat,
+                            args=(dbfile, owner, held, lease, stop, running, maxrun))
+    beat.daemon = True
+    beat.start()
+
+    nok = 0
+    nfail = 0
+    nlost = 0
+    try:
+        while (maxtasks is None) or (nok + nfail < maxtasks):
+            n = batch
+            if maxtasks is not None:
+                n = min(n, maxtasks - nok - nfail)
+
+            tasks = Claim(conn, owner, n=n, lease=lease, maxtries=maxtries)
+            if len(tasks) == 0:
+                nxt = conn.execute("SELECT MIN(lease) FROM tasks WHERE state='run'").fetchone()[0]
+                if (wait is False) or (nxt is None):
+                    break
+                # sleep until the next lease could expire (or be finished)
+                _time.sleep(min(max(nxt - _time.time(), 0.) + 0.1, lease / 3.))
+                continue
+            held[:] = [t[0] for t in tasks]
+
+            for id, path in tasks:
+                if not Hold(conn, owner, id, lease=lease):
+                    # e.g. an earlier task in the batch ran past maxrun
+                    print('RunQueue: lost the lease on ' + path + ', skipping it')
+                    nlost = nlost + 1
+                    held.remove(id)
+                    sys.stdout.flush()
+                    continue
+
+                running[0] = _time.time()
+                try:
+                    func(path)
+                    err = None
+                except Exception:
+                    err = traceback.format_exc()
+                running[0] = None
+
+                if err is not None:
+                    print('RunQueue: FAILED ' + path)
+                    print(err)
+
+                if not Finish(conn, owner, id, error=err):
+                    print('RunQueue: lost the lease on ' + path)
+                    nlost = nlost + 1
+                elif err is None:
+                    nok = nok + 1
+                else:
+                    nfail = nfail + 1
+                held.remove(id)
+                sys.stdout.flush()
+    finally:
+        stop.set()
+        beat.join()
+        conn.close()
+
+    return nok, nfail, nlost
+
+
+def _RunLCFunc(dbmode='fits', emufile=None, **kwargs):
+    '''
+    The func for RunQueue that runs appaloosa on each light curve
+    '''
+    import appaloosa
+    import emulator
+    import worker
+    import batch
+
+    if isinstance(emufile, str):
+        emufile = emulator.LoadEmulator(emufile)
+    if emufile is not None:
+        kwargs['emufile'] = emufile
+    kwargs.setdefault('display', False)
+    kwargs.setdefault('debug', False)
+
+    def func(path):
+        # the task may have been started before (lost lease, retry, or a
+        # crashed worker), and FakeFlares appends to the .fake file
+        batch._ClearFake(path, dbmode)
+        try:
+            if dbmode == 'mysql':
+                appaloosa.RunLC(objectid=path, dbmode=dbmode, **kwargs)
+            else:
+                appaloosa.RunLC(file=path, dbmode=dbmode, **kwargs)
+        finally:
+            worker._ResetState()
+        return
+
+    return func
+
+
+def _DemoTask(path):
+    '''
+    Stand-in for RunLC in the demo: sleep a bit, and sometimes fail
+    '''
+    k = int(path.split('_')[-1])
+    _time.sleep(0.02 + 0.03 * (k % 3))
+    if k % 17 == 0:
+        raise ValueError('demo failure for ' + path)
+    return
+
+
+def _DemoNode(dbfile, inode, batch, lease):
+    if inode == 0:
+        # this "node" claims some work and then dies without finishing it
+        conn = Connect(dbfile)
+        Claim(conn, OwnerID(), n=batch, lease=lease)
+        conn.close()
+        os._exit(0)
+    RunQueue(dbfile, _DemoTask, batch=batch, lease=lease)
+    return
+
+
+def Demo(dbfile='demo_queue.db', ntask=100, nproc=4, batch=5, lease=1.):
+    '''
+    Try the queue out locally, with nproc processes standing in for nodes.
+    One of them claims a batch and dies, so its tasks only get done once
+    the lease expires and another node picks them up.
+    '''
+    import multiprocessing
+
+    if os.path.isfile(dbfile):
+        os.remove(dbfile)
+    CreateQueue(dbfile, ['lc_' + str(k) for k in range(ntask)])
+
+    t0 = _time.time()
+    procs = [multiprocessing.Process(target=_DemoNode, args=(dbfile, i, batch, lease))
+             for i in range(nproc)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    status = Status(dbfile)
+    print('Demo: ' + str(status) + ' in ' + str(round(_time.time() - t0, 1)) + ' s')
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shared SQLite task queue for appaloosa')
+    sub = parser.add_subparsers(dest='cmd')
+
+    p = sub.add_parser('create', help='add the files in a list to the queue')
+    p.add_argument('dbfile')
+    p.add_argument('listfile')
+
+    p = sub.add_parser('run', help='claim and run light curves until the queue is empty')
+    p.add_argument('dbfile')
+    p.add_argument('--batch', type=int, default=10)
+    p.add_argument('--lease', type=float, default=600.)
+    p.add_argument('--maxtries', type=int, default=3)
+    p.add_argument('--maxrun', type=float, default=14400.,
+                   help='seconds one light curve may run before its lease is let go (0 for no limit)')
+    p.add_argument('--dbmode', default='fits')
+    p.add_argument('--nfake', type=int, default=100)
+    p.add_argument('--fakemode', default='full', choices=('full', 'local', 'validate'))
+    p.add_argument('--emufile', default=None)
+
+    p = sub.add_parser('status', help='count the tasks in each state')
+    p.add_argument('dbfile')
+
+    p = sub.add_parser('requeue', help='put failed tasks back in the queue')
+    p.add_argument('dbfile')
+    p.add_argument('--state', default='fail')
+
+    p = sub.add_parser('demo', help='run a local test with a few processes')
+    p.add_argument('--dbfile', default='demo_queue.db')
+    p.add_argument('--ntask', type=int, default=100)
+    p.add_argument('--nproc', type=int, default=4)
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'create':
+        ff = open(args.listfile, 'r')
+        files = [line.strip() for line in ff if len(line.strip()) > 0]
+        ff.close()
+        print('added ' + str(CreateQueue(args.dbfile, files)) + ' tasks')
+
+    elif args.cmd == 'run':
+        func = _RunLCFunc(dbmode=args.dbmode, emufile=args.emufile,
+                          nfake=args.nfake, fakemode=args.fakemode)
+        nok, nfail, nlost = RunQueue(args.dbfile, func, batch=args.batch,
+                                     lease=args.lease, maxtries=args.maxtries,
+                                     maxrun=args.maxrun if args.maxrun > 0 else None)
+        print('RunQueue: ' + str(nok) + ' done, ' + str(nfail) + ' failed, ' +
+              str(nlost) + ' lost')
+
+    elif args.cmd == 'status':
+        print(Status(args.dbfile))
+
+    elif args.cmd == 'requeue':
+        print('requeued ' + str(Requeue(args.dbfile, state=args.state)) + ' tasks')
+
+    elif args.cmd == 'demo':
+        status = Demo(dbfile=args.dbfile, ntask=args.ntask, nproc=args.nproc)
+        if status['todo'] + status['run'] > 0:
+            return 1
+
+    else:
+        parser.print_help()
+        return 1
+
+    return 0
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python taskqueue.py status queue.db
+if __name__ == "__main__":
+    sys.exit(main())
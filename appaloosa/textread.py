@@ -0,0 +1,272 @@
+'''
+Fast reader for columns of numbers in text files, e.g. the ASCII light
+curves read by GetLCk2, GetLCvdb and GetLCtxt.
+
+Does the same job as np.loadtxt(file, unpack=True, ...) for plain
+numeric tables, but instead of parsing one line at a time the file is
+read in big chunks (cut at a line end), and each chunk is converted to
+numbers in one go (np.fromstring, or the C version of np.loadtxt in
+numpy >= 1.23), then copied in to preallocated output arrays. Only
+the columns asked for are kept, so files bigger than memory can be read
+(ReadText), or streamed through one chunk at a time (IterText).
+
+Two layouts are supported:
+    - delimited (whitespace by default, or e.g. delimiter=','), with
+      usecols picking the columns by number
+    - fixed width, with widths giving the (start, end) character range
+      of each column
+
+Comments (one or more strings, e.g. comments=('#','*')) can start
+anywhere in a line, and skiprows lines are skipped at the top, as for
+np.loadtxt. Every data line should have the same number of values. If a
+chunk doesn't parse cleanly (blank lines, empty fields, text in a
+column...) it is handed to np.loadtxt instead, so the result
+(or error) is the same as before, only slower.
+'''
+
+import os
+import io
+import gzip
+import warnings
+import numpy as np
+
+# bytes to read at a time
+_CHUNK = 1 << 22
+
+# numpy >= 1.23 has np.loadtxt written in C, which is as fast as
+# np.fromstring and only converts the columns in usecols. Use it to parse
+# each chunk when it's there.
+_CLOADTXT = tuple([int(v) for v in np.__version__.split('.')[:2]]) >= (1, 23)
+
+
+def _Open(file):
+    '''
+    Open a (possibly gzip) text file for reading bytes, or use an
+    already open file object
+    '''
+    if not isinstance(file, str):
+        return file
+
+    f = open(file, 'rb')
+    if f.read(2) == b'\x1f\x8b':
+        f.close()
+        return gzip.GzipFile(file, 'rb')
+    f.seek(0)
+    return f
+
+
+def _Chunks(f, skiprows=0, chunksize=_CHUNK):
+    '''
+    Read f in chunks of about chunksize bytes, each ending at a line end,
+    after skipping the first skiprows lines
+    '''
+    for k in range(skiprows):
+        f.readline()
+
+    tail = b''
+    while True:
+        buf = f.read(chunksize)
+        if len(buf) == 0:
+            break
+        buf = tail + buf
+        cut = buf.rfind(b'\n') + 1
+        if cut == 0:
+            # no line end yet, keep reading
+            tail = buf
+            continue
+        tail = buf[cut:]
+        yield buf[:cut]
+
+    if len(tail.strip()) > 0:
+        yield tail + b'\n'
+
+
+def _StripComments(chunk, comments):
+    '''
+    Remove everything after a comment string on each line, and drop the
+    lines left blank
+    '''
+    if not any([c in chunk for c in comments]):
+        return chunk
+
+    lines = chunk.split(b'\n')
+    for c in comments:
+        lines = [line.split(c, 1)[0] for line in lines]
+    return b'\n'.join([line for line in lines if len(line.strip()) > 0]) + b'\n'
+
+
+def _ParseDelimited(chunk, ncols, delimiter):
+    '''
+    All the numbers in a chunk as an (nrows, ncols) array, or None if
+    they don't make a clean table
+    '''
+    if delimiter is not None:
+        chunk = chunk.replace(delimiter, b' ')
+
+    with warnings.catch_warnings():
+        # stopping early at something that's not a number is only a
+        # DeprecationWarning in some numpy versions, an error in others
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            vals = np.fromstring(chunk, dtype='float64', sep=' ')
+        except ValueError:
+            return None
+
+    # every line must have given exactly ncols numbers
+    nrows = chunk.count(b'\n')
+    if len(vals) != nrows * ncols:
+        return None
+    return vals.reshape(nrows, ncols)
+
+
+def _ParseFixed(chunk, widths, usecols):
+    '''
+    Fixed width columns of a chunk, as a list of arrays
+    '''
+    lines = [line for line in chunk.split(b'\n') if len(line.strip()) > 0]
+    if len(lines) == 0:
+        return [np.zeros(0) for k in usecols]
+
+    # one row of characters per line, padded to the longest line
+    width = max([len(line) for line in lines])
+    chars = np.array(lines, dtype='S' + str(width)).view('u1').reshape(len(lines), width)
+
+    cols = []
+    for k in usecols:
+        start, end = widths[k]
+        field = np.ascontiguousarray(chars[:, start:end]).view('S' + str(end - start))
+        cols.append(field.ravel().astype('float64'))
+    return cols
+
+
+def IterText(file, usecols=None, skiprows=0, delimiter=None, comments='#',
+             widths=None, chunksize=_CHUNK):
+    '''
+    Stream through a text table, one chunk at a time
+
+    Parameters
+    ----------
+    file : str or file object
+    usecols : sequence of int, optional
+        which columns to read (Default is all of them)
+    skiprows : int, optional
+        number of lines to skip at the top of the file, including comments
+    delimiter : str, optional
+        the string between values (Default is any whitespace)
+    comments : str or sequence of str, optional
+        the start of a comment, anywhere in a line (Default is '#')
+    widths : sequence of (int, int), optional
+        for fixed width files, the [start, end) character range of each
+        column. delimiter is not used if these are given.
+    chunksize : int, optional
+        bytes to parse at a time
+
+    Yields
+    ------
+    list of float arrays, one per column in usecols
+    '''
+    if comments is None:
+        comments = ()
+    elif isinstance(comments, str):
+        comments = (comments,)
+    comments = [c.encode('latin-1') for c in comments]
+
+    if isinstance(delimiter, str):
+        delimiter = delimiter.encode('latin-1')
+        if len(delimiter.strip()) == 0:
+            # any whitespace works the same
+            delimiter = None
+
+    if (widths is not None) and (usecols is None):
+        usecols = range(len(widths))
+
+    f = _Open(file)
+    try:
+        ncols = None
+        for raw in _Chunks(f, skiprows=skiprows, chunksize=chunksize):
+            chunk = raw
+            if len(comments) > 0:
+                chunk = _StripComments(raw, comments)
+            if len(chunk.strip()) == 0:
+                # only comments (e.g. a long header), which np.loadtxt
+                # would warn about
+                continue
+
+            if widths is not None:
+                yield _ParseFixed(chunk, widths, usecols)
+                continue
+
+            table = None
+            if _CLOADTXT is False:
+                if ncols is None:
+                    # the number of columns, from the first line with data
+                    for line in chunk.split(b'\n'):
+                        if len(line.strip()) > 0:
+                            ncols = len(line.split(delimiter))
+                            break
+                    if ncols is None:
+                        continue
+                    if usecols is None:
+                        usecols = range(ncols)
+                if max(usecols) < ncols:
+                    table = _ParseDelimited(chunk, ncols, delimiter)
+
+            if table is not None:
+                yield [table[:, k] for k in usecols]
+                continue
+
+            # np.loadtxt on just this chunk. Also deals with (or raises the
+            # error for) anything _ParseDelimited can't
+            delim = delimiter
+            if delim is not None:
+                delim = delim.decode('latin-1')
+            table = np.loadtxt(io.BytesIO(raw), usecols=usecols, ndmin=2, delimiter=delim,
+                               comments=[c.decode('latin-1') for c in comments] or None)
+            yield [table[:, k] for k in range(table.shape[1])]
+    finally:
+        if isinstance(file, str):
+            f.close()
+
+
+def ReadText(file, usecols=None, skiprows=0, delimiter=None, comments='#',
+             widths=None, chunksize=_CHUNK):
+    '''
+    Read columns of numbers from a text file, like
+    np.loadtxt(file, unpack=True, ...). See IterText for the parameters.
+
+    The outputs are allocated once, from the file size and the line
+    length of the first chunk, and only grown if that guess was short.
+
+    Returns
+    -------
+    list of float arrays, one per column in usecols
+    '''
+    size = None
+    if isinstance(file, str):
+        size = os.path.getsize(file)
+
+    out = None
+    n = 0
+    for cols in IterText(file, usecols=usecols, skiprows=skiprows, delimiter=delimiter,
+                         comments=comments, widths=widths, chunksize=chunksize):
+        m = len(cols[0])
+        if out is None:
+            if (size is not None) and (m > 0):
+                # rows per byte of the first chunk, times the file size
+                nalloc = int(1.05 * m * size / min(chunksize, size)) + 1
+            else:
+                nalloc = 4 * m + 1
+            out = [np.empty(nalloc, dtype='float64') for col in cols]
+
+        if n + m > len(out[0]):
+            grow = max(n + m, len(out[0]) * 2)
+            out = [np.resize(col, grow) for col in out]
+
+        for k in range(len(cols)):
+            out[k][n:n + m] = cols[k]
+        n = n + m
+
+    if out is None:
+        return [np.zeros(0) for k in (usecols if usecols is not None else ())]
+
+    return [col[:n] for col in out]
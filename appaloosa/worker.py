@@ -0,0 +1,191 @@
+'''
+Long-lived worker that runs RunLC on many light curves in one process,
+so the interpreter start up and the imports (matplotlib, astropy, scipy,
+etc) are only paid once, instead of once per light curve.
+
+File paths can come from a list file, from stdin, or from a spool
+directory of job files (.lis files, one path per line). Workers claim a
+job file by renaming it, so many workers can share one spool directory.
+
+Run from the terminal, e.g.:
+$ python worker.py --list chunk_00001.lis
+$ find Q*_public/ -name '*.fits' | python worker.py --stdin
+$ python worker.py --spool /path/to/spool/
+'''
+
+import os
+import sys
+import gc
+import socket
+import traceback
+import argparse
+import time as _time
+import appaloosa
+import emulator
+
+
+def _ReadList(listfile):
+    '''
+    The paths in a list file, skipping blank and "#" lines
+    '''
+    ff = open(listfile, 'r')
+    paths = [line.strip() for line in ff]
+    ff.close()
+    return [p for p in paths if (len(p) > 0) and not p.startswith('#')]
+
+
+def IterList(listfile):
+    '''
+    Yield each path in a list file
+    '''
+    for path in _ReadList(listfile):
+        yield path
+
+
+def IterStdin():
+    '''
+    Yield each path read from stdin, as they arrive
+    '''
+    for line in sys.stdin:
+        path = line.strip()
+        if (len(path) > 0) and not path.startswith('#'):
+            yield path
+
+
+def IterSpool(spooldir, claimid=None):
+    '''
+    Yield paths from the job files (*.lis) in a spool directory.
+
+    Each job file is claimed by renaming it to "<name>.<claimid>.run" (the
+    rename fails for everyone but one worker), and renamed to
+    "<name>.<claimid>.done" once all of its paths have been handed out.
+    Stops when there are no unclaimed job files left.
+    '''
+    if claimid is None:
+        claimid = socket.gethostname() + '-' + str(os.getpid())
+
+    while True:
+        jobs = sorted([f for f in os.listdir(spooldir) if f.endswith('.lis')])
+        if len(jobs) == 0:
+            return
+
+        for job in jobs:
+            src = os.path.join(spooldir, job)
+            claimed = src + '.' + claimid + '.run'
+            try:
+                os.rename(src, claimed)
+            except OSError:
+                # another worker got it first
+                continue
+
+            for path in _ReadList(claimed):
+                yield path
+
+            os.rename(claimed, src + '.' + claimid + '.done')
+
+
+def _ResetState():
+    '''
+    Clear out anything one light curve could leave behind for the next
+    '''
+    if appaloosa._plt is not None:
+        appaloosa._plt.close('all')
+    gc.collect()
+    return
+
+
+def Worker(paths, dbmode='fits', emufile=None, stoponerror=False, **kwargs):
+    '''
+    Run RunLC on every path, in this process.
+
+    Parameters
+    ----------
+    paths : iterable
+        light curve file names (or object ID's for dbmode='mysql'), e.g.
+        from IterList, IterStdin or IterSpool
+    dbmode : str, optional
+        passed to RunLC (Default is 'fits')
+    emufile : str, optional
+        completeness emulator for RunLC. Loaded once, and re-used for
+        every light curve.
+    stoponerror : bool, optional
+        If False (default), print the error for a failed light curve and
+        move on to the next.
+    kwargs :
+        any other RunLC options (e.g. nfake, fakemode, ...)
+
+    Returns
+    -------
+    (number of light curves finished, number that failed)
+    '''
+    # things that can be kept warm between light curves
+    if isinstance(emufile, str):
+        kwargs['emufile'] = emulator.LoadEmulator(emufile)
+    elif emufile is not None:
+        kwargs['emufile'] = emufile
+
+    kwargs.setdefault('display', False)
+    kwargs.setdefault('debug', False)
+
+    nok = 0
+    nfail = 0
+    t0 = _time.time()
+
+    for path in paths:
+        t1 = _time.time()
+        try:
+            if dbmode == 'mysql':
+                appaloosa.RunLC(objectid=path, dbmode=dbmode, **kwargs)
+            else:
+                appaloosa.RunLC(file=path, dbmode=dbmode, **kwargs)
+            nok = nok + 1
+            print('Worker: done ' + path + ' (' + str(round(_time.time() - t1, 2)) + ' s)')
+        except Exception:
+            nfail = nfail + 1
+            print('Worker: FAILED ' + path)
+            traceback.print_exc()
+            if stoponerror is True:
+                raise
+        finally:
+            _ResetState()
+        sys.stdout.flush()
+
+    print('Worker: ' + str(nok) + ' done, ' + str(nfail) + ' failed in ' +
+          str(round(_time.time() - t0, 1)) + ' s')
+
+    return nok, nfail
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run appaloosa on many light curves in one process')
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument('--list', help='file with one light curve path per line')
+    src.add_argument('--stdin', action='store_true', help='read paths from stdin')
+    src.add_argument('--spool', help='spool directory of .lis job files to claim')
+    parser.add_argument('--dbmode', default='fits')
+    parser.add_argument('--nfake', type=int, default=100)
+    parser.add_argument('--fakemode', default='full', choices=('full', 'local', 'validate'))
+    parser.add_argument('--emufile', default=None)
+    parser.add_argument('--stoponerror', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.list is not None:
+        paths = IterList(args.list)
+    elif args.stdin is True:
+        paths = IterStdin()
+    else:
+        paths = IterSpool(args.spool)
+
+    nok, nfail = Worker(paths, dbmode=args.dbmode, emufile=args.emufile,
+                        stoponerror=args.stoponerror, nfake=args.nfake,
+                        fakemode=args.fakemode)
+
+    if nfail > 0:
+        return 1
+    return 0
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python worker.py --list files.lis
+if __name__ == "__main__":
+    sys.exit(main())